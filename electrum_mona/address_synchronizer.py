@@ -210,7 +210,7 @@ class AddressSynchronizer(Logger):
 
     def add_address(self, address):
         if not self.db.get_addr_history(address):
-            self.db.history[address] = []
+            self.db.set_addr_history(address, [])
             self.set_up_to_date(False)
         if self.synchronizer:
             self.synchronizer.add(address)
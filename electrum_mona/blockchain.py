@@ -21,10 +21,21 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import mmap
+import json
+import bisect
+import array
+import struct
+import asyncio
 import threading
 import sys
 import time
-from typing import Optional, Dict, Mapping, Sequence
+import multiprocessing
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Dict, Mapping, Sequence, NamedTuple, List, Tuple
 
 from . import util
 from .bitcoin import hash_encode, int_to_hex, rev_hex
@@ -38,6 +49,11 @@ from .logging import get_logger, Logger
 _logger = get_logger(__name__)
 MAX_TARGET = 0x00000fffffffffffffffffffffffffffffffffffffffffffffffffffffffffff
 HEADER_SIZE = 80  # bytes
+HASH_SIZE = 32  # bytes, of the entries in the header hash index
+NUM_RECENT_HASHES = 2016  # size of the in-memory hash -> height map, per chain
+# files next to each headers file, see Blockchain._chainwork_index_path,
+# Blockchain._extents_path and HeaderSegment
+INDEX_FILE_SUFFIXES = ('.chainwork', '.extents', '.hashes')
 
 try:
     import lyra2re2_hash
@@ -46,6 +62,17 @@ except ImportError as e:
 
 from .scrypt import scrypt_1024_1_1_80 as scryptGetHash
 
+HAS_NUMPY = False
+try:
+    import numpy
+except ImportError:
+    pass
+else:
+    HAS_NUMPY = True
+
+# Monacoin switched from scrypt to Lyra2REv2 at this height
+LYRA2REV2_HEIGHT = 450000
+
 
 class MissingHeader(Exception):
     pass
@@ -90,10 +117,417 @@ def hash_raw_header(header: str) -> str:
     return hash_encode(sha256d(bfh(header)))
 
 
+# version, prev_block_hash, merkle_root, timestamp, bits, nonce
+_HEADER_STRUCT = struct.Struct('<I32s32sIII')
+if HAS_NUMPY:
+    _HEADER_DTYPE = numpy.dtype([('version', '<u4'), ('prev_block_hash', 'V32'), ('merkle_root', 'V32'),
+                                 ('timestamp', '<u4'), ('bits', '<u4'), ('nonce', '<u4')])
+    assert _HEADER_DTYPE.itemsize == HEADER_SIZE
+
+
+class HeaderBatch:
+    """Serialized headers at consecutive heights, e.g. a chunk, parsed into
+    columns in one pass instead of into a dict per header.
+
+    The integer columns (version, timestamp, bits, nonce) are numpy arrays if
+    numpy is available, array.array otherwise; use tolist() to get python ints
+    for arithmetic. Hashes are bytes in serialization order, and header hashes
+    are computed from the raw 80 byte slices, without going through hex.
+    """
+
+    def __init__(self, data: bytes, start_height: int):
+        if len(data) % HEADER_SIZE != 0:
+            raise InvalidHeader('Invalid headers length: {}'.format(len(data)))
+        self.data = bytes(data)
+        self.start_height = start_height
+        self._hashes = None  # type: Optional[List[bytes]]
+        if HAS_NUMPY:
+            rows = numpy.frombuffer(self.data, dtype=_HEADER_DTYPE)
+            self.version = rows['version']
+            self.timestamp = rows['timestamp']
+            self.bits = rows['bits']
+            self.nonce = rows['nonce']
+            self._prev_block_hashes = rows['prev_block_hash']
+            self._merkle_roots = rows['merkle_root']
+        else:
+            columns = list(zip(*_HEADER_STRUCT.iter_unpack(self.data))) or [()] * 6
+            self.version = array.array('L', columns[0])
+            self.timestamp = array.array('L', columns[3])
+            self.bits = array.array('L', columns[4])
+            self.nonce = array.array('L', columns[5])
+            self._prev_block_hashes = columns[1]
+            self._merkle_roots = columns[2]
+
+    def __len__(self) -> int:
+        return len(self.data) // HEADER_SIZE
+
+    def raw_header(self, i: int) -> bytes:
+        return self.data[i*HEADER_SIZE:(i+1)*HEADER_SIZE]
+
+    def is_missing(self, i: int) -> bool:
+        return self.raw_header(i) == bytes(HEADER_SIZE)
+
+    def prev_block_hash(self, i: int) -> bytes:
+        return bytes(self._prev_block_hashes[i])
+
+    def merkle_root(self, i: int) -> bytes:
+        return bytes(self._merkle_roots[i])
+
+    def hashes(self) -> List[bytes]:
+        """sha256d of each header; use hash_encode for the usual hex form."""
+        if self._hashes is None:
+            data = self.data
+            self._hashes = [sha256d(data[i:i+HEADER_SIZE]) for i in range(0, len(data), HEADER_SIZE)]
+        return self._hashes
+
+    def header(self, i: int) -> dict:
+        """The same dict as deserialize_header returns."""
+        return {
+            'version': int(self.version[i]),
+            'prev_block_hash': hash_encode(self.prev_block_hash(i)),
+            'merkle_root': hash_encode(self.merkle_root(i)),
+            'timestamp': int(self.timestamp[i]),
+            'bits': int(self.bits[i]),
+            'nonce': int(self.nonce[i]),
+            'block_height': self.start_height + i,
+        }
+
+
+class HeaderStore:
+    """Read-only memory map over a headers file, or over its hash index.
+
+    The map stays open for the lifetime of the owning Blockchain, so reading a
+    header does not cost an open/seek/read/close round trip. Whoever changes
+    the file on disk must call remap() afterwards.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._mmap = None  # type: Optional[mmap.mmap]
+        self._size = 0  # in bytes
+        self.remap()
+
+    def size(self) -> int:
+        return self._size
+
+    def remap(self, path: str = None) -> None:
+        if path is not None:
+            self.path = path
+        self.close()
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            size = 0
+        if size > 0:
+            with open(self.path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            size = len(self._mmap)
+        self._size = size
+
+    def close(self) -> None:
+        m, self._mmap, self._size = self._mmap, None, 0
+        if m is None:
+            return
+        try:
+            m.close()
+        except BufferError:
+            # a memoryview returned by read() is still alive.
+            # the old map is released when that view goes away.
+            pass
+
+    def read(self, offset: int, length: int) -> memoryview:
+        """Returns a zero-copy view of the given byte range.
+        The view is shorter than requested if the range is past the end of the file.
+        """
+        if self._mmap is None or offset < 0:
+            return memoryview(b'')
+        return memoryview(self._mmap)[offset:offset+length]
+
+
+class HeaderSegment:
+    """A file of raw headers, with the sha256d of each header in a
+    '.hashes' file next to it.
+
+    Headers files are only appended to, by the chain whose path() they are at.
+    After a fork overtook its parent, chains also read headers from each
+    other's files, see Blockchain._swap_with_parent. Use get_segment() to
+    get the one instance per file.
+
+    Writes are not synced to disk; whoever writes calls sync() once done
+    with a chunk or batch of headers.
+    """
+
+    def __init__(self, path: str):
+        self.lock = threading.RLock()
+        self._headers = HeaderStore(path)
+        self._hashes = HeaderStore(path + '.hashes')
+        if self._hashes.size() > self.size() * HASH_SIZE:
+            # left behind by a crash; never let hashes get ahead of the headers
+            self._write(self._hashes, b'', self.size() * HASH_SIZE, truncate=True)
+
+    @property
+    def path(self) -> str:
+        return self._headers.path
+
+    def size(self) -> int:
+        return self._headers.size() // HEADER_SIZE
+
+    def read_headers(self, pos: int, count: int = 1) -> memoryview:
+        with self.lock:
+            return self._headers.read(pos * HEADER_SIZE, count * HEADER_SIZE)
+
+    def read_hash(self, pos: int) -> Optional[bytes]:
+        """Returns the indexed hash of the header at pos, if any."""
+        with self.lock:
+            h = self._hashes.read(pos * HASH_SIZE, HASH_SIZE)
+            if len(h) == HASH_SIZE and h != bytes(HASH_SIZE):
+                return bytes(h)
+        return None
+
+    def append(self, data: bytes, hashes: bytes) -> int:
+        """Returns the position of the first appended header."""
+        with self.lock:
+            pos = self.size()
+            self._write(self._headers, data, pos * HEADER_SIZE)
+            self._write(self._hashes, hashes, pos * HASH_SIZE)
+            return pos
+
+    def overwrite(self, pos: int, data: bytes, hashes: bytes) -> None:
+        with self.lock:
+            # invalidate the hashes first, so they are never ahead of the headers
+            self._write(self._hashes, bytes(len(hashes)), pos * HASH_SIZE)
+            self._fsync(self._hashes)
+            self._write(self._headers, data, pos * HEADER_SIZE)
+            self._write(self._hashes, hashes, pos * HASH_SIZE)
+
+    def write_hashes(self, pos: int, hashes: bytes) -> None:
+        with self.lock:
+            self._write(self._hashes, hashes, pos * HASH_SIZE)
+
+    def truncate(self, pos: int) -> None:
+        with self.lock:
+            self._write(self._hashes, b'', pos * HASH_SIZE, truncate=True)
+            self._write(self._headers, b'', pos * HEADER_SIZE, truncate=True)
+
+    def sync(self) -> None:
+        """Makes the writes so far durable, the headers before their hashes."""
+        with self.lock:
+            self._fsync(self._headers)
+            self._fsync(self._hashes)
+
+    def rename(self, path: str) -> None:
+        path = os.path.abspath(path)
+        with self.lock:
+            self.close()
+            os.replace(self.path, path)
+            if os.path.exists(self._hashes.path):
+                os.replace(self._hashes.path, path + '.hashes')
+            elif os.path.exists(path + '.hashes'):
+                os.unlink(path + '.hashes')
+            with _segments_lock:
+                _segments.pop(self.path, None)
+                _segments[path] = self
+            self._headers.remap(path)
+            self._hashes.remap(path + '.hashes')
+
+    def delete_hashes(self) -> None:
+        with self.lock:
+            self._hashes.close()
+            try:
+                os.unlink(self._hashes.path)
+            except FileNotFoundError:
+                pass
+            self._hashes.remap()
+
+    def close(self) -> None:
+        """Unmaps the files. Must be called before they are replaced,
+        truncated or deleted by someone else; remap() maps them again.
+        """
+        with self.lock:
+            self._headers.close()
+            self._hashes.close()
+
+    def remap(self) -> None:
+        with self.lock:
+            self._headers.remap()
+            self._hashes.remap()
+
+    @classmethod
+    def _write(cls, store: HeaderStore, data: bytes, offset: int, truncate: bool = False) -> None:
+        store.close()
+        try:
+            if not os.path.exists(store.path):
+                # e.g. the hashes of the checkpoint region get written at large offsets
+                open(store.path, 'wb').close()
+                util.ensure_sparse_file(store.path)
+            with open(store.path, 'rb+') as f:
+                if truncate:
+                    f.truncate(offset)
+                f.seek(offset)
+                f.write(data)
+        finally:
+            store.remap()
+
+    @classmethod
+    def _fsync(cls, store: HeaderStore) -> None:
+        try:
+            with open(store.path, 'rb+') as f:
+                os.fsync(f.fileno())
+        except FileNotFoundError:
+            pass
+
+
+_segments = {}  # type: Dict[str, HeaderSegment]
+_segments_lock = threading.Lock()  # lock order: take this last; so after HeaderSegment.lock
+
+
+def get_segment(path: str) -> HeaderSegment:
+    path = os.path.abspath(path)
+    with _segments_lock:
+        segment = _segments.get(path)
+        if segment is None:
+            segment = _segments[path] = HeaderSegment(path)
+        return segment
+
+
+class Extent(NamedTuple):
+    segment: HeaderSegment
+    start: int  # position of the first header in the segment
+    count: int
+
+
+def split_extents(extents: Sequence[Extent], n: int) -> Tuple[List[Extent], List[Extent]]:
+    """Splits a list of extents after the first n headers."""
+    low, high = [], []
+    for e in extents:
+        if n >= e.count:
+            low.append(e)
+        elif n <= 0:
+            high.append(e)
+        else:
+            low.append(Extent(e.segment, e.start, n))
+            high.append(Extent(e.segment, e.start + n, e.count - n))
+        n -= e.count
+    return low, high
+
+
+def _referenced_end(segment: HeaderSegment, chains: Sequence['Blockchain']) -> int:
+    """End of the part of segment that is read by any of the chains."""
+    end = 0
+    for b in chains:
+        for e in b._extents:
+            if e.segment is segment:
+                end = max(end, e.start + e.count)
+    return end
+
+
+class PowJob(NamedTuple):
+    raw_header: bytes
+    height: int
+    target: int
+
+
+def pow_hash_header(raw_header: bytes, height: int) -> bytes:
+    if height < LYRA2REV2_HEIGHT:
+        return scryptGetHash(raw_header)
+    return lyra2re2_hash.getPoWHash(raw_header)
+
+
+def verify_pow_batch(headers: Sequence[PowJob]) -> None:
+    """Checks the proof of work of many headers, e.g. a whole chunk, in one call.
+    Raises for the first header whose hash is above its target.
+    """
+    for raw_header, height, target in headers:
+        powhash = int.from_bytes(pow_hash_header(raw_header, height), byteorder='little')
+        if powhash > target:
+            raise Exception("insufficient proof of work at height %d: %s vs target %s" % (height, powhash, target))
+
+
+# below this many headers, shipping them to worker processes costs more than it saves
+MIN_POW_JOBS_FOR_PROCESS_POOL = 128
+
+_pow_executor = None  # type: Optional[ProcessPoolExecutor]
+_pow_executor_lock = threading.Lock()
+
+
+def _num_pow_workers() -> int:
+    return os.cpu_count() or 1
+
+
+def _get_pow_executor() -> Optional[ProcessPoolExecutor]:
+    global _pow_executor
+    if 'ANDROID_DATA' in os.environ:
+        return None  # no multiprocessing there
+    if sys.version_info < (3, 7):
+        return None  # no mp_context, and forking a process that runs other threads is not safe
+    with _pow_executor_lock:
+        if _pow_executor is None:
+            try:
+                # 'spawn', as forking a process that runs other threads is not safe
+                _pow_executor = ProcessPoolExecutor(max_workers=_num_pow_workers(),
+                                                    mp_context=multiprocessing.get_context('spawn'))
+            except (ImportError, NotImplementedError, OSError) as e:
+                _logger.warning(f"cannot create process pool for header verification: {repr(e)}")
+                return None
+        return _pow_executor
+
+
+def shutdown_pow_executor() -> None:
+    global _pow_executor
+    with _pow_executor_lock:
+        executor, _pow_executor = _pow_executor, None
+    if executor is not None:
+        executor.shutdown(wait=False)
+
+
+async def verify_pow_batch_in_process_pool(headers: Sequence[PowJob]) -> None:
+    """Like verify_pow_batch, but spreads the hashing over one worker process per core."""
+    executor = None
+    if len(headers) >= MIN_POW_JOBS_FOR_PROCESS_POOL:
+        executor = _get_pow_executor()
+    if executor is None:
+        verify_pow_batch(headers)
+        return
+    num_slices = min(_num_pow_workers(), len(headers) // (MIN_POW_JOBS_FOR_PROCESS_POOL // 2))
+    slice_size = -(-len(headers) // num_slices)
+    loop = asyncio.get_event_loop()
+    try:
+        await asyncio.gather(*[
+            loop.run_in_executor(executor, verify_pow_batch, headers[i:i+slice_size])
+            for i in range(0, len(headers), slice_size)])
+    except BrokenProcessPool as e:
+        # e.g. a worker got killed. the next chunk gets a new pool
+        _logger.warning(f"process pool for header verification broke: {repr(e)}")
+        _discard_pow_executor(executor)
+        verify_pow_batch(headers)
+
+
+def _discard_pow_executor(executor: ProcessPoolExecutor) -> None:
+    global _pow_executor
+    with _pow_executor_lock:
+        if _pow_executor is executor:
+            _pow_executor = None
+    executor.shutdown(wait=False)
+
+
+# set once a header saved without its proof of work turned out to be invalid.
+# from then on, chunks are fully verified again, for the rest of the session.
+_deferred_pow_failed = False
+
+
+def deferred_pow_enabled(config: 'SimpleConfig') -> bool:
+    """Whether chunks get saved before their proof of work is checked.
+    For trusted servers only: the hashing is left to DeferredPowVerifier.
+    """
+    return bool(config.get('deferred_pow_verification', False)) and not _deferred_pow_failed
+
+
 # key: blockhash hex at forkpoint
 # the chain at some key is the best chain that includes the given hash
 blockchains = {}  # type: Dict[str, Blockchain]
-blockchains_lock = threading.RLock()  # lock order: take this last; so after Blockchain.lock
+# lock order: take this last; so after Blockchain.lock.
+# when holding several Blockchain.locks, take a child's before its parent's.
+blockchains_lock = threading.RLock()
 
 
 def read_blockchains(config: 'SimpleConfig'):
@@ -108,8 +542,14 @@ def read_blockchains(config: 'SimpleConfig'):
         header_after_cp = best_chain.read_header(constants.net.max_checkpoint()+1)
         if not header_after_cp or not best_chain.can_connect(header_after_cp, check_height=False):
             _logger.info("[blockchain] deleting best chain. cannot connect header after last cp to last cp.")
-            os.unlink(best_chain.path())
-            best_chain.update_size()
+            with best_chain.lock:
+                best_chain.close_header_store()
+                os.unlink(best_chain.path())
+                best_chain.delete_index_files()
+                best_chain.update_size()
+    snapshot_path = config.get('header_snapshot')
+    if snapshot_path:
+        import_header_snapshot(best_chain, snapshot_path, config.get('header_snapshot_tip'))
     # forks
     fdir = os.path.join(util.get_headers_dir(config), 'forks')
     util.make_dir(fdir)
@@ -119,7 +559,7 @@ def read_blockchains(config: 'SimpleConfig'):
 
     def delete_chain(filename, reason):
         _logger.info(f"[blockchain] deleting chain {filename}: {reason}")
-        os.unlink(os.path.join(fdir, filename))
+        delete_chain_files(os.path.join(fdir, filename))
 
     def instantiate_chain(filename):
         __, forkpoint, prev_hash, first_hash = filename.split('_')
@@ -150,6 +590,10 @@ def read_blockchains(config: 'SimpleConfig'):
         if not b.parent.can_connect(h, check_height=False):
             delete_chain(filename, "cannot connect chain to parent")
             return
+        if b.parent.check_hash(forkpoint, first_hash):
+            # left behind by an interrupted swap
+            delete_chain(filename, "chain is already part of its parent")
+            return
         chain_id = b.get_id()
         assert first_hash == chain_id, (first_hash, chain_id)
         blockchains[chain_id] = b
@@ -158,29 +602,173 @@ def read_blockchains(config: 'SimpleConfig'):
         instantiate_chain(filename)
 
 
+def delete_chain_files(path: str) -> None:
+    """Deletes the files of a fork that is not in blockchains (any more).
+    The headers file is kept as long as other chains read from it.
+    """
+    segment = get_segment(path)
+    suffixes = INDEX_FILE_SUFFIXES
+    with blockchains_lock:
+        referenced_end = _referenced_end(segment, list(blockchains.values()))
+    if referenced_end > 0:
+        # other chains still read headers from the file
+        suffixes = ('.chainwork', '.extents')
+    else:
+        with segment.lock:
+            segment.close()
+            os.unlink(segment.path)
+        with _segments_lock:
+            _segments.pop(segment.path, None)
+    for suffix in suffixes:
+        try:
+            os.unlink(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def discard_header(height: int, header_hash: str) -> List['Blockchain']:
+    """Removes a header, and all headers after it, from every chain that
+    contains it. Forks that start at or above height are deleted.
+    Returns the chains that lost headers.
+    """
+    chains = get_chains_that_contain_header(height, header_hash)
+    # forks first, so that their parents can truncate the files they read from
+    for chain in sorted(chains, key=lambda b: b.forkpoint, reverse=True):
+        with chain.lock:
+            if chain.forkpoint >= height and chain.parent is not None:
+                _logger.info(f"[blockchain] deleting chain {chain.get_name()}: built on bad header {height}")
+                with blockchains_lock:
+                    blockchains.pop(chain.get_id(), None)
+                delete_chain_files(chain.path())
+            else:
+                chain.write(b'', (height - chain.forkpoint) * HEADER_SIZE)
+    return chains
+
+
+def import_header_snapshot(best_chain: 'Blockchain', path: str, tip_hash: Optional[str]) -> None:
+    from .header_snapshot import import_snapshot, HeaderSnapshotError
+    if not tip_hash:
+        _logger.warning("[blockchain] not importing header snapshot: 'header_snapshot_tip' is not set")
+        return
+    init_headers_file_for_best_chain()
+    try:
+        import_snapshot(best_chain, path, tip_hash)
+    except (HeaderSnapshotError, OSError) as e:
+        _logger.warning(f"[blockchain] failed to import header snapshot {path}: {e!r}")
+
+
+def needs_compaction() -> bool:
+    with blockchains_lock: chains = list(blockchains.values())
+    return any(not b._has_simple_extents() for b in chains)
+
+
+def compact_chains() -> None:
+    """Rewrites the headers files so that every chain's headers are in its
+    own file again, see Blockchain.compact. Meant to run in the background,
+    after forks swapped places with their parents.
+    """
+    with blockchains_lock: chains = list(blockchains.values())
+    # a chain can only rewrite its file once the others stopped reading from it
+    for i in range(len(chains) + 1):
+        if not any([b.compact() for b in chains]):
+            break
+
+
 def get_best_chain() -> 'Blockchain':
     return blockchains[constants.net.GENESIS]
 
-# block hash -> chain work; up to and including that block
-_CHAINWORK_CACHE = {
-    "0000000000000000000000000000000000000000000000000000000000000000": 0,  # virtual block at height -1
-}  # type: Dict[str, int]
+
+def work_from_target(target: int) -> int:
+    """Expected number of hashes to find a block at target."""
+    return 2 ** 256 // (target + 1)
 
 
 def init_headers_file_for_best_chain():
     b = get_best_chain()
     filename = b.path()
     length = HEADER_SIZE * len(constants.net.CHECKPOINTS) * 2016
-    if not os.path.exists(filename) or os.path.getsize(filename) < length:
-        with open(filename, 'wb') as f:
-            if length > 0:
-                f.seek(length - 1)
-                f.write(b'\x00')
-        util.ensure_sparse_file(filename)
     with b.lock:
+        if not os.path.exists(filename) or os.path.getsize(filename) < length:
+            b.close_header_store()
+            b.delete_index_files()
+            with open(filename, 'wb') as f:
+                if length > 0:
+                    f.seek(length - 1)
+                    f.write(b'\x00')
+            util.ensure_sparse_file(filename)
         b.update_size()
 
 
+class DGWv3Calculator:
+    """Dark Gravity Wave v3 over a sliding window of the last PAST_BLOCKS headers.
+
+    Headers are appended as they get verified or saved, so the target of the
+    next height is computed without reading any header. The window must be
+    seeded again when the chain it follows is rewritten, e.g. on a reorg.
+    Gives the same results as Blockchain.get_target_dgwv3.
+    """
+
+    PAST_BLOCKS = 24
+    TARGET_SPACING = 90  # seconds
+    # thanks watanabe!! http://askmona.org/5288#res_61
+    FIRST_HEIGHT = 450024
+
+    def __init__(self):
+        self._window = deque(maxlen=self.PAST_BLOCKS)  # (bits, timestamp); oldest first
+        self.tip_height = None  # type: Optional[int]
+
+    def reset(self) -> None:
+        self._window.clear()
+        self.tip_height = None
+
+    def seed(self, chain: 'Blockchain', height: int) -> None:
+        """Fills the window with the headers of chain just below height."""
+        self.reset()
+        batch = chain.read_header_batch(max(0, height - self.PAST_BLOCKS), min(height, self.PAST_BLOCKS))
+        bits, timestamps = batch.bits.tolist(), batch.timestamp.tolist()
+        for i in range(len(batch)):
+            if batch.is_missing(i):
+                self.reset()
+                continue
+            self.append(batch.start_height + i, bits[i], timestamps[i])
+
+    def append(self, height: int, bits: int, timestamp: int) -> None:
+        if self.tip_height is not None and height != self.tip_height + 1:
+            self.reset()
+        self._window.append((bits, timestamp))
+        self.tip_height = height
+
+    def __len__(self) -> int:
+        return len(self._window)
+
+    def is_ready(self, height: int) -> bool:
+        """Whether the window holds the PAST_BLOCKS headers just below height."""
+        return self.tip_height == height - 1 and len(self._window) == self.PAST_BLOCKS
+
+    def get_target(self, height: int) -> int:
+        # DGWv3 PastBlocksMax = 24 Because checkpoint don't have preblock data.
+        if height < len(constants.net.CHECKPOINTS)*2016 + self.PAST_BLOCKS:
+            return 0
+        if height - 1 < self.FIRST_HEIGHT:
+            return MAX_TARGET
+        if not self.is_ready(height):
+            raise MissingHeader(height - 1)
+        past_difficulty_average = 0
+        for count, (bits, timestamp) in enumerate(reversed(self._window), start=1):
+            target = Blockchain.bits_to_target(bits)
+            if count == 1:
+                past_difficulty_average = target
+            else:
+                past_difficulty_average = (past_difficulty_average * count + target) // (count + 1)
+        target_timespan = self.PAST_BLOCKS * self.TARGET_SPACING
+        actual_timespan = self._window[-1][1] - self._window[0][1]
+        actual_timespan = max(actual_timespan, target_timespan // 3)
+        actual_timespan = min(actual_timespan, target_timespan * 3)
+        # retarget
+        new_target = past_difficulty_average * actual_timespan // target_timespan
+        return min(new_target, MAX_TARGET)
+
+
 class Blockchain(Logger):
     """
     Manages blockchain headers and their verification
@@ -200,7 +788,14 @@ class Blockchain(Logger):
         self._forkpoint_hash = forkpoint_hash  # blockhash at forkpoint. "first hash"
         self._prev_hash = prev_hash  # blockhash immediately before forkpoint
         self.lock = threading.RLock()
+        self._extents = []  # type: List[Extent]  # where our headers are, from forkpoint up
+        self._extent_ends = []  # type: List[int]  # number of our headers up to the end of each extent
+        self._height_by_recent_hash = {}  # type: Dict[str, int]
+        self._dgw = DGWv3Calculator()  # follows our tip
+        self._chainwork_index = None  # type: Optional[List[int]]
+        self._chainwork_tip = None  # type: Optional[Tuple[int, int]]  # (height, chainwork)
         self.update_size()
+        self._load_recent_hashes()
 
     def with_lock(func):
         def func_wrapper(self, *args, **kwargs):
@@ -266,6 +861,10 @@ class Blockchain(Logger):
         is the given hash.
         """
         assert isinstance(header_hash, str) and len(header_hash) == 64, header_hash  # hex
+        if height >= self.forkpoint:
+            known_height = self._height_by_recent_hash.get(header_hash)
+            if known_height is not None:
+                return known_height == height
         try:
             return header_hash == self.get_hash(height)
         except Exception:
@@ -282,6 +881,8 @@ class Blockchain(Logger):
                           prev_hash=parent.get_hash(forkpoint-1))
         self.assert_headers_file_available(parent.path())
         open(self.path(), 'w+').close()
+        self.delete_index_files()
+        self.update_size()
         self.save_header(header)
         # put into global dict. note that in some cases
         # save_header might have already put it there but that's OK
@@ -300,50 +901,160 @@ class Blockchain(Logger):
 
     @with_lock
     def update_size(self) -> None:
-        p = self.path()
-        self._size = os.path.getsize(p)//HEADER_SIZE if os.path.exists(p) else 0
+        """Reloads our headers after our file was changed by someone else."""
+        self._own_segment().remap()
+        self._load_extents()
+
+    @with_lock
+    def close_header_store(self) -> None:
+        """Unmaps our headers file. Must be called before the file is
+        replaced, truncated or deleted; update_size() maps it again.
+        """
+        self._own_segment().close()
+
+    def _own_segment(self) -> HeaderSegment:
+        return get_segment(self.path())
+
+    def _extents_path(self) -> str:
+        return self.path() + '.extents'
+
+    @with_lock
+    def _set_extents(self, extents: List[Extent]) -> None:
+        self._extents = extents
+        self._extent_ends = []
+        size = 0
+        for e in extents:
+            size += e.count
+            self._extent_ends.append(size)
+        self._size = size
+
+    @with_lock
+    def _has_simple_extents(self) -> bool:
+        """Whether our headers are exactly the contents of our own file."""
+        own = self._own_segment()
+        if not self._extents:
+            return own.size() == 0
+        e = self._extents[0]
+        return len(self._extents) == 1 and e.segment is own and e.start == 0 and e.count == own.size()
+
+    @with_lock
+    def _load_extents(self) -> None:
+        """Without an '.extents' file, our headers are the contents of our own file."""
+        own = self._own_segment()
+        try:
+            with open(self._extents_path(), 'r') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            self._set_extents([Extent(own, 0, own.size())] if own.size() else [])
+            return
+        except ValueError as e:
+            self.logger.warning(f"cannot read {self._extents_path()}: {e!r}")
+            entries = []
+        headers_dir = util.get_headers_dir(self.config)
+        extents = []
+        for name, start, count in entries:
+            segment = get_segment(os.path.join(headers_dir, name))
+            if not os.path.exists(segment.path) or start + count > segment.size():
+                self.logger.warning(f"dropping headers after {len(extents)} extents: {name} is too short")
+                break
+            extents.append(Extent(segment, start, count))
+        self._set_extents(extents)
+
+    @with_lock
+    def _save_extents(self) -> None:
+        filename = self._extents_path()
+        if self._has_simple_extents():
+            try:
+                os.unlink(filename)
+            except FileNotFoundError:
+                pass
+            return
+        headers_dir = util.get_headers_dir(self.config)
+        entries = [[os.path.relpath(e.segment.path, headers_dir), e.start, e.count] for e in self._extents]
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(entries, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(filename + '.tmp', filename)
+
+    @with_lock
+    def _locate(self, delta: int) -> Tuple[HeaderSegment, int]:
+        """Returns the segment and the position in it of our header number delta."""
+        i = bisect.bisect_right(self._extent_ends, delta)
+        e = self._extents[i]
+        return e.segment, e.start + delta - (self._extent_ends[i-1] if i > 0 else 0)
 
     @classmethod
     def verify_header(cls, header: dict, prev_hash: str, target: int, expected_header_hash: str=None) -> None:
+        pow_job = cls.verify_header_without_pow(header, prev_hash, target, expected_header_hash)
+        if pow_job is not None:
+            verify_pow_batch([pow_job])
+
+    @classmethod
+    def verify_header_without_pow(cls, header: dict, prev_hash: str, target: int,
+                                  expected_header_hash: str=None) -> Optional[PowJob]:
+        """Does every check of verify_header except hashing the proof of work.
+        Returns what still has to go through verify_pow_batch, if anything.
+        """
         height = header.get('block_height')
         _hash = hash_header(header)
         if expected_header_hash and expected_header_hash != _hash:
             raise Exception("hash mismatches with expected: {} vs {}".format(expected_header_hash, _hash))
         if prev_hash != header.get('prev_block_hash'):
             raise Exception("prev hash mismatch: %s vs %s" % (prev_hash, header.get('prev_block_hash')))
-        # DGWv3 PastBlocksMax = 24 Because checkpoint don't have preblock data.
-        if height // 2016 < len(constants.net.CHECKPOINTS) and height % 2016 != 2015 or \
-                height >= len(constants.net.CHECKPOINTS)*2016 and height <= len(constants.net.CHECKPOINTS)*2016 + 24:
-            return
-        if constants.net.TESTNET:
-            return
+        if not cls.is_pow_checked(height):
+            return None
         bits = cls.target_to_bits(target)
         if bits != header.get('bits'):
             raise Exception("bits mismatch: %s vs %s" % (bits, header.get('bits')))
-        if height < 450000 :
-            _powhash = rev_hex(bh2u(scryptGetHash(bfh(serialize_header(header)))))
-        else:
-            _powhash = rev_hex(bh2u(lyra2re2_hash.getPoWHash(bfh(serialize_header(header)))))
-        if int('0x' + _powhash, 16) > target:
-            raise Exception("insufficient proof of work: %s vs target %s" % (int('0x' + _powhash, 16), target))
+        return PowJob(bfh(serialize_header(header)), height, target)
+
+    @classmethod
+    def is_pow_checked(cls, height: int) -> bool:
+        """Whether verify_header checks the bits and proof of work at height."""
+        num_checkpoints = len(constants.net.CHECKPOINTS)
+        # DGWv3 PastBlocksMax = 24 Because checkpoint don't have preblock data.
+        if height // 2016 < num_checkpoints and height % 2016 != 2015 or \
+                num_checkpoints*2016 <= height <= num_checkpoints*2016 + 24:
+            return False
+        return not constants.net.TESTNET
 
     def verify_chunk(self, index: int, data: bytes) -> None:
-        num = len(data) // HEADER_SIZE
+        pow_jobs = self.verify_chunk_without_pow(index, data)
+        verify_pow_batch(pow_jobs)
+
+    def verify_chunk_without_pow(self, index: int, data: bytes) -> List[PowJob]:
+        """First phase of chunk verification: targets and linkage, done serially.
+        Returns the proof of work hashes that still have to be checked.
+        """
         start_height = index * 2016
-        prev_hash = self.get_hash(start_height - 1)
-        headers = {}
-        for i in range(num):
+        batch = HeaderBatch(data, start_height)
+        header_hashes = batch.hashes()
+        bits, timestamps = batch.bits.tolist(), batch.timestamp.tolist()
+        prev_hash = bytes.fromhex(self.get_hash(start_height - 1))[::-1]
+        dgw = DGWv3Calculator()
+        dgw.seed(self, start_height)
+        pow_jobs = []
+        for i in range(len(batch)):
             height = start_height + i
             try:
                 expected_header_hash = self.get_hash(height)
             except MissingHeader:
                 expected_header_hash = None
-            raw_header = data[i*HEADER_SIZE : (i+1)*HEADER_SIZE]
-            header = deserialize_header(raw_header, index*2016 + i)
-            headers[header.get('block_height')] = header
-            target = self.get_target(index*2016 + i, headers)
-            self.verify_header(header, prev_hash, target, expected_header_hash)
-            prev_hash = hash_header(header)
+            if expected_header_hash and expected_header_hash != hash_encode(header_hashes[i]):
+                raise Exception("hash mismatches with expected: {} vs {}".format(
+                    expected_header_hash, hash_encode(header_hashes[i])))
+            if prev_hash != batch.prev_block_hash(i):
+                raise Exception("prev hash mismatch: %s vs %s" % (
+                    hash_encode(prev_hash), hash_encode(batch.prev_block_hash(i))))
+            target = self.get_target(height, dgw=dgw)
+            if self.is_pow_checked(height):
+                if self.target_to_bits(target) != bits[i]:
+                    raise Exception("bits mismatch: %s vs %s" % (self.target_to_bits(target), bits[i]))
+                pow_jobs.append(PowJob(batch.raw_header(i), height, target))
+            dgw.append(height, bits[i], timestamps[i])
+            prev_hash = header_hashes[i]
+        return pow_jobs
 
     @with_lock
     def path(self):
@@ -380,7 +1091,14 @@ class Blockchain(Logger):
         self.swap_with_parent()
 
     def swap_with_parent(self) -> None:
-        with self.lock, blockchains_lock:
+        with ExitStack() as stack:
+            # a swap can cascade up to the root, and changes every chain on the way.
+            # lock them all before blockchains_lock, see the lock order there
+            chain = self
+            while chain is not None:
+                stack.enter_context(chain.lock)
+                chain = chain.parent
+            stack.enter_context(blockchains_lock)
             # do the swap; possibly multiple ones
             cnt = 0
             while True:
@@ -398,45 +1116,60 @@ class Blockchain(Logger):
 
     def _swap_with_parent(self) -> bool:
         """Check if this chain became stronger than its parent, and swap
-        the underlying files if so. The Blockchain instances will keep
+        places with it if so. The Blockchain instances will keep
         'containing' the same headers, but their ids change and so
-        they will be stored in different files."""
+        they will be stored under different names.
+
+        No headers are copied: both chains just get new extents over the
+        existing files. We take over the parent's name and file, and our
+        old file is renamed to the parent's new name. compact_chains()
+        untangles the files later.
+        """
         if self.parent is None:
             return False
-        #That's why I'm going to kill you last.
-        #if self.parent.get_chainwork() >= self.get_chainwork():
-        if self.parent.height() - self.forkpoint + 1 >= self.size():
+        if self.parent.get_chainwork() >= self.get_chainwork():
             return False
         self.logger.info(f"swapping {self.forkpoint} {self.parent.forkpoint}")
-        parent_branch_size = self.parent.height() - self.forkpoint + 1
         forkpoint = self.forkpoint  # type: Optional[int]
         parent = self.parent  # type: Optional[Blockchain]
         child_old_id = self.get_id()
         parent_old_id = parent.get_id()
-        # swap files
-        # child takes parent's name
-        # parent's new name will be something new (not child's old name)
         self.assert_headers_file_available(self.path())
-        child_old_name = self.path()
-        with open(self.path(), 'rb') as f:
-            my_data = f.read()
         self.assert_headers_file_available(parent.path())
         assert forkpoint > parent.forkpoint, (f"forkpoint of parent chain ({parent.forkpoint}) "
                                               f"should be at lower height than children's ({forkpoint})")
-        with open(parent.path(), 'rb') as f:
-            f.seek((forkpoint - parent.forkpoint)*HEADER_SIZE)
-            parent_data = f.read(parent_branch_size*HEADER_SIZE)
-        self.write(parent_data, 0)
-        parent.write(my_data, (forkpoint - parent.forkpoint)*HEADER_SIZE)
-        # swap parameters
-        self.parent, parent.parent = parent.parent, self  # type: Optional[Blockchain], Optional[Blockchain]
-        self.forkpoint, parent.forkpoint = parent.forkpoint, self.forkpoint
-        self._forkpoint_hash, parent._forkpoint_hash = parent._forkpoint_hash, hash_raw_header(bh2u(parent_data[:HEADER_SIZE]))
-        self._prev_hash, parent._prev_hash = parent._prev_hash, self._prev_hash
-        # parent's new name
-        os.replace(child_old_name, parent.path())
-        self.update_size()
-        parent.update_size()
+        with parent.lock:  # already held, see swap_with_parent
+            parent_low, parent_high = split_extents(parent._extents, forkpoint - parent.forkpoint)
+            parent_first_hash = parent.get_hash(forkpoint)
+            # the chainwork index in the parent's file stays valid below our forkpoint
+            parent._truncate_chainwork(forkpoint)
+            my_extents = self._extents
+            my_old_segment = self._own_segment()
+            my_old_extents_path = self._extents_path()
+            my_old_chainwork_path = self._chainwork_index_path()
+            # swap parameters
+            self.parent, parent.parent = parent.parent, self  # type: Optional[Blockchain], Optional[Blockchain]
+            self.forkpoint, parent.forkpoint = parent.forkpoint, self.forkpoint
+            self._forkpoint_hash, parent._forkpoint_hash = parent._forkpoint_hash, parent_first_hash
+            self._prev_hash, parent._prev_hash = parent._prev_hash, self._prev_hash
+            # parent's new name. it appends to our old file from now on.
+            for filename in (parent._extents_path(), parent._chainwork_index_path()):
+                if os.path.exists(filename):
+                    os.unlink(filename)
+            my_old_segment.rename(parent.path())
+            parent._set_extents(parent_high)
+            parent._save_extents()
+            self._set_extents(parent_low + my_extents)
+            self._save_extents()
+            for filename in (my_old_extents_path, my_old_chainwork_path):
+                if os.path.exists(filename):
+                    os.unlink(filename)
+            self._chainwork_index, parent._chainwork_index = parent._chainwork_index, []
+            self._chainwork_tip = parent._chainwork_tip = None
+            self._dgw.reset()
+            parent._dgw.reset()
+            self._load_recent_hashes()
+            parent._load_recent_hashes()
         # update pointers
         blockchains.pop(child_old_id, None)
         blockchains.pop(parent_old_id, None)
@@ -457,17 +1190,129 @@ class Blockchain(Logger):
 
     @with_lock
     def write(self, data: bytes, offset: int, truncate: bool=True) -> None:
-        filename = self.path()
-        self.assert_headers_file_available(filename)
-        with open(filename, 'rb+') as f:
-            if truncate and offset != self._size * HEADER_SIZE:
-                f.seek(offset)
-                f.truncate()
-            f.seek(offset)
-            f.write(data)
-            f.flush()
-            os.fsync(f.fileno())
-        self.update_size()
+        """Writes headers at offset (in bytes, from forkpoint).
+        Headers are appended to our own file. If offset is below our tip, we
+        stop reading our old headers from there on, and the part of our file
+        that nobody reads any more gets truncated. Without truncate, headers
+        in our own file get overwritten in place instead, which is how the
+        main chain fills in the checkpoint region.
+        """
+        self.assert_headers_file_available(self.path())
+        own = self._own_segment()
+        delta = offset // HEADER_SIZE
+        if delta > self._size:
+            # leave a gap of missing headers, as seeking past the end of a file would
+            data = bytes((delta - self._size) * HEADER_SIZE) + data
+            delta = self._size
+        is_append = delta == self._size
+        first_height = self.forkpoint + delta
+        num_headers = len(data) // HEADER_SIZE
+        hashes = b''.join(self._hash_of_raw_header(data[i*HEADER_SIZE:(i+1)*HEADER_SIZE])
+                          for i in range(num_headers))
+        if not is_append and not constants.net.TESTNET:
+            # drop the stale part of the chainwork index before touching the
+            # headers, so that a crash in between cannot leave it ahead of them
+            self._truncate_chainwork(first_height)
+        if not is_append and not truncate and self._is_in_own_segment(delta, num_headers):
+            segment, pos = self._locate(delta)
+            self._forget_hashes(first_height, first_height + num_headers)
+            own.overwrite(pos, data, hashes)
+            own.sync()
+        else:
+            if not is_append:
+                self._set_extents(split_extents(self._extents, delta)[0])
+                self._save_extents()
+                self._forget_hashes(first_height)
+                with blockchains_lock:
+                    referenced_end = _referenced_end(own, list(blockchains.values()) + [self])
+                if own.size() > referenced_end:
+                    own.truncate(referenced_end)
+            if num_headers > 0:
+                pos = own.append(data, hashes)
+                # before the extents claim them
+                own.sync()
+                extents = list(self._extents)
+                last = extents[-1] if extents else None
+                if last is not None and last.segment is own and last.start + last.count == pos:
+                    extents[-1] = Extent(own, last.start, last.count + num_headers)
+                else:
+                    extents.append(Extent(own, pos, num_headers))
+                self._set_extents(extents)
+                self._save_extents()
+        self._remember_hashes(first_height, hashes)
+        if is_append:
+            for i in range(num_headers):
+                raw_header = data[i*HEADER_SIZE:(i+1)*HEADER_SIZE]
+                bits = int.from_bytes(raw_header[72:76], byteorder='little')
+                timestamp = int.from_bytes(raw_header[68:72], byteorder='little')
+                self._dgw.append(first_height + i, bits, timestamp)
+            self._extend_chainwork_tip(first_height, first_height + num_headers - 1)
+        else:
+            self._dgw.reset()
+
+    @classmethod
+    def _hash_of_raw_header(cls, raw_header: bytes) -> bytes:
+        if raw_header == bytes(HEADER_SIZE):
+            return bytes(HASH_SIZE)  # missing header
+        return sha256d(raw_header)
+
+    @with_lock
+    def _is_in_own_segment(self, delta: int, count: int) -> bool:
+        """Whether our headers delta to delta+count are contiguous in our own file."""
+        if count <= 0 or delta + count > self._size:
+            return False
+        i = bisect.bisect_right(self._extent_ends, delta)
+        return self._extents[i].segment is self._own_segment() and self._extent_ends[i] >= delta + count
+
+    @with_lock
+    def compact(self) -> bool:
+        """Moves our headers that are in other chains' files into our own
+        file. Once no other chain reads the rest of our file, it is
+        rewritten so that our headers are its exact contents again.
+        Returns whether anything changed.
+        """
+        with blockchains_lock:
+            if self._has_simple_extents():
+                return False
+            own = self._own_segment()
+            first = self._extents[0]
+            keep = first.count if first.segment is own and first.start == 0 else 0
+            tail = split_extents(self._extents, keep)[1]
+            referenced_end = _referenced_end(own, [b for b in blockchains.values() if b is not self])
+            if referenced_end > keep and all(e.segment is own for e in tail):
+                return False
+            data = b''.join(bytes(e.segment.read_headers(e.start, e.count)) for e in tail)
+            hashes = b''.join(self._hash_of_raw_header(data[i:i+HEADER_SIZE])
+                              for i in range(0, len(data), HEADER_SIZE))
+            if referenced_end <= keep:
+                # until the tail is written back, only claim the part we keep
+                self._set_extents([Extent(own, 0, keep)] if keep else [])
+                self._save_extents()
+                own.truncate(keep)
+                pos = own.append(data, hashes)
+                own.sync()
+                assert pos == keep, (pos, keep)
+                self._set_extents([Extent(own, 0, own.size())])
+            else:
+                pos = own.append(data, hashes)
+                own.sync()
+                self._set_extents(self._extents[:1] + [Extent(own, pos, len(data) // HEADER_SIZE)]
+                                  if keep else [Extent(own, pos, len(data) // HEADER_SIZE)])
+            self._save_extents()
+            return True
+
+    def _extend_chainwork_tip(self, start_height: int, end_height: int) -> None:
+        if self._chainwork_tip is None or self._chainwork_tip[0] != start_height - 1:
+            self._chainwork_tip = None
+            return
+        if constants.net.TESTNET:
+            return
+        try:
+            work = self._chainwork_tip[1] + self._sum_chainwork(start_height, end_height)
+        except MissingHeader:
+            self._chainwork_tip = None
+        else:
+            self._chainwork_tip = (end_height, work)
 
     @with_lock
     def save_header(self, header: dict) -> None:
@@ -480,22 +1325,55 @@ class Blockchain(Logger):
         self.swap_with_parent()
 
     @with_lock
-    def read_header(self, height: int) -> Optional[dict]:
+    def read_raw_header(self, height: int) -> Optional[memoryview]:
+        """Returns a zero-copy view of the serialized header at height.
+        The view must not be kept around; copy it with bytes() if needed.
+        """
         if height < 0:
             return
         if height < self.forkpoint:
-            return self.parent.read_header(height)
+            return self.parent.read_raw_header(height)
         if height > self.height():
             return
-        delta = height - self.forkpoint
-        name = self.path()
-        self.assert_headers_file_available(name)
-        with open(name, 'rb') as f:
-            f.seek(delta * HEADER_SIZE)
-            h = f.read(HEADER_SIZE)
-            if len(h) < HEADER_SIZE:
-                raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
-        if h == bytes([0])*HEADER_SIZE:
+        segment, pos = self._locate(height - self.forkpoint)
+        h = segment.read_headers(pos)
+        if len(h) < HEADER_SIZE:
+            raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
+        if h == bytes(HEADER_SIZE):
+            return None
+        return h
+
+    @with_lock
+    def read_raw_headers(self, height: int, count: int) -> bytes:
+        """Returns count serialized headers from height on, or fewer if the
+        chain ends before. Missing headers are all zeroes, see read_raw_header.
+        """
+        height = max(height, 0)
+        end_height = min(height + count, self.height() + 1)
+        if height >= end_height:
+            return b''
+        if height < self.forkpoint:
+            data = self.parent.read_raw_headers(height, min(end_height, self.forkpoint) - height)
+            return data + self.read_raw_headers(self.forkpoint, end_height - self.forkpoint)
+        parts = []
+        delta, end_delta = height - self.forkpoint, end_height - self.forkpoint
+        while delta < end_delta:
+            i = bisect.bisect_right(self._extent_ends, delta)
+            n = min(end_delta, self._extent_ends[i]) - delta
+            segment, pos = self._locate(delta)
+            parts.append(bytes(segment.read_headers(pos, n)))
+            delta += n
+        return b''.join(parts)
+
+    def read_header_batch(self, height: int, count: int) -> HeaderBatch:
+        """Like read_header, for count headers from height on, at once."""
+        height = max(height, 0)
+        return HeaderBatch(self.read_raw_headers(height, count), height)
+
+    @with_lock
+    def read_header(self, height: int) -> Optional[dict]:
+        h = self.read_raw_header(height)
+        if h is None:
             return None
         return deserialize_header(h, height)
 
@@ -532,11 +1410,74 @@ class Blockchain(Logger):
             index = height // 2016
             h, t = self.checkpoints[index]
             return h
+        elif height < self.forkpoint:
+            return self.parent.get_hash(height)
         else:
-            header = self.read_header(height)
-            if header is None:
+            raw_hash = self._read_indexed_hash(height)
+            if raw_hash is None:
                 raise MissingHeader(height)
-            return hash_header(header)
+            return hash_encode(raw_hash)
+
+    @with_lock
+    def _read_indexed_hash(self, height: int) -> Optional[bytes]:
+        """Returns the sha256d of the header at height, from the hash index.
+        Headers saved before the index existed get indexed on first use.
+        """
+        delta = height - self.forkpoint
+        if not 0 <= delta < self.size():
+            return None
+        segment, pos = self._locate(delta)
+        h = segment.read_hash(pos)
+        if h is not None:
+            return h
+        if self.read_raw_header(height) is None:
+            return None
+        self._index_chunk_hashes(height // 2016)
+        return segment.read_hash(pos)
+
+    @with_lock
+    def _index_chunk_hashes(self, index: int) -> None:
+        start_height = max(index * 2016, self.forkpoint)
+        end_height = min(index * 2016 + 2015, self.height())
+        run_segment, run_pos, hashes = None, 0, []
+        for height in range(start_height, end_height + 1):
+            segment, pos = self._locate(height - self.forkpoint)
+            if segment is not run_segment or pos != run_pos + len(hashes):
+                if hashes:
+                    run_segment.write_hashes(run_pos, b''.join(hashes))
+                run_segment, run_pos, hashes = segment, pos, []
+            raw_header = segment.read_headers(pos)
+            hashes.append(self._hash_of_raw_header(bytes(raw_header)))
+        if hashes:
+            run_segment.write_hashes(run_pos, b''.join(hashes))
+
+    @with_lock
+    def _load_recent_hashes(self) -> None:
+        self._height_by_recent_hash = {}
+        first_height = max(self.forkpoint, self.height() - NUM_RECENT_HASHES + 1)
+        hashes = []
+        for height in range(first_height, self.height() + 1):
+            segment, pos = self._locate(height - self.forkpoint)
+            hashes.append(segment.read_hash(pos) or bytes(HASH_SIZE))
+        self._remember_hashes(first_height, b''.join(hashes))
+
+    def _remember_hashes(self, first_height: int, hashes: bytes) -> None:
+        d = self._height_by_recent_hash
+        min_height = self.height() - NUM_RECENT_HASHES + 1
+        for i in range(len(hashes) // HASH_SIZE):
+            height = first_height + i
+            raw_hash = hashes[i*HASH_SIZE:(i+1)*HASH_SIZE]
+            if height < min_height or raw_hash == bytes(HASH_SIZE):
+                continue
+            d[hash_encode(raw_hash)] = height
+        if len(d) > NUM_RECENT_HASHES:
+            self._height_by_recent_hash = {h: height for h, height in d.items() if height >= min_height}
+
+    def _forget_hashes(self, first_height: int, end_height: Optional[int] = None) -> None:
+        """Drops the hashes in [first_height, end_height) from the in-memory map."""
+        self._height_by_recent_hash = {
+            h: height for h, height in self._height_by_recent_hash.items()
+            if height < first_height or (end_height is not None and height >= end_height)}
 
 
     @classmethod
@@ -624,7 +1565,10 @@ class Blockchain(Logger):
         return bnNew
 
 
-    def get_target(self, height, chain={}) -> int:
+    def get_target(self, height, chain={}, *, dgw: DGWv3Calculator = None) -> int:
+        """Target of the header at height. If dgw is given, it must be
+        positioned at height - 1 and is used instead of reading headers.
+        """
         if constants.net.TESTNET:
             return 0
         elif height // 2016 < len(constants.net.CHECKPOINTS) and height % 2016 == 2015:
@@ -636,42 +1580,170 @@ class Blockchain(Logger):
             # for using testdata(checkpoints)
             #if height == 2206543:
             #    print(Blockchain.get_target_dgwv3(self, height, chain))
+            if dgw is not None:
+                return dgw.get_target(height)
             return Blockchain.get_target_dgwv3(self, height, chain)
 
+    @with_lock
+    def get_target_of_next_header(self, height: int) -> int:
+        """Target of a header at height that would connect to this chain.
+        Connecting at the tip uses the DGW window that follows our tip.
+        """
+        if height == self.height() + 1:
+            dgw = self._dgw
+            if dgw.tip_height != height - 1:
+                dgw.seed(self, height)
+        else:
+            dgw = DGWv3Calculator()
+            dgw.seed(self, height)
+        return self.get_target(height, dgw=dgw)
+
 
-    #def chainwork_of_header_at_height(self, height: int) -> int:
-    #    """work done by single header at given height"""
-    #    chunk_idx = height // 2016 - 1
-    #    target = self.get_target(index * 2016)
-    #    work = ((2 ** 256 - target - 1) // (target + 1)) + 1
-    #    return work
+    @with_lock
+    def chainwork_of_header_at_height(self, height: int) -> int:
+        """work done by single header at given height"""
+        if height < len(self.checkpoints) * 2016:
+            # headers in the checkpoint region are usually not stored
+            h, target = self.checkpoints[height // 2016]
+        else:
+            raw_header = self.read_raw_header(height)
+            if raw_header is None:
+                raise MissingHeader(height)
+            target = self.bits_to_target(int.from_bytes(raw_header[72:76], byteorder='little'))
+        return work_from_target(target)
+
+    def _sum_chainwork(self, start_height: int, end_height: int) -> int:
+        """Work of the headers from start_height to end_height (inclusive)."""
+        total = 0
+        height = start_height
+        while height <= end_height and height < len(self.checkpoints) * 2016:
+            chunk_end = min(end_height, height // 2016 * 2016 + 2015)
+            total += (chunk_end - height + 1) * self.chainwork_of_header_at_height(height)
+            height = chunk_end + 1
+        if height > end_height:
+            return total
+        batch = self.read_header_batch(height, end_height - height + 1)
+        for i in range(len(batch)):
+            if batch.is_missing(i):
+                raise MissingHeader(height + i)
+        if height + len(batch) <= end_height:
+            raise MissingHeader(height + len(batch))
+        for bits in batch.bits.tolist():
+            total += work_from_target(self.bits_to_target(bits))
+        return total
+
+    def _chainwork_index_path(self) -> str:
+        return self.path() + '.chainwork'
 
-    #@with_lock
-    #def get_chainwork(self, height=None) -> int:
-    #    if height is None:
-    #        height = max(0, self.height())
-    #    if constants.net.TESTNET:
+    @with_lock
+    def _get_chainwork_index(self) -> List[int]:
+        """Cumulative chainwork at the end of each complete chunk, starting with
+        the chunk that contains our forkpoint. Persisted next to the headers file.
+        """
+        if self._chainwork_index is None:
+            index = []
+            try:
+                with open(self._chainwork_index_path(), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                data = b''
+            num_chunks = (self.height() + 1) // 2016 - self.forkpoint // 2016
+            for i in range(min(len(data) // 32, max(0, num_chunks))):
+                index.append(int.from_bytes(data[i*32:(i+1)*32], byteorder='big'))
+            self._chainwork_index = index
+        return self._chainwork_index
+
+    @with_lock
+    def _save_chainwork_index(self) -> None:
+        index = self._get_chainwork_index()
+        data = b''.join(work.to_bytes(32, byteorder='big') for work in index)
+        filename = self._chainwork_index_path()
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(filename + '.tmp', filename)
+
+    @with_lock
+    def _truncate_chainwork(self, height: int) -> None:
+        """Forgets cached chainwork that depends on headers at height or above."""
+        # in the checkpoint region, chainwork does not depend on the headers
+        height = max(height, len(self.checkpoints) * 2016)
+        if self._chainwork_tip is not None and self._chainwork_tip[0] >= height:
+            self._chainwork_tip = None
+        index = self._get_chainwork_index()
+        keep = max(0, height // 2016 - self.forkpoint // 2016)
+        if len(index) > keep:
+            del index[keep:]
+            self._save_chainwork_index()
+
+    @with_lock
+    def delete_chainwork_index(self) -> None:
+        self._chainwork_index = []
+        self._chainwork_tip = None
+        try:
+            os.unlink(self._chainwork_index_path())
+        except FileNotFoundError:
+            pass
+
+    @with_lock
+    def delete_index_files(self) -> None:
+        """Removes the files next to our headers file, e.g. when the headers
+        file itself is deleted or rewritten.
+        """
+        self.delete_chainwork_index()
+        self._own_segment().delete_hashes()
+        self._height_by_recent_hash = {}
+        try:
+            os.unlink(self._extents_path())
+        except FileNotFoundError:
+            pass
+
+    @with_lock
+    def _get_chainwork_at_chunk_end(self, chunk_idx: int) -> int:
+        index = self._get_chainwork_index()
+        first_chunk = self.forkpoint // 2016
+        if len(index) <= chunk_idx - first_chunk:
+            while len(index) <= chunk_idx - first_chunk:
+                k = first_chunk + len(index)
+                if index:
+                    work, start_height = index[-1], k * 2016
+                else:
+                    work, start_height = self._get_chainwork_below_forkpoint(), self.forkpoint
+                index.append(work + self._sum_chainwork(start_height, k * 2016 + 2015))
+            self._save_chainwork_index()
+        return index[chunk_idx - first_chunk]
+
+    def _get_chainwork_below_forkpoint(self) -> int:
+        if self.parent is None:
+            return 0
+        return self.parent.get_chainwork(self.forkpoint - 1)
+
+    @with_lock
+    def get_chainwork(self, height=None) -> int:
+        if height is None:
+            height = max(0, self.height())
+        if constants.net.TESTNET:
             # On testnet/regtest, difficulty works somewhat different.
             # It's out of scope to properly implement that.
-    #        return height
-    #    last_retarget = height // 2016 * 2016 - 1
-    #    cached_height = last_retarget
-    #    while _CHAINWORK_CACHE.get(self.get_hash(cached_height)) is None:
-    #        if cached_height <= -1:
-    #            break
-    #        cached_height -= 2016
-    #    assert cached_height >= -1, cached_height
-    #    running_total = _CHAINWORK_CACHE[self.get_hash(cached_height)]
-    #    while cached_height < last_retarget:
-    #        cached_height += 2016
-    #        work_in_single_header = self.chainwork_of_header_at_height(cached_height)
-    #        work_in_chunk = 2016 * work_in_single_header
-    #        running_total += work_in_chunk
-    #        _CHAINWORK_CACHE[self.get_hash(cached_height)] = running_total
-    #    cached_height += 2016
-    #    work_in_single_header = self.chainwork_of_header_at_height(cached_height)
-    #    work_in_last_partial_chunk = (height % 2016 + 1) * work_in_single_header
-    #    return running_total + work_in_last_partial_chunk
+            return height
+        if height < self.forkpoint:
+            return self.parent.get_chainwork(height)
+        if height > self.height():
+            raise MissingHeader(height)
+        if self._chainwork_tip is not None and self._chainwork_tip[0] == height:
+            return self._chainwork_tip[1]
+        last_chunk = (height + 1) // 2016 - 1  # last complete chunk up to height
+        if (last_chunk + 1) * 2016 - 1 >= self.forkpoint:
+            work = self._get_chainwork_at_chunk_end(last_chunk)
+            start_height = (last_chunk + 1) * 2016
+        else:
+            work = self._get_chainwork_below_forkpoint()
+            start_height = self.forkpoint
+        work += self._sum_chainwork(start_height, height)
+        if height == self.height():
+            self._chainwork_tip = (height, work)
+        return work
 
     def can_connect(self, header: dict, check_height: bool=True) -> bool:
         if header is None:
@@ -687,10 +1759,8 @@ class Blockchain(Logger):
             return False
         if prev_hash != header.get('prev_block_hash'):
             return False
-        headers = {}
-        headers[header.get('block_height')] = header
         try:
-            target = self.get_target(height, headers)
+            target = self.get_target_of_next_header(height)
         except MissingHeader:
             return False
         try:
@@ -703,9 +1773,33 @@ class Blockchain(Logger):
         assert idx >= 0, idx
         try:
             data = bfh(hexdata)
-            self.verify_chunk(idx, data)
+            pow_jobs = self.verify_chunk_without_pow(idx, data)
+            if not deferred_pow_enabled(self.config):
+                verify_pow_batch(pow_jobs)
+            self.save_chunk(idx, data)
+            return True
+        except BaseException as e:
+            self.logger.info(f'verify_chunk idx {idx} failed: {repr(e)}')
+            return False
+
+    async def connect_chunk_async(self, idx: int, hexdata: str) -> bool:
+        """Like connect_chunk, but does the proof of work hashing in worker processes."""
+        assert idx >= 0, idx
+        try:
+            data = bfh(hexdata)
+            prev_hash = self.get_hash(idx * 2016 - 1)
+            pow_jobs = self.verify_chunk_without_pow(idx, data)
+            if not deferred_pow_enabled(self.config):
+                await verify_pow_batch_in_process_pool(pow_jobs)
+            # the chain may have changed while we were waiting for the hashing,
+            # e.g. been swapped with a fork or truncated
+            if not self.check_hash(idx * 2016 - 1, prev_hash):
+                self.logger.info(f'verify_chunk idx {idx} failed: chain changed meanwhile')
+                return False
             self.save_chunk(idx, data)
             return True
+        except asyncio.CancelledError:
+            raise
         except BaseException as e:
             self.logger.info(f'verify_chunk idx {idx} failed: {repr(e)}')
             return False
@@ -755,3 +1849,85 @@ def get_chains_that_contain_header(height: int, header_hash: str) -> Sequence[Bl
               if chain.check_hash(height=height, header_hash=header_hash)]
     chains = sorted(chains, key=lambda x: x.get_chainwork(), reverse=True)
     return chains
+
+
+class DeferredPowVerifier:
+    """Checks the proof of work of the headers that were saved without it,
+    see deferred_pow_enabled. Walks the best chain forward a chunk at a time,
+    and persists how far it got as the (height, hash) of the last verified
+    header, so that the progress survives restarts and reorgs.
+    """
+
+    def __init__(self, config: 'SimpleConfig'):
+        self.config = config
+        if deferred_pow_enabled(config) and config.get('pow_verified_tip') is None:
+            # headers saved before deferring was turned on were fully verified
+            chain = get_best_chain()
+            if chain.height() > constants.net.max_checkpoint():
+                self._set_watermark(chain.height(), chain.get_hash(chain.height()))
+
+    def is_active(self) -> bool:
+        return deferred_pow_enabled(self.config) or self.config.get('pow_verified_tip') is not None
+
+    def _set_watermark(self, height: Optional[int], header_hash: str = None) -> None:
+        value = [height, header_hash] if height is not None else None
+        self.config.set_key('pow_verified_tip', value, True)
+
+    def get_verified_height(self, chain: Blockchain = None) -> int:
+        """Height up to which the headers of chain have had their proof of work checked."""
+        if chain is None:
+            chain = get_best_chain()
+        height = constants.net.max_checkpoint()
+        watermark = self.config.get('pow_verified_tip')
+        if watermark:
+            verified_height, verified_hash = watermark
+            if chain.check_hash(verified_height, verified_hash):
+                height = max(height, verified_height)
+            else:
+                # only what chain shares with the verified headers counts
+                for other in get_chains_that_contain_header(verified_height, verified_hash):
+                    common_height = chain.get_height_of_last_common_block_with_chain(other)
+                    height = max(height, min(verified_height, common_height))
+        return min(height, chain.height())
+
+    def has_work(self) -> bool:
+        return self.is_active() and self.get_verified_height() < get_best_chain().height()
+
+    def verify_next_chunk(self) -> List[Blockchain]:
+        """Checks the proof of work of the headers after the watermark, up to
+        the end of their chunk. On failure, the bad header and everything
+        built on it gets discarded; the chains that lost headers are returned.
+        """
+        global _deferred_pow_failed
+        chain = get_best_chain()
+        # get_verified_height looks at other chains. it must not run under
+        # chain.lock, see the lock order at blockchains_lock
+        start_height = self.get_verified_height(chain) + 1
+        with chain.lock:
+            end_height = min(chain.height(), (start_height // 2016 + 1) * 2016 - 1)
+            if start_height > end_height:
+                if not deferred_pow_enabled(self.config):
+                    self._set_watermark(None)  # caught up
+                return []
+            prev_hash = chain.get_hash(start_height - 1)
+            batch = chain.read_header_batch(start_height, end_height - start_height + 1)
+            end_hash = chain.get_hash(end_height)
+        if (self.get_verified_height(chain) + 1 != start_height
+                or not chain.check_hash(start_height - 1, prev_hash)):
+            return []  # the chain changed meanwhile; try again later
+        pow_jobs = []
+        # bits were checked against the DGWv3 target when the headers were saved
+        for i, bits in enumerate(batch.bits.tolist()):
+            height = start_height + i
+            if Blockchain.is_pow_checked(height):
+                pow_jobs.append(PowJob(batch.raw_header(i), height, Blockchain.bits_to_target(bits)))
+        # the slow part; without holding the lock
+        for raw_header, height, target in pow_jobs:
+            powhash = int.from_bytes(pow_hash_header(raw_header, height), byteorder='little')
+            if powhash > target:
+                _deferred_pow_failed = True
+                _logger.warning(f"header at height {height} has insufficient proof of work. "
+                                f"discarding it and all headers built on it.")
+                return discard_header(height, hash_encode(sha256d(raw_header)))
+        self._set_watermark(end_height, end_hash)
+        return []
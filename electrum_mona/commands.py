@@ -38,6 +38,8 @@ from itertools import repeat
 from decimal import Decimal
 from typing import Optional, TYPE_CHECKING, Dict, List
 
+from aiorpcx import run_in_thread
+
 from .import util, ecc
 from .util import (bfh, bh2u, format_satoshis, json_decode, json_normalize,
                    is_hash256_str, is_hex_str, to_bytes)
@@ -61,6 +63,7 @@ from .version import ELECTRUM_VERSION
 from .simple_config import SimpleConfig
 from .invoices import LNInvoice
 from . import submarine_swaps
+from . import sqlite_wallet_db
 
 
 if TYPE_CHECKING:
@@ -205,6 +208,8 @@ class Commands:
             'default_wallet': self.config.get_wallet_path(),
             'fee_per_kb': self.config.fee_per_kb(),
         }
+        if self.network.pow_verifier.is_active():
+            response['pow_verified_height'] = self.network.pow_verifier.get_verified_height()
         return response
 
     @command('n')
@@ -269,6 +274,43 @@ class Commands:
             'msg': d['msg'],
         }
 
+    @command('')
+    async def convert_to_sqlite(self, password=None, wallet_path=None):
+        """Convert a wallet file to SQLite, with which large wallets load faster
+        and use less memory. The wallet must not be open. The original file is
+        kept, with '.json_backup' appended to its name.
+        """
+        if self.daemon and self.daemon.get_wallet(wallet_path):
+            raise Exception("Close the wallet first.")
+        backup_path = sqlite_wallet_db.convert_to_sqlite(wallet_path, password=password)
+        return {
+            'path': wallet_path,
+            'backup_path': backup_path,
+        }
+
+    @command('')
+    async def convert_to_json(self, password=None, wallet_path=None):
+        """Convert an SQLite wallet file back to json, e.g. to upgrade it, or
+        to open it with an older version. The wallet must not be open. The
+        original file is kept, with '.sqlite_backup' appended to its name.
+        """
+        if self.daemon and self.daemon.get_wallet(wallet_path):
+            raise Exception("Close the wallet first.")
+        backup_path = sqlite_wallet_db.convert_to_json(wallet_path, password=password)
+        return {
+            'path': wallet_path,
+            'backup_path': backup_path,
+        }
+
+    @command('wp')
+    async def enable_journal(self, password=None, wallet: Abstract_Wallet = None):
+        """Save changes by appending them to the wallet file, instead of
+        rewriting it, which is faster with large wallets. This cannot be
+        undone, and older versions of Electrum cannot open the file afterwards.
+        """
+        wallet.enable_file_journal(password)
+        return True
+
     @command('wp')
     async def password(self, password=None, new_password=None, wallet: Abstract_Wallet = None):
         """Change wallet password. """
@@ -408,11 +450,16 @@ class Commands:
         return tx.to_json()
 
     @command('n')
-    async def broadcast(self, tx):
-        """Broadcast a transaction to the network. """
+    async def broadcast(self, tx, num_servers=None):
+        """Broadcast a transaction to the network.
+        With num_servers, the transaction is sent to that many servers concurrently,
+        and the outcome for each server is returned along with the txid. """
         tx = Transaction(tx)
-        await self.network.broadcast_transaction(tx)
-        return tx.txid()
+        if num_servers is None:
+            await self.network.broadcast_transaction(tx)
+            return tx.txid()
+        outcomes = await self.network.broadcast_transaction_to_servers(tx, num_servers=num_servers)
+        return {'txid': tx.txid(), 'servers': outcomes}
 
     @command('')
     async def createmultisig(self, num, pubkeys):
@@ -517,6 +564,42 @@ class Commands:
         """Return the list of known servers (candidates for connecting)."""
         return self.network.get_servers()
 
+    @command('n')
+    async def getservertimeouts(self):
+        """Return the RTT estimates and the request timeouts derived from them,
+        for each connected server and RPC method."""
+        return self.network.get_server_timeouts()
+
+    @command('n')
+    async def getrpcstats(self):
+        """Return, for each connected server and RPC method, the number of requests,
+        errors and requests in flight, the approximate bytes sent and received,
+        and a histogram of the latencies (in seconds). Also returns how many
+        requests of network jobs the scheduler lets each server have in flight."""
+        return self.network.get_rpc_stats()
+
+    @command('n')
+    async def dumprpcstats(self, path):
+        """Write the output of getrpcstats to a JSON file."""
+        await run_in_thread(partial(self.network.dump_rpc_stats, path))
+        return path
+
+    @command('n')
+    async def export_header_snapshot(self, path, to_height=None):
+        """Export the headers of the best chain after the last checkpoint to a
+        snapshot file. Other nodes import it at startup when the 'header_snapshot'
+        config variable points to it and 'header_snapshot_tip' is set to the
+        returned tip hash.
+        """
+        from .header_snapshot import export_snapshot
+        info = await run_in_thread(partial(export_snapshot, self.network.blockchain(), path, to_height=to_height))
+        return {
+            'path': path,
+            'first_height': info.first_height,
+            'tip_height': info.tip_height,
+            'tip_hash': info.tip_hash,
+        }
+
     @command('')
     async def version(self):
         """Return the version of Electrum."""
@@ -1218,6 +1301,7 @@ command_options = {
     'expiration':  (None, "Time in seconds"),
     'attempts':    (None, "Number of payment attempts"),
     'timeout':     (None, "Timeout in seconds"),
+    'num_servers': (None, "Number of servers to send the transaction to concurrently"),
     'force':       (None, "Create new address beyond gap limit, if no more addresses are available."),
     'pending':     (None, "Show only pending requests."),
     'push_amount': (None, 'Push initial amount (in MONA)'),
@@ -1261,6 +1345,7 @@ arg_types = {
     'rbf': eval_bool,
     'timeout': float,
     'attempts': int,
+    'num_servers': int,
 }
 
 config_variables = {
@@ -11,7 +11,7 @@ from kivy.clock import Clock
 from electrum_mona.util import InvalidPassword
 from electrum_mona.wallet import WalletStorage, Wallet
 from electrum_mona.gui.kivy.i18n import _
-from electrum_mona.wallet_db import WalletDB
+from electrum_mona.wallet_db import load_wallet_db
 
 from .wallets import WalletDialog
 
@@ -359,7 +359,7 @@ class OpenWalletDialog(PasswordDialog):
         else:
             # it is a bit wasteful load the wallet here and load it again in main_window,
             # but that is fine, because we are progressively enforcing storage encryption.
-            db = WalletDB(self.storage.read(), manual_upgrades=False)
+            db = load_wallet_db(self.storage, manual_upgrades=False)
             wallet = Wallet(db, self.storage, config=self.app.electrum_config)
             self.require_password = wallet.has_password()
             self.pw_check = wallet.check_password
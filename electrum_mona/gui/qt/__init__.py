@@ -48,7 +48,7 @@ from electrum_mona.base_wizard import GoBack
 from electrum_mona.util import (UserCancelled, profiler,
                            WalletFileException, BitcoinException, get_new_wallet_name)
 from electrum_mona.wallet import Wallet, Abstract_Wallet
-from electrum_mona.wallet_db import WalletDB
+from electrum_mona.wallet_db import load_wallet_db
 from electrum_mona.logging import Logger
 
 from .installwizard import InstallWizard, WalletAlreadyOpenInMemory
@@ -314,7 +314,7 @@ class ElectrumGui(Logger):
                 wizard.run('new')
                 storage, db = wizard.create_storage(path)
             else:
-                db = WalletDB(storage.read(), manual_upgrades=False)
+                db = load_wallet_db(storage, manual_upgrades=False)
                 wizard.run_upgrades(storage, db)
         except (UserCancelled, GoBack):
             return
@@ -3,7 +3,6 @@
 # file LICENCE or http://www.opensource.org/licenses/mit-license.php
 
 import os
-import json
 import sys
 import threading
 import traceback
@@ -18,6 +17,7 @@ from PyQt5.QtWidgets import (QWidget, QDialog, QLabel, QHBoxLayout, QMessageBox,
 
 from electrum_mona.wallet import Wallet, Abstract_Wallet
 from electrum_mona.storage import WalletStorage, StorageReadWriteError
+from electrum_mona.json_db import load_json_with_journal
 from electrum_mona.util import UserCancelled, InvalidPassword, WalletFileException, get_new_wallet_name
 from electrum_mona.base_wizard import BaseWizard, HWD_SETUP_DECRYPT_WALLET, GoBack, ReRunDialog
 from electrum_mona.network import Network
@@ -388,7 +388,7 @@ class InstallWizard(QDialog, MessageBoxMixin, BaseWizard):
                     self.show_warning(_('The file was removed'))
                 return
             self.show()
-            self.data = json.loads(storage.read())
+            self.data, _ = load_json_with_journal(storage.read())
             self.run(action)
             for k, v in self.data.items():
                 db.put(k, v)
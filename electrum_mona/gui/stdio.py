@@ -5,7 +5,7 @@ import logging
 
 from electrum_mona import util
 from electrum_mona import WalletStorage, Wallet
-from electrum_mona.wallet_db import WalletDB
+from electrum_mona.wallet_db import load_wallet_db
 from electrum_mona.util import format_satoshis
 from electrum_mona.bitcoin import is_address, COIN
 from electrum_mona.transaction import PartialTxOutput
@@ -31,7 +31,7 @@ class ElectrumGui:
             password = getpass.getpass('Password:', stream=None)
             storage.decrypt(password)
 
-        db = WalletDB(storage.read(), manual_upgrades=False)
+        db = load_wallet_db(storage, manual_upgrades=False)
 
         self.done = 0
         self.last_balance = ""
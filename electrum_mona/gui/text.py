@@ -14,7 +14,7 @@ from electrum_mona.util import format_satoshis
 from electrum_mona.bitcoin import is_address, COIN
 from electrum_mona.transaction import PartialTxOutput
 from electrum_mona.wallet import Wallet
-from electrum_mona.wallet_db import WalletDB
+from electrum_mona.wallet_db import load_wallet_db
 from electrum_mona.storage import WalletStorage
 from electrum_mona.network import NetworkParameters, TxBroadcastError, BestEffortRequestFailed
 from electrum_mona.interface import ServerAddr
@@ -42,7 +42,7 @@ class ElectrumGui:
         if storage.is_encrypted():
             password = getpass.getpass('Password:', stream=None)
             storage.decrypt(password)
-        db = WalletDB(storage.read(), manual_upgrades=False)
+        db = load_wallet_db(storage, manual_upgrades=False)
         self.wallet = Wallet(db, storage, config=config)
         self.wallet.start_network(self.network)
         self.contacts = self.wallet.contacts
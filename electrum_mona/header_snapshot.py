@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2018 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Header snapshots let a fresh datadir skip downloading the headers after the
+# last checkpoint. A snapshot holds the raw headers of the best chain, starting
+# right after the last checkpoint, in zlib-compressed chunks.
+#
+# file layout (integers are little-endian):
+#   magic (8) | version (1) | genesis hash (32) | first height (4) | count (4) |
+#   headers per chunk (4) | tip hash (32) |
+#   for each chunk: compressed length (4) | zlib(raw headers) |
+#   sha256 of everything above (32)
+#
+# Proof of work is not checked on import. Instead, the headers must link up by
+# hash from the last checkpoint to a tip hash that the user configured.
+# The DGWv3 window needed to continue is just the last headers of the chain,
+# so it comes with the snapshot for free.
+
+import os
+import struct
+import zlib
+import hashlib
+from typing import Iterator, NamedTuple
+
+from . import constants
+from .bitcoin import hash_encode
+from .crypto import sha256d
+from .logging import get_logger
+from .blockchain import Blockchain, HEADER_SIZE
+
+
+_logger = get_logger(__name__)
+
+SNAPSHOT_MAGIC = b'ELMHSNAP'
+SNAPSHOT_VERSION = 1
+HEADERS_PER_CHUNK = 2016
+
+_FILE_HEADER = struct.Struct('<8sB32sIII32s')
+_CHUNK_LEN = struct.Struct('<I')
+_DIGEST_SIZE = 32
+
+
+class HeaderSnapshotError(Exception): pass
+
+
+class SnapshotInfo(NamedTuple):
+    first_height: int
+    count: int
+    headers_per_chunk: int
+    tip_hash: str
+
+    @property
+    def tip_height(self) -> int:
+        return self.first_height + self.count - 1
+
+
+def _hash_to_bytes(h: str) -> bytes:
+    return bytes.fromhex(h)[::-1]
+
+
+def export_snapshot(chain: Blockchain, path: str, *, to_height: int = None) -> SnapshotInfo:
+    """Writes the headers of chain after the last checkpoint up to to_height
+    (default: the tip) to a snapshot file at path.
+    """
+    first_height = constants.net.max_checkpoint() + 1
+    if to_height is None:
+        to_height = chain.height()
+    if not first_height <= to_height <= chain.height():
+        raise HeaderSnapshotError(f"cannot export headers {first_height} to {to_height}: "
+                                  f"local chain is at height {chain.height()}")
+    info = SnapshotInfo(first_height=first_height,
+                        count=to_height - first_height + 1,
+                        headers_per_chunk=HEADERS_PER_CHUNK,
+                        tip_hash=chain.get_hash(to_height))
+    digest = hashlib.sha256()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        def write(data: bytes):
+            digest.update(data)
+            f.write(data)
+        write(_FILE_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, _hash_to_bytes(constants.net.GENESIS),
+                                info.first_height, info.count, info.headers_per_chunk,
+                                _hash_to_bytes(info.tip_hash)))
+        for start in range(first_height, to_height + 1, HEADERS_PER_CHUNK):
+            end = min(start + HEADERS_PER_CHUNK, to_height + 1)
+            raw_headers = []
+            for height in range(start, end):
+                raw_header = chain.read_raw_header(height)
+                if raw_header is None:
+                    raise HeaderSnapshotError(f"missing header at height {height}")
+                raw_headers.append(bytes(raw_header))
+            compressed = zlib.compress(b''.join(raw_headers))
+            write(_CHUNK_LEN.pack(len(compressed)))
+            write(compressed)
+        f.write(digest.digest())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return info
+
+
+def read_snapshot_info(path: str) -> SnapshotInfo:
+    with open(path, 'rb') as f:
+        data = f.read(_FILE_HEADER.size)
+    if len(data) < _FILE_HEADER.size:
+        raise HeaderSnapshotError("snapshot file is truncated")
+    magic, version, genesis, first_height, count, headers_per_chunk, tip_hash = _FILE_HEADER.unpack(data)
+    if magic != SNAPSHOT_MAGIC:
+        raise HeaderSnapshotError("not a header snapshot file")
+    if version != SNAPSHOT_VERSION:
+        raise HeaderSnapshotError(f"unsupported snapshot version: {version}")
+    if hash_encode(genesis) != constants.net.GENESIS:
+        raise HeaderSnapshotError("snapshot is for a different network")
+    if count == 0 or headers_per_chunk == 0:
+        raise HeaderSnapshotError("snapshot is empty")
+    return SnapshotInfo(first_height=first_height,
+                        count=count,
+                        headers_per_chunk=headers_per_chunk,
+                        tip_hash=hash_encode(tip_hash))
+
+
+def iter_snapshot_chunks(path: str, info: SnapshotInfo) -> Iterator[bytes]:
+    """Yields the raw headers of the snapshot, a chunk at a time.
+    The file digest is only known to be good once the iterator is exhausted.
+    """
+    digest = hashlib.sha256()
+    num_headers = 0
+    with open(path, 'rb') as f:
+        def read(n: int) -> bytes:
+            data = f.read(n)
+            if len(data) != n:
+                raise HeaderSnapshotError("snapshot file is truncated")
+            digest.update(data)
+            return data
+        read(_FILE_HEADER.size)
+        while num_headers < info.count:
+            compressed_len, = _CHUNK_LEN.unpack(read(_CHUNK_LEN.size))
+            try:
+                chunk = zlib.decompress(read(compressed_len))
+            except zlib.error as e:
+                raise HeaderSnapshotError(f"corrupt chunk: {e!r}") from e
+            expected_len = min(info.headers_per_chunk, info.count - num_headers) * HEADER_SIZE
+            if len(chunk) != expected_len:
+                raise HeaderSnapshotError(f"unexpected chunk length: {len(chunk)} != {expected_len}")
+            num_headers += len(chunk) // HEADER_SIZE
+            yield chunk
+        if f.read(_DIGEST_SIZE) != digest.digest() or f.read(1):
+            raise HeaderSnapshotError("snapshot digest mismatch")
+
+
+def verify_snapshot(path: str, info: SnapshotInfo, prev_hash: str, tip_hash: str) -> None:
+    """Checks the file digest, and that the headers link up from prev_hash
+    (the block before the first header) to tip_hash.
+    """
+    if info.tip_hash != tip_hash:
+        raise HeaderSnapshotError(f"snapshot tip {info.tip_hash} is not the expected {tip_hash}")
+    prev = _hash_to_bytes(prev_hash)
+    height = info.first_height
+    for chunk in iter_snapshot_chunks(path, info):
+        for i in range(0, len(chunk), HEADER_SIZE):
+            raw_header = chunk[i:i+HEADER_SIZE]
+            if raw_header[4:36] != prev:
+                raise HeaderSnapshotError(f"header at height {height} does not link up with the previous one")
+            prev = sha256d(raw_header)
+            height += 1
+    if hash_encode(prev) != tip_hash:
+        raise HeaderSnapshotError("last header of the snapshot does not match its tip hash")
+
+
+def import_snapshot(chain: Blockchain, path: str, tip_hash: str) -> bool:
+    """Appends the headers of the snapshot to chain, after checking them
+    with verify_snapshot. Returns whether any headers were added.
+    """
+    info = read_snapshot_info(path)
+    local_height = chain.height()
+    if local_height >= info.tip_height:
+        return False
+    if local_height < info.first_height - 1:
+        raise HeaderSnapshotError(f"snapshot starts at {info.first_height}, "
+                                  f"but local headers end at {local_height}")
+    verify_snapshot(path, info, chain.get_hash(info.first_height - 1), tip_hash)
+    height = info.first_height
+    for chunk in iter_snapshot_chunks(path, info):
+        end_height = height + len(chunk) // HEADER_SIZE - 1
+        if height <= local_height <= end_height:
+            # the snapshot must agree with the headers we already have
+            i = local_height - height
+            if hash_encode(sha256d(chunk[i*HEADER_SIZE:(i+1)*HEADER_SIZE])) != chain.get_hash(local_height):
+                raise HeaderSnapshotError(f"snapshot conflicts with local header at height {local_height}")
+        if end_height > local_height:
+            skip = max(0, local_height + 1 - height)
+            chain.write(chunk[skip*HEADER_SIZE:], (height + skip - chain.forkpoint) * HEADER_SIZE)
+        height = end_height + 1
+    _logger.info(f"imported header snapshot up to height {info.tip_height}")
+    return True
@@ -29,12 +29,14 @@ import sys
 import traceback
 import asyncio
 import socket
-from typing import Tuple, Union, List, TYPE_CHECKING, Optional, Set, NamedTuple, Any, Sequence
-from collections import defaultdict
+import time
+from typing import Tuple, Union, List, TYPE_CHECKING, Optional, Set, NamedTuple, Any, Sequence, Dict
+from collections import defaultdict, OrderedDict
 from ipaddress import IPv4Network, IPv6Network, ip_address, IPv6Address, IPv4Address
 import itertools
 import logging
 import hashlib
+import json
 
 import aiorpcx
 from aiorpcx import TaskGroup
@@ -58,6 +60,7 @@ from . import constants
 from .i18n import _
 from .logging import Logger
 from .transaction import Transaction
+from .request_scheduler import JobPriority
 
 if TYPE_CHECKING:
     from .network import Network
@@ -69,6 +72,17 @@ ca_path = certifi.where()
 BUCKET_NAME_OF_ONION_SERVERS = 'onion'
 
 MAX_INCOMING_MSG_SIZE = 1_000_000  # in bytes
+MAX_BATCH_SIZE = 100  # requests per JSON-RPC batch, see NotificationSession.send_batched_request
+MAX_CACHED_RESULTS = 1000  # see NotificationSession.send_coalesced_request
+
+# Methods whose identical concurrent requests share one response,
+# and for how many seconds the result may be reused afterwards.
+COALESCED_RPC_METHODS = {
+    'blockchain.transaction.get': 10,
+    'blockchain.transaction.get_merkle': 10,
+    'blockchain.transaction.id_from_pos': 10,
+    'blockchain.scripthash.get_history': 0,  # changes with the status; only shared while in flight
+}
 
 _KNOWN_NETWORK_PROTOCOLS = {'t', 's'}
 PREFERRED_NETWORK_PROTOCOL = 's'
@@ -81,11 +95,142 @@ class NetworkTimeout:
         NORMAL = 30
         RELAXED = 45
         MOST_RELAXED = 600
+        MIN_ADAPTIVE = 5  # lower bound of the timeouts derived from RTT estimates
 
     class Urgent(Generic):
         NORMAL = 10
         RELAXED = 20
         MOST_RELAXED = 60
+        MIN_ADAPTIVE = 2
+
+
+class RttEstimator:
+    """Smoothed RTT and RTT variance of the requests of an RPC method to a server,
+    from which a timeout is derived like the TCP retransmission timeout (RFC 6298).
+    """
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+    MIN_SAMPLES = 5  # before that, the fixed NetworkTimeout values are used
+    MAX_BACKOFF = 8
+
+    def __init__(self):
+        self.srtt = None  # type: Optional[float]
+        self.rttvar = None  # type: Optional[float]
+        self.num_samples = 0
+        self.backoff = 1
+
+    def add_sample(self, rtt: float) -> None:
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.num_samples += 1
+        self.backoff = 1
+
+    def on_timeout(self) -> None:
+        self.backoff = min(2 * self.backoff, self.MAX_BACKOFF)
+
+    def get_timeout(self, request_type=NetworkTimeout.Generic) -> Optional[float]:
+        if self.num_samples < self.MIN_SAMPLES:
+            return None
+        rto = (self.srtt + self.K * self.rttvar) * self.backoff
+        return min(max(rto, request_type.MIN_ADAPTIVE), request_type.MOST_RELAXED)
+
+    def to_json(self) -> dict:
+        return {
+            'srtt': self.srtt,
+            'rttvar': self.rttvar,
+            'num_samples': self.num_samples,
+            'timeout': self.get_timeout(),
+        }
+
+
+# upper bounds of the buckets of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+
+
+def _json_size(obj: Any) -> int:
+    """Approximate size of obj on the wire."""
+    if isinstance(obj, str):
+        return len(obj) + 2
+    return len(json.dumps(obj))
+
+
+class _MethodStats:
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+
+    def add_latency(self, latency: float) -> None:
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.latency_buckets[i] += 1
+                break
+
+    def to_json(self) -> dict:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'in_flight': self.in_flight,
+            'bytes_out': self.bytes_out,
+            'bytes_in': self.bytes_in,
+            'latency_sum': self.latency_sum,
+            'latency_max': self.latency_max,
+            'latency_buckets': {str(bound): n for bound, n in zip(LATENCY_BUCKETS, self.latency_buckets)},
+        }
+
+
+class _RequestMeasurement:
+
+    def __init__(self, stats: _MethodStats, params):
+        self.stats = stats
+        self.start = time.monotonic()
+        self.response = None
+        stats.in_flight += 1
+        stats.bytes_out += _json_size(params)
+
+    def __enter__(self) -> '_RequestMeasurement':
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        stats = self.stats
+        stats.in_flight -= 1
+        stats.count += 1
+        stats.add_latency(time.monotonic() - self.start)
+        if exc_type is not None:
+            if not issubclass(exc_type, asyncio.CancelledError) or issubclass(exc_type, TaskTimeout):
+                stats.errors += 1
+        else:
+            stats.bytes_in += _json_size(self.response)
+
+
+class RpcStats:
+    """Latency histograms, approximate bytes in/out, error and in-flight counts
+    of the requests of a session, per method.
+    """
+
+    def __init__(self):
+        self._methods = defaultdict(_MethodStats)  # type: Dict[str, _MethodStats]
+
+    def measure(self, method: str, params) -> _RequestMeasurement:
+        """Context manager around a request. Set the response
+        on the returned object before leaving it."""
+        return _RequestMeasurement(self._methods[method], params)
+
+    def to_json(self) -> Dict[str, dict]:
+        return {method: stats.to_json() for method, stats in sorted(self._methods.items())}
 
 
 def assert_non_negative_integer(val: Any) -> None:
@@ -138,9 +283,18 @@ class NotificationSession(RPCSession):
         self.subscriptions = defaultdict(list)
         self.cache = {}
         self.default_timeout = NetworkTimeout.Generic.NORMAL
+        self.adaptive_timeouts = True
+        # per RPC method, as their response times differ a lot
+        self.rtt_estimators = defaultdict(RttEstimator)  # type: Dict[str, RttEstimator]
         self._msg_counter = itertools.count(start=1)
         self.interface = interface
         self.cost_hard_limit = 0  # disable aiorpcx resource limits
+        self._batch_queue = []  # type: List[Tuple[str, List, asyncio.Future]]
+        self._batch_tasks = set()  # type: Set[asyncio.Future]
+        self._inflight_requests = {}  # type: Dict[str, asyncio.Future]
+        self._result_cache = OrderedDict()  # type: OrderedDict[str, Tuple[float, Any]]
+        self.rpc_cache_stats = {'hits': 0, 'misses': 0}
+        self.rpc_stats = RpcStats()
 
     async def handle_request(self, request):
         self.maybe_log(f"--> {request}")
@@ -165,24 +319,197 @@ class NotificationSession(RPCSession):
         # aiorpcx. the timeout arg here in most cases should not be set
         msg_id = next(self._msg_counter)
         self.maybe_log(f"<-- {args} {kwargs} (id: {msg_id})")
+        method = args[0]
+        if timeout is None:
+            timeout = self.get_request_timeout(method)
+        start = time.monotonic()
         try:
             # note: RPCSession.send_request raises TaskTimeout in case of a timeout.
             # TaskTimeout is a subclass of CancelledError, which is *suppressed* in TaskGroups
-            response = await asyncio.wait_for(
-                super().send_request(*args, **kwargs),
-                timeout)
+            with self.rpc_stats.measure(method, args[1] if len(args) > 1 else []) as measurement:
+                response = await asyncio.wait_for(
+                    super().send_request(*args, **kwargs),
+                    timeout)
+                measurement.response = response
         except (TaskTimeout, asyncio.TimeoutError) as e:
+            self._add_rtt_timeout(method)
+            self.interface.record_request(method, error=True)
             raise RequestTimedOut(f'request timed out: {args} (id: {msg_id})') from e
         except CodeMessageError as e:
             self.maybe_log(f"--> {repr(e)} (id: {msg_id})")
+            self._add_rtt_sample(method, time.monotonic() - start)
             raise
         else:
             self.maybe_log(f"--> {response} (id: {msg_id})")
+            self._add_rtt_sample(method, time.monotonic() - start)
             return response
 
-    def set_default_timeout(self, timeout):
-        self.sent_request_timeout = timeout
-        self.max_send_delay = timeout
+    def _add_rtt_sample(self, method: str, rtt: float) -> None:
+        self.rtt_estimators[method].add_sample(rtt)
+        self._update_session_timeouts()
+        self.interface.record_request(method, rtt=rtt)
+
+    def _add_rtt_timeout(self, method: str) -> None:
+        self.rtt_estimators[method].on_timeout()
+        self._update_session_timeouts()
+
+    def get_adaptive_timeout(self, method: str = None, request_type=NetworkTimeout.Generic) -> Optional[float]:
+        """Returns the timeout derived from the RTT estimate of method,
+        or None if there are not enough samples yet.
+        """
+        estimator = self.rtt_estimators.get(method)
+        if estimator is None:
+            return None
+        return estimator.get_timeout(request_type)
+
+    def get_request_timeout(self, method: str) -> float:
+        """The adaptive timeout of method, which can only be shorter than
+        the default timeout, i.e. the one of the network's timeout policy.
+        """
+        timeout = self.get_adaptive_timeout(method) if self.adaptive_timeouts else None
+        if timeout is None:
+            return self.default_timeout
+        return min(timeout, self.default_timeout)
+
+    def get_timeout_stats(self) -> Dict[str, dict]:
+        return {method: estimator.to_json()
+                for method, estimator in self.rtt_estimators.items()}
+
+    async def send_batched_request(self, method: str, params: List, *, timeout=None):
+        """Like send_request, but the requests made during the same iteration
+        of the event loop are sent together, as JSON-RPC batches.
+        Each request still gets its own result or exception.
+        """
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        if not self._batch_queue:
+            loop.call_soon(self._flush_batch_queue)
+        self._batch_queue.append((method, params, fut))
+        if timeout is None:
+            timeout = self.get_request_timeout(method)
+        start = time.monotonic()
+        try:
+            with self.rpc_stats.measure(method, params) as measurement:
+                measurement.response = await asyncio.wait_for(fut, timeout)
+        except (RequestTimedOut, asyncio.TimeoutError) as e:
+            # the batch as a whole, or this request, timed out
+            self._add_rtt_timeout(method)
+            self.interface.record_request(method, error=True)
+            if isinstance(e, RequestTimedOut):
+                raise
+            raise RequestTimedOut(f'request timed out: {(method, params)}') from e
+        except CodeMessageError:
+            self._add_rtt_sample(method, time.monotonic() - start)
+            raise
+        else:
+            self._add_rtt_sample(method, time.monotonic() - start)
+            return measurement.response
+
+    def _flush_batch_queue(self) -> None:
+        queue, self._batch_queue = self._batch_queue, []
+        max_size = self.get_max_batch_size()
+        for i in range(0, len(queue), max_size):
+            task = asyncio.ensure_future(self._send_batch(queue[i:i+max_size]))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _send_batch(self, requests: Sequence[Tuple[str, List, asyncio.Future]]) -> None:
+        requests = [r for r in requests if not r[2].done()]  # e.g. timed out already
+        if not requests:
+            return
+        msg_id = next(self._msg_counter)
+        self.maybe_log(f"<-- batch {[(method, params) for method, params, fut in requests]} (id: {msg_id})")
+        try:
+            async with self.send_batch() as batch:
+                for method, params, fut in requests:
+                    batch.add_request(method, params)
+        except (TaskTimeout, asyncio.TimeoutError) as e:
+            exc = RequestTimedOut(f'batch request timed out (id: {msg_id})')
+            for method, params, fut in requests:
+                if not fut.done():
+                    fut.set_exception(exc)
+            return
+        except asyncio.CancelledError:
+            for method, params, fut in requests:
+                fut.cancel()
+            raise
+        except Exception as e:
+            for method, params, fut in requests:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        self.maybe_log(f"--> batch {batch.results} (id: {msg_id})")
+        for (method, params, fut), result in zip(requests, batch.results):
+            if fut.done():
+                continue
+            if isinstance(result, Exception):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
+
+    async def send_coalesced_request(self, method: str, params: List, *, timeout=None, batched: bool = False):
+        """Like send_request, but identical requests in flight share one response,
+        and the result is reused for COALESCED_RPC_METHODS[method] seconds.
+        """
+        key = self.get_hashable_key_for_rpc_call(method, params)
+        cached = self._result_cache.get(key)
+        if cached is not None:
+            expiry, result = cached
+            if expiry > time.monotonic():
+                self.rpc_cache_stats['hits'] += 1
+                return result
+            del self._result_cache[key]
+        fut = self._inflight_requests.get(key)
+        if fut is not None:
+            self.rpc_cache_stats['hits'] += 1
+        else:
+            self.rpc_cache_stats['misses'] += 1
+            if batched:
+                fut = asyncio.ensure_future(self.send_batched_request(method, params))
+            else:
+                fut = asyncio.ensure_future(self.send_request(method, params))
+            self._inflight_requests[key] = fut
+            fut.add_done_callback(lambda f: self._on_coalesced_request_done(method, key, f))
+        try:
+            # shield: the request is not ours alone to cancel
+            return await asyncio.wait_for(asyncio.shield(fut), timeout)
+        except asyncio.TimeoutError as e:
+            raise RequestTimedOut(f'request timed out: {(method, params)}') from e
+
+    def _on_coalesced_request_done(self, method: str, key: str, fut: asyncio.Future) -> None:
+        if self._inflight_requests.get(key) is fut:
+            del self._inflight_requests[key]
+        if fut.cancelled() or fut.exception() is not None:
+            return
+        ttl = COALESCED_RPC_METHODS.get(method, 0)
+        if ttl <= 0:
+            return
+        self._result_cache[key] = (time.monotonic() + ttl, fut.result())
+        self._result_cache.move_to_end(key)
+        while len(self._result_cache) > MAX_CACHED_RESULTS:
+            self._result_cache.popitem(last=False)
+
+    def get_max_batch_size(self) -> int:
+        return max(1, int(self.interface.network.config.get('network_max_batch_size', MAX_BATCH_SIZE)))
+
+    def set_default_timeout(self, timeout, *, adaptive: bool = True):
+        """Sets the timeout of requests for which there is no RTT estimate yet,
+        which also caps the others. Without adaptive, it is used for all requests.
+        """
+        self.default_timeout = timeout
+        self.adaptive_timeouts = adaptive
+        self._update_session_timeouts()
+
+    def _update_session_timeouts(self) -> None:
+        # aiorpcx applies these to all requests, including batches;
+        # the per-request timeouts are enforced in send_request
+        timeouts = [self.default_timeout]
+        for estimator in self.rtt_estimators.values():
+            timeout = estimator.get_timeout()
+            if timeout is not None:
+                timeouts.append(timeout)
+        self.sent_request_timeout = max(timeouts)
+        self.max_send_delay = max(timeouts)
 
     async def subscribe(self, method: str, params: List, queue: asyncio.Queue):
         # note: until the cache is written for the first time,
@@ -345,6 +672,87 @@ def _get_cert_path_for_host(*, config: 'SimpleConfig', host: str) -> str:
     return os.path.join(config.path, 'certs', filename)
 
 
+class _ResumableSSLContext(ssl.SSLContext):
+    """An SSLContext for a single server, offering it the TLS session
+    of our last connection, so that the server can resume it instead of
+    doing a full handshake.
+    """
+    tls_session = None  # type: Optional[ssl.SSLSession]
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.tls_session
+        return super().wrap_bio(incoming, outgoing, server_side=server_side,
+                                server_hostname=server_hostname, session=session)
+
+
+class _SavedCert(NamedTuple):
+    stat_key: Tuple[int, int, int]
+    dercert: Optional[bytes]  # None if the server has a CA signed cert
+    x509: Optional[x509.X509]
+    fingerprint: Optional[str]
+
+
+def _stat_key(path: str) -> Optional[Tuple[int, int, int]]:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+class SSLContextCache:
+    """The saved certs of servers, and an SSL context per server.
+
+    Saved certs are parsed once, and read again only if their file changes.
+    A context is kept as long as the cert it was made from, so reconnecting
+    to a server can resume the TLS session of the previous connection.
+    """
+
+    def __init__(self):
+        self._certs = {}  # type: Dict[str, _SavedCert]
+        self._contexts = {}  # type: Dict[ServerAddr, Tuple[_SavedCert, _ResumableSSLContext]]
+
+    def get_saved_cert(self, cert_path: str) -> Optional[_SavedCert]:
+        """Returns the cached cert saved at cert_path, if it has not changed since."""
+        cert = self._certs.get(cert_path)
+        if cert is not None and cert.stat_key != _stat_key(cert_path):
+            del self._certs[cert_path]
+            cert = None
+        return cert
+
+    def add_saved_cert(self, cert_path: str, *, stat_key: Tuple[int, int, int],
+                       dercert: Optional[bytes], x509_cert: Optional[x509.X509]) -> _SavedCert:
+        fingerprint = hashlib.sha256(dercert).hexdigest() if dercert is not None else None
+        cert = _SavedCert(stat_key=stat_key, dercert=dercert, x509=x509_cert, fingerprint=fingerprint)
+        self._certs[cert_path] = cert
+        return cert
+
+    def get_context(self, server: ServerAddr, cert: _SavedCert) -> _ResumableSSLContext:
+        cached = self._contexts.get(server)
+        if cached is not None and cached[0] is cert:
+            return cached[1]
+        sslc = _ResumableSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        if cert.dercert is None:
+            # CA signed cert
+            sslc.load_verify_locations(cafile=ca_path)
+        else:
+            # pinned self-signed cert
+            sslc.load_verify_locations(cadata=cert.dercert)
+            sslc.check_hostname = False
+        self._contexts[server] = (cert, sslc)
+        return sslc
+
+    def forget_session(self, server: ServerAddr) -> None:
+        cached = self._contexts.get(server)
+        if cached is not None:
+            cached[1].tls_session = None
+
+    def clear(self) -> None:
+        self._certs.clear()
+        self._contexts.clear()
+
+
 class Interface(Logger):
 
     LOGGING_SHORTCUT = 'i'
@@ -372,6 +780,11 @@ class Interface(Logger):
 
         self.fee_estimates_eta = {}
 
+        # how long it took to connect and get a response, and whether
+        # the TLS session of a previous connection could be resumed
+        self.connect_time = None  # type: Optional[float]
+        self.tls_session_reused = False
+
         # Dump network messages (only for this interface).  Set at runtime from the console.
         self.debug = False
 
@@ -423,15 +836,18 @@ class Interface(Logger):
         else:
             await self._save_certificate()
 
-    def _is_saved_ssl_cert_available(self):
-        if not os.path.exists(self.cert_path):
-            return False
+    def _get_saved_ssl_cert(self) -> Optional[_SavedCert]:
+        cache = self.network.ssl_context_cache
+        cert = cache.get_saved_cert(self.cert_path)
+        if cert is not None:
+            return cert
+        stat_key = _stat_key(self.cert_path)
+        if stat_key is None:
+            return None
         with open(self.cert_path, 'r') as f:
             contents = f.read()
         if contents == '':  # CA signed
-            if self._get_expected_fingerprint():
-                raise InvalidOptionCombination("cannot use --serverfingerprint with CA signed servers")
-            return True
+            return cache.add_saved_cert(self.cert_path, stat_key=stat_key, dercert=None, x509_cert=None)
         # pinned self-signed cert
         try:
             b = pem.dePem(contents, 'CERTIFICATE')
@@ -443,13 +859,24 @@ class Interface(Logger):
         except Exception as e:
             self.logger.info(f"error parsing already saved cert: {e}")
             raise ErrorParsingSSLCert(e) from e
+        return cache.add_saved_cert(self.cert_path, stat_key=stat_key, dercert=bytes(b), x509_cert=x)
+
+    def _is_saved_ssl_cert_available(self):
+        cert = self._get_saved_ssl_cert()
+        if cert is None:
+            return False
+        if cert.dercert is None:  # CA signed
+            if self._get_expected_fingerprint():
+                raise InvalidOptionCombination("cannot use --serverfingerprint with CA signed servers")
+            return True
+        # pinned self-signed cert
         try:
-            x.check_date()
+            cert.x509.check_date()
         except x509.CertificateError as e:
             self.logger.info(f"certificate has expired: {e}")
             os.unlink(self.cert_path)  # delete pinned cert only in this case
             return False
-        self._verify_certificate_fingerprint(bytearray(b))
+        self._verify_fingerprint(cert.fingerprint)
         return True
 
     async def _get_ssl_context(self):
@@ -458,22 +885,14 @@ class Interface(Logger):
             return None
 
         # see if we already have cert for this server; or get it for the first time
-        ca_sslc = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, cafile=ca_path)
         if not self._is_saved_ssl_cert_available():
+            ca_sslc = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, cafile=ca_path)
             try:
                 await self._try_saving_ssl_cert_for_first_time(ca_sslc)
             except (OSError, ConnectError, aiorpcx.socks.SOCKSError) as e:
                 raise ErrorGettingSSLCertFromServer(e) from e
         # now we have a file saved in our certificate store
-        siz = os.stat(self.cert_path).st_size
-        if siz == 0:
-            # CA signed cert
-            sslc = ca_sslc
-        else:
-            # pinned self-signed cert
-            sslc = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=self.cert_path)
-            sslc.check_hostname = 0
-        return sslc
+        return self.network.ssl_context_cache.get_context(self.server, self._get_saved_ssl_cert())
 
     def handle_disconnect(func):
         async def wrapper_func(self: 'Interface', *args, **kwargs):
@@ -504,6 +923,9 @@ class Interface(Logger):
             await self.open_session(ssl_context)
         except (asyncio.CancelledError, ConnectError, aiorpcx.socks.SOCKSError) as e:
             # make SSL errors for main interface more visible (to help servers ops debug cert pinning issues)
+            if isinstance(e, ConnectError) and isinstance(e.__cause__, ssl.SSLError):
+                # do not offer that session again
+                self.network.ssl_context_cache.forget_session(self.server)
             if (isinstance(e, ConnectError) and isinstance(e.__cause__, ssl.SSLError)
                     and self.is_main_server() and not self.network.auto_connect):
                 self.logger.warning(f'Cannot connect to main server due to SSL error '
@@ -567,10 +989,12 @@ class Interface(Logger):
             return self.network.config.get("serverfingerprint")
 
     def _verify_certificate_fingerprint(self, certificate):
+        self._verify_fingerprint(hashlib.sha256(certificate).hexdigest())
+
+    def _verify_fingerprint(self, fingerprint: str):
         expected_fingerprint = self._get_expected_fingerprint()
         if not expected_fingerprint:
             return
-        fingerprint = hashlib.sha256(certificate).hexdigest()
         fingerprints_match = fingerprint.lower() == expected_fingerprint.lower()
         if not fingerprints_match:
             util.trigger_callback('cert_mismatch')
@@ -580,8 +1004,10 @@ class Interface(Logger):
     async def get_block_header(self, height, assert_mode):
         self.logger.info(f'requesting block header {height} in mode {assert_mode}')
         # use lower timeout as we usually have network.bhi_lock here
-        timeout = self.network.get_network_timeout_seconds(NetworkTimeout.Urgent)
-        res = await self.session.send_request('blockchain.block.header', [height], timeout=timeout)
+        timeout = self.network.get_network_timeout_seconds(
+            NetworkTimeout.Urgent, interface=self, method='blockchain.block.header')
+        async with self.network.request_scheduler.slot(self.server, JobPriority.HEADERS):
+            res = await self.session.send_request('blockchain.block.header', [height], timeout=timeout)
         return blockchain.deserialize_header(bytes.fromhex(res), height)
 
     async def request_chunk(self, height: int, tip=None, *, can_return_early=False):
@@ -597,9 +1023,22 @@ class Interface(Logger):
             size = max(size, 0)
         try:
             self._requested_chunks.add(index)
-            res = await self.session.send_request('blockchain.block.headers', [index * 2016, size])
+            chunk_hex = await self.get_chunk_hex(index, size)
         finally:
             self._requested_chunks.discard(index)
+        conn = await self.blockchain.connect_chunk_async(index, chunk_hex)
+        if not conn:
+            return conn, 0
+        return conn, size
+
+    async def get_chunk_hex(self, index: int, size: int) -> str:
+        """Fetches size headers starting at height index * 2016.
+        The headers are not checked against any chain.
+        """
+        async with self.network.request_scheduler.slot(self.server, JobPriority.HEADERS):
+            start = time.monotonic()
+            res = await self.session.send_request('blockchain.block.headers', [index * 2016, size])
+            elapsed = time.monotonic() - start
         assert_dict_contains_field(res, field_name='count')
         assert_dict_contains_field(res, field_name='hex')
         assert_dict_contains_field(res, field_name='max')
@@ -610,10 +1049,15 @@ class Interface(Logger):
             raise RequestCorrupted('inconsistent chunk hex and count')
         if res['count'] != size:
             raise RequestCorrupted(f"expected {size} headers but only got {res['count']}")
-        conn = self.blockchain.connect_chunk(index, res['hex'])
-        if not conn:
-            return conn, 0
-        return conn, res['count']
+        self.network.server_scores.record_throughput(self.server, len(res['hex']) // 2, elapsed)
+        return res['hex']
+
+    def record_request(self, method: str, *, rtt: float = None, error: bool = False) -> None:
+        """Feeds the outcome of a request into the score of the server."""
+        if method == 'blockchain.block.headers':
+            # latency is dominated by the size of the chunk; see get_chunk_hex
+            rtt = None
+        self.network.server_scores.record_request(self.server, rtt=rtt, error=error)
 
     def is_main_server(self) -> bool:
         return (self.network.interface == self or
@@ -621,15 +1065,20 @@ class Interface(Logger):
 
     async def open_session(self, sslc, exit_early=False):
         session_factory = lambda *args, iface=self, **kwargs: NotificationSession(*args, **kwargs, interface=iface)
+        start = time.monotonic()
         async with _RSClient(session_factory=session_factory,
                              host=self.host, port=self.port,
                              ssl=sslc, proxy=self.proxy) as session:
             self.session = session  # type: NotificationSession
-            self.session.set_default_timeout(self.network.get_network_timeout_seconds(NetworkTimeout.Generic))
+            self.session.set_default_timeout(self.network.get_network_timeout_seconds(NetworkTimeout.Generic),
+                                             adaptive=self.network.has_adaptive_timeouts())
             try:
                 ver = await session.send_request('server.version', [self.client_name(), version.PROTOCOL_VERSION])
             except aiorpcx.jsonrpc.RPCError as e:
                 raise GracefulDisconnect(e)  # probably 'unsupported protocol version'
+            self.connect_time = time.monotonic() - start
+            if isinstance(sslc, _ResumableSSLContext):
+                self._remember_tls_session(session, sslc)
             if exit_early:
                 return
             if ver[1] != version.PROTOCOL_VERSION:
@@ -638,7 +1087,9 @@ class Interface(Logger):
             if not self.network.check_interface_against_healthy_spread_of_connected_servers(self):
                 raise GracefulDisconnect(f'too many connected servers already '
                                          f'in bucket {self.bucket_based_on_ipaddress()}')
-            self.logger.info(f"connection established. version: {ver}")
+            self.logger.info(f"connection established. version: {ver}, "
+                             f"took {self.connect_time * 1000:.0f} ms"
+                             + (" (TLS session resumed)" if self.tls_session_reused else ""))
 
             try:
                 async with self.taskgroup as group:
@@ -653,6 +1104,17 @@ class Interface(Logger):
                     raise GracefulDisconnect(e, log_level=logging.WARNING) from e
                 raise
 
+    def _remember_tls_session(self, session: 'NotificationSession', sslc: _ResumableSSLContext) -> None:
+        asyncio_transport = session.transport._asyncio_transport  # type: asyncio.BaseTransport
+        ssl_object = asyncio_transport.get_extra_info("ssl_object")  # type: Optional[ssl.SSLObject]
+        if ssl_object is None:
+            return
+        self.tls_session_reused = ssl_object.session_reused
+        # with TLS 1.3, the session ticket arrives after the handshake,
+        # so by now, having got a response, we should have it
+        if ssl_object.session is not None:
+            sslc.tls_session = ssl_object.session
+
     async def monitor_connection(self):
         while True:
             await asyncio.sleep(1)
@@ -724,6 +1186,17 @@ class Interface(Logger):
         last = None
         while last is None or height <= next_height:
             prev_last, prev_height = last, height
+            if next_height >= (height // 2016 + 1) * 2016:
+                # more than one chunk to go: fetch them from all servers in parallel
+                new_height, could_connect = await self.network.download_header_chunks(self, height, next_height)
+                if new_height > height:
+                    util.trigger_callback('network_updated')
+                    last, height = 'catchup', new_height
+                if not could_connect:
+                    if height <= constants.net.max_checkpoint():
+                        raise GracefulDisconnect('server chain conflicts with checkpoints or genesis')
+                    last, height = await self.step(height)
+                continue
             if next_height > height + 10:
                 could_connect, num_headers = await self.request_chunk(height, next_height)
                 if not could_connect:
@@ -893,13 +1366,20 @@ class Interface(Logger):
             self._ipaddr_bucket = do_bucket()
         return self._ipaddr_bucket
 
-    async def get_merkle_for_transaction(self, tx_hash: str, tx_height: int) -> dict:
+    async def _send_request(self, method: str, params: List, *, timeout=None, batched: bool = False):
+        if method in COALESCED_RPC_METHODS:
+            return await self.session.send_coalesced_request(method, params, timeout=timeout, batched=batched)
+        if batched:
+            return await self.session.send_batched_request(method, params, timeout=timeout)
+        return await self.session.send_request(method, params, timeout=timeout)
+
+    async def get_merkle_for_transaction(self, tx_hash: str, tx_height: int, *, batched: bool = False) -> dict:
         if not is_hash256_str(tx_hash):
             raise Exception(f"{repr(tx_hash)} is not a txid")
         if not is_non_negative_integer(tx_height):
             raise Exception(f"{repr(tx_height)} is not a block height")
         # do request
-        res = await self.session.send_request('blockchain.transaction.get_merkle', [tx_hash, tx_height])
+        res = await self._send_request('blockchain.transaction.get_merkle', [tx_hash, tx_height], batched=batched)
         # check response
         block_height = assert_dict_contains_field(res, field_name='block_height')
         merkle = assert_dict_contains_field(res, field_name='merkle')
@@ -912,10 +1392,10 @@ class Interface(Logger):
             assert_hash256_str(item)
         return res
 
-    async def get_transaction(self, tx_hash: str, *, timeout=None) -> str:
+    async def get_transaction(self, tx_hash: str, *, timeout=None, batched: bool = False) -> str:
         if not is_hash256_str(tx_hash):
             raise Exception(f"{repr(tx_hash)} is not a txid")
-        raw = await self.session.send_request('blockchain.transaction.get', [tx_hash], timeout=timeout)
+        raw = await self._send_request('blockchain.transaction.get', [tx_hash], timeout=timeout, batched=batched)
         # validate response
         if not is_hex_str(raw):
             raise RequestCorrupted(f"received garbage (non-hex) as tx data (txid {tx_hash}): {raw!r}")
@@ -928,11 +1408,11 @@ class Interface(Logger):
             raise RequestCorrupted(f"received tx does not match expected txid {tx_hash} (got {tx.txid()})")
         return raw
 
-    async def get_history_for_scripthash(self, sh: str) -> List[dict]:
+    async def get_history_for_scripthash(self, sh: str, *, batched: bool = False) -> List[dict]:
         if not is_hash256_str(sh):
             raise Exception(f"{repr(sh)} is not a scripthash")
         # do request
-        res = await self.session.send_request('blockchain.scripthash.get_history', [sh])
+        res = await self._send_request('blockchain.scripthash.get_history', [sh], batched=batched)
         # check response
         assert_list_or_tuple(res)
         for tx_item in res:
@@ -981,7 +1461,7 @@ class Interface(Logger):
         if not is_non_negative_integer(tx_pos):
             raise Exception(f"{repr(tx_pos)} should be non-negative integer")
         # do request
-        res = await self.session.send_request(
+        res = await self._send_request(
             'blockchain.transaction.id_from_pos',
             [tx_height, tx_pos, merkle],
         )
@@ -25,12 +25,75 @@
 import threading
 import copy
 import json
+from typing import Tuple, Dict, Any, Optional
 
 from . import util
+from .util import WalletFileException
 from .logging import Logger
 
 JsonDBJsonEncoder = util.MyEncoder
 
+# Changes are appended to the json file as a journal, one line per write.
+# Journal lines are json lists, so they start with '[' at the beginning
+# of a line, which the json of the db itself (a dict) never does.
+JOURNAL_START = '\n['
+
+
+def split_journal(s: str) -> Tuple[str, str]:
+    """Splits the contents of a json file into the db and its journal."""
+    i = s.find(JOURNAL_START)
+    if i < 0:
+        return s, ''
+    return s[:i], s[i+1:]
+
+
+def _apply_journal_record(data: dict, record: list) -> None:
+    for change in record:
+        path = change[0]
+        d = data
+        for key in path[:-1]:
+            d = d[key]
+        key = path[-1]
+        if len(change) == 1:
+            d.pop(key, None)
+        elif isinstance(d, list) and key == len(d):
+            d.append(change[1])
+        else:
+            d[key] = change[1]
+
+
+def apply_journal(data: dict, journal: str) -> bool:
+    """Replays the journal on data, the json of the db.
+    Returns False if the last write was incomplete, e.g. because we crashed
+    while appending it, in which case that write is ignored.
+    """
+    lines = journal.split('\n')
+    for i, line in enumerate(lines):
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            if i == len(lines) - 1:
+                return False
+            raise WalletFileException("Cannot read wallet file. (journal is corrupt)")
+        try:
+            _apply_journal_record(data, record)
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            raise WalletFileException(f"Cannot read wallet file. (cannot apply journal: {e!r})") from e
+    return True
+
+
+def load_json_with_journal(s: str) -> Tuple[dict, bool]:
+    """Parses the contents of a json file, and replays its journal.
+    Returns the data, and whether the journal was complete.
+    """
+    s, journal = split_journal(s)
+    data = json.loads(s)
+    is_complete = apply_journal(data, journal) if journal else True
+    return data, is_complete
+
+
 def modifier(func):
     def wrapper(self, *args, **kwargs):
         with self.lock:
@@ -48,14 +111,16 @@ def locked(func):
 class StoredObject:
 
     db = None
+    _path = None
 
     def __setattr__(self, key, value):
-        if self.db:
-            self.db.set_modified(True)
         object.__setattr__(self, key, value)
+        if self.db and not key.startswith('_'):
+            self.db._journal_set(self._path, self)
 
-    def set_db(self, db):
-        self.db = db
+    def set_db(self, db, path):
+        object.__setattr__(self, 'db', db)
+        object.__setattr__(self, '_path', path)
 
     def to_json(self):
         d = dict(vars(self))
@@ -67,6 +132,7 @@ class StoredObject:
 
 
 _RaiseKeyError = object() # singleton for no-default behavior
+_DELETED = object()
 
 class StoredDict(dict):
 
@@ -76,7 +142,7 @@ class StoredDict(dict):
         self.path = path
         # recursively convert dicts to StoredDict
         for k, v in list(data.items()):
-            self.__setitem__(k, v)
+            self._setitem(k, v, add_to_journal=False)
 
     def convert_key(self, key):
         """Convert int keys to str keys, as only those are allowed in json."""
@@ -85,19 +151,32 @@ class StoredDict(dict):
         #             suddenly the keys are str...
         return str(int(key)) if isinstance(key, int) else key
 
+    def set_db(self, db, path):
+        """Recursively sets db and path, e.g. when added to another dict."""
+        self.db = db
+        self.path = path
+        for k, v in dict.items(self):
+            if isinstance(v, (StoredDict, StoredObject)):
+                v.set_db(db, path + [k])
+
     @locked
     def __setitem__(self, key, v):
+        self._setitem(key, v)
+
+    def _setitem(self, key, v, *, add_to_journal=True):
         key = self.convert_key(key)
         is_new = key not in self
         # early return to prevent unnecessary disk writes
         if not is_new and self[key] == v:
+            # a list or dict that was changed in place and then set again
+            # is equal to itself, but its changes still have to be journaled
+            old_v = dict.get(self, key)
+            if self.db and add_to_journal and (old_v is v or isinstance(v, (list, dict, set))):
+                self.db._journal_set(self.path + [key], old_v)
             return
         # recursively set db and path
         if isinstance(v, StoredDict):
-            v.db = self.db
-            v.path = self.path + [key]
-            for k, vv in v.items():
-                v[k] = vv
+            v.set_db(self.db, self.path + [key])
         # recursively convert dict to StoredDict.
         # _convert_dict is called breadth-first
         elif isinstance(v, dict):
@@ -111,18 +190,18 @@ class StoredDict(dict):
                 v = self.db._convert_value(self.path, key, v)
         # set parent of StoredObject
         if isinstance(v, StoredObject):
-            v.set_db(self.db)
+            v.set_db(self.db, self.path + [key])
         # set item
         dict.__setitem__(self, key, v)
-        if self.db:
-            self.db.set_modified(True)
+        if self.db and add_to_journal:
+            self.db._journal_set(self.path + [key], v)
 
     @locked
     def __delitem__(self, key):
         key = self.convert_key(key)
         dict.__delitem__(self, key)
         if self.db:
-            self.db.set_modified(True)
+            self.db._journal_delete(self, self.path + [key])
 
     @locked
     def __getitem__(self, key):
@@ -139,12 +218,20 @@ class StoredDict(dict):
         key = self.convert_key(key)
         if v is _RaiseKeyError:
             r = dict.pop(self, key)
+        elif dict.__contains__(self, key):
+            r = dict.pop(self, key)
         else:
-            r = dict.pop(self, key, v)
+            return v
         if self.db:
-            self.db.set_modified(True)
+            self.db._journal_delete(self, self.path + [key])
         return r
 
+    @locked
+    def clear(self):
+        dict.clear(self)
+        if self.db:
+            self.db._journal_set(self.path, self)
+
     @locked
     def get(self, key, default=None):
         key = self.convert_key(key)
@@ -160,14 +247,73 @@ class JsonDB(Logger):
         self.lock = threading.RLock()
         self.data = data
         self._modified = False
+        # changes since the last write: path -> new value (or _DELETED).
+        # unless a full write is needed, only these are written, as a journal
+        self._pending_changes = {}  # type: Dict[Tuple, Any]
+        self._full_write_needed = False
 
     def set_modified(self, b):
+        """Setting this means the whole db needs to be written,
+        as we do not know what changed.
+        """
         with self.lock:
             self._modified = b
+            self._full_write_needed = b
+            self._pending_changes.clear()
 
     def modified(self):
         return self._modified
 
+    def _get_by_path(self, path):
+        d = self.data
+        for key in path:
+            try:
+                d = d[key]
+            except (KeyError, IndexError, TypeError):
+                return None
+        return d
+
+    def _journal_set(self, path, value):
+        """Records that the value at path was set, or changed in place."""
+        with self.lock:
+            self._modified = True
+            if self._full_write_needed:
+                return
+            if not path:
+                self.set_modified(True)
+                return
+            # do not record changes to dicts that are not (yet) part of the db,
+            # e.g. the storage of a channel being created. they are written
+            # when added to the db.
+            if self._get_by_path(path) is not value:
+                return
+            self._pending_changes[tuple(path)] = value
+
+    def _journal_delete(self, parent, path):
+        with self.lock:
+            self._modified = True
+            if self._full_write_needed:
+                return
+            if self._get_by_path(path[:-1]) is not parent:
+                return
+            self._pending_changes[tuple(path)] = _DELETED
+
+    @locked
+    def dump_journal_record(self) -> Optional[str]:
+        """Serializes the changes since the last write as a line of the journal.
+        Changes within a dict that was itself changed are left out, as that
+        change includes them. This makes the order of changes irrelevant.
+        """
+        changes = self._pending_changes
+        record = []
+        for path, value in changes.items():
+            if any(path[:i] in changes for i in range(1, len(path))):
+                continue
+            record.append([path] if value is _DELETED else [path, value])
+        if not record:
+            return None
+        return json.dumps(record, separators=(',', ':'), cls=JsonDBJsonEncoder)
+
     @locked
     def get(self, key, default=None):
         v = self.data.get(key)
@@ -32,6 +32,8 @@ import socket
 import json
 import sys
 import asyncio
+import bisect
+import sqlite3
 from typing import NamedTuple, Optional, Sequence, List, Dict, Tuple, TYPE_CHECKING, Iterable, Set, Any
 import traceback
 import concurrent
@@ -54,12 +56,15 @@ from .transaction import Transaction
 from .blockchain import Blockchain, HEADER_SIZE
 from .interface import (Interface, PREFERRED_NETWORK_PROTOCOL,
                         RequestTimedOut, NetworkTimeout, BUCKET_NAME_OF_ONION_SERVERS,
-                        NetworkException, RequestCorrupted, ServerAddr)
+                        NetworkException, RequestCorrupted, ServerAddr, SSLContextCache)
 from .version import PROTOCOL_VERSION
 from .simple_config import SimpleConfig
 from .i18n import _
 from .logging import get_logger, Logger
 from .lnutil import ChannelBlackList
+from .tx_cache import TxCache, DEFAULT_TX_CACHE_MAX_SIZE
+from .server_scores import ServerScores, MAIN_SERVER_SWITCH_RATIO
+from .request_scheduler import RequestScheduler, DEFAULT_MAX_LIMIT as DEFAULT_MAX_CONCURRENT_REQUESTS
 
 if TYPE_CHECKING:
     from .channel_db import ChannelDB
@@ -74,6 +79,9 @@ _logger = get_logger(__name__)
 NUM_TARGET_CONNECTED_SERVERS = 10
 NUM_STICKY_SERVERS = 4
 NUM_RECENT_SERVERS = 20
+HEADER_CHUNK_WINDOW = 8  # chunks in flight during header download, see HeaderChunkScheduler
+MIN_MAIN_SERVER_DWELL = 60  # seconds before a new main server may be replaced for scoring badly
+BAD_MAIN_SERVER_CHECK_INTERVAL = 10  # seconds
 
 
 def parse_servers(result: Sequence[Tuple[str, str, List[str]]]) -> Dict[str, dict]:
@@ -132,13 +140,18 @@ def filter_protocol(hostmap, *, allowed_protocols: Iterable[str] = None) -> Sequ
 
 
 def pick_random_server(hostmap=None, *, allowed_protocols: Iterable[str],
-                       exclude_set: Set[ServerAddr] = None) -> Optional[ServerAddr]:
+                       exclude_set: Set[ServerAddr] = None,
+                       server_scores: ServerScores = None) -> Optional[ServerAddr]:
+    """Picks a random server. If server_scores is given, the choice
+    is weighted by score."""
     if hostmap is None:
         hostmap = constants.net.DEFAULT_SERVERS
     if exclude_set is None:
         exclude_set = set()
     servers = set(filter_protocol(hostmap, allowed_protocols=allowed_protocols))
     eligible = list(servers - exclude_set)
+    if server_scores is not None:
+        return server_scores.choose(eligible)
     return random.choice(eligible) if eligible else None
 
 
@@ -211,6 +224,15 @@ class TxBroadcastServerReturnedError(TxBroadcastError):
                     str(self))
 
 
+# sanitized broadcast errors meaning that the server already has the transaction
+TX_ALREADY_KNOWN_MESSAGES = {
+    "txn-already-in-mempool",
+    "txn-already-known",
+    "transaction already in block chain",
+    "Transaction already in block chain",
+}
+
+
 class TxBroadcastUnknownError(TxBroadcastError):
     def get_message_for_gui(self):
         return "{}\n{}" \
@@ -233,6 +255,110 @@ class UntrustedServerReturnedError(NetworkException):
                 f"[DO NOT TRUST THIS MESSAGE] original_exception: {repr(self.original_exception)}>")
 
 
+class _ChunkUnavailable(Exception): pass
+
+
+class HeaderChunkScheduler:
+    """Downloads the header chunks between two heights for an interface,
+    spreading the requests over all connected servers with a sliding window
+    of chunks in flight. Chunks are connected to the blockchain of the
+    interface in order.
+
+    A chunk from another server is only used if its last header is the one the
+    interface itself has at that height. Servers that fail a request or send a
+    conflicting chunk are not asked again; their chunk is retried elsewhere,
+    and in the end on the interface itself.
+    """
+
+    def __init__(self, network: 'Network', interface: Interface):
+        self.network = network
+        self.interface = interface
+        self.logger = interface.logger
+        self.window = max(1, network.config.get('network_header_chunk_window', HEADER_CHUNK_WINDOW))
+        self._excluded = set()  # type: Set[ServerAddr]
+
+    def _pick_interface(self, end_height: int, load: Dict[Interface, int]) -> Interface:
+        with self.network.interfaces_lock:
+            interfaces = list(self.network.interfaces.values())
+        candidates = [iface for iface in interfaces
+                      if iface is not self.interface
+                      and iface.server not in self._excluded
+                      and iface.tip >= end_height
+                      and iface.session and not iface.session.is_closing()]
+        candidates.append(self.interface)
+        random.shuffle(candidates)
+        return min(candidates, key=lambda iface: load.get(iface, 0))
+
+    def _exclude(self, iface: Interface, reason: str) -> None:
+        self.logger.info(f"not downloading headers from {iface.server} any more: {reason}")
+        self._excluded.add(iface.server)
+
+    async def _fetch(self, index: int, size: int, iface: Interface) -> str:
+        if iface is self.interface:
+            return await iface.get_chunk_hex(index, size)
+        try:
+            chunk_hex = await iface.get_chunk_hex(index, size)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            raise _ChunkUnavailable(repr(e)) from e
+        # cross-check against the server we are syncing with
+        header_hex = await self.interface.session.send_batched_request(
+            'blockchain.block.header', [index * 2016 + size - 1])
+        if not isinstance(header_hex, str) or header_hex.lower() != chunk_hex[-HEADER_SIZE * 2:].lower():
+            raise _ChunkUnavailable(f"chunk {index} conflicts with {self.interface.server}")
+        return chunk_hex
+
+    async def run(self, height: int, tip: int) -> Tuple[int, bool]:
+        """Returns the height after the last header that could be connected,
+        and False if we stopped there because the chunk of the interface
+        itself does not connect.
+        """
+        first_index, last_index = height // 2016, tip // 2016
+        chunk_size = lambda index: min(2016, tip - index * 2016 + 1)
+        queue = list(range(first_index, last_index + 1))  # sorted, not requested yet
+        in_flight = {}  # type: Dict[asyncio.Future, Tuple[int, Interface]]
+        fetched = {}  # type: Dict[int, Tuple[Interface, str]]
+        next_index = first_index  # next chunk to connect
+        could_connect = True
+        try:
+            while next_index <= last_index:
+                while queue and len(in_flight) < self.window and queue[0] < next_index + self.window:
+                    index = queue.pop(0)
+                    load = defaultdict(int)
+                    for _, iface in in_flight.values():
+                        load[iface] += 1
+                    iface = self._pick_interface(index * 2016 + chunk_size(index) - 1, load)
+                    task = asyncio.ensure_future(self._fetch(index, chunk_size(index), iface))
+                    in_flight[task] = (index, iface)
+                if next_index not in fetched:
+                    done, _ = await asyncio.wait(list(in_flight), return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        index, iface = in_flight.pop(task)
+                        try:
+                            fetched[index] = (iface, task.result())
+                        except _ChunkUnavailable as e:
+                            self._exclude(iface, str(e))
+                            bisect.insort(queue, index)
+                    continue
+                iface, chunk_hex = fetched.pop(next_index)
+                if not await self.interface.blockchain.connect_chunk_async(next_index, chunk_hex):
+                    if iface is self.interface:
+                        could_connect = False
+                        break
+                    self._exclude(iface, f"chunk {next_index} does not connect")
+                    bisect.insort(queue, next_index)
+                    continue
+                self.logger.info(f"connected chunk {next_index} from {iface.server}")
+                next_index += 1
+        finally:
+            for task in in_flight:
+                task.cancel()
+        if next_index == first_index:
+            return height, could_connect
+        return (next_index - 1) * 2016 + chunk_size(next_index - 1), could_connect
+
+
 _INSTANCE = None
 
 
@@ -280,6 +406,7 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
 
         blockchain.read_blockchains(self.config)
         blockchain.init_headers_file_for_best_chain()
+        self.pow_verifier = blockchain.DeferredPowVerifier(self.config)
         self.logger.info(f"blockchains {list(map(lambda b: b.forkpoint, blockchain.blockchains.values()))}")
         self._blockchain_preferred_block = self.config.get('blockchain_preferred_block', None)  # type: Dict[str, Any]
         if self._blockchain_preferred_block is None:
@@ -288,6 +415,10 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
 
         self._allowed_protocols = {PREFERRED_NETWORK_PROTOCOL}
 
+        # persisted next to recent_servers
+        self.server_scores = ServerScores(os.path.join(self.config.path, "server_scores")
+                                          if self.config.path else None)
+
         # Server for addresses and transactions
         self.default_server = self.config.get('server', None)
         # Sanitize default server
@@ -298,7 +429,8 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
                 self.logger.warning('failed to parse server-string; falling back to localhost:1:s.')
                 self.default_server = ServerAddr.from_str("localhost:1:s")
         else:
-            self.default_server = pick_random_server(allowed_protocols=self._allowed_protocols)
+            self.default_server = pick_random_server(allowed_protocols=self._allowed_protocols,
+                                                     server_scores=self.server_scores)
         assert isinstance(self.default_server, ServerAddr), f"invalid type for default_server: {self.default_server!r}"
 
         self.taskgroup = None
@@ -318,9 +450,23 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
 
         dir_path = os.path.join(self.config.path, 'certs')
         util.make_dir(dir_path)
+        # kept across reconnects, to resume TLS sessions
+        self.ssl_context_cache = SSLContextCache()
+        # limits the requests of network jobs in flight to each server
+        self.request_scheduler = RequestScheduler(
+            max_limit=self.config.get('network_max_concurrent_requests', DEFAULT_MAX_CONCURRENT_REQUESTS))
+
+        # raw transactions, shared by all wallets of this datadir
+        self.tx_cache = None  # type: Optional[TxCache]
+        tx_cache_max_size = self.config.get('tx_cache_max_size', DEFAULT_TX_CACHE_MAX_SIZE)
+        if tx_cache_max_size:
+            self.tx_cache = TxCache(os.path.join(self.config.path, 'tx_cache'),
+                                    max_size=tx_cache_max_size)
 
         # the main server we are currently communicating with
         self.interface = None
+        self._main_interface_since = 0  # monotonic time
+        self._last_bad_interface_check = 0
         self.default_server_changed_event = asyncio.Event()
         # Set of servers we have an ongoing connection with.
         # For any ServerAddr, at most one corresponding Interface object
@@ -426,6 +572,12 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
             self.logger.info(f'{self.default_server} is lagging ({sh} vs {lh})')
         return result
 
+    def _record_server_lags(self) -> None:
+        local_height = self.get_local_height()
+        with self.interfaces_lock: interfaces = list(self.interfaces.values())
+        for iface in interfaces:
+            self.server_scores.record_lag(iface.server, local_height - iface.tip)
+
     def _set_status(self, status):
         self.connection_status = status
         self.notify('status')
@@ -507,6 +659,34 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         with self.interfaces_lock:
             return list(self.interfaces)
 
+    def get_rpc_cache_stats(self) -> Dict[str, int]:
+        """Hits and misses of the shared request table, summed over the connected interfaces."""
+        stats = defaultdict(int)
+        with self.interfaces_lock:
+            interfaces = list(self.interfaces.values())
+        for interface in interfaces:
+            if interface.session:
+                for k, v in interface.session.rpc_cache_stats.items():
+                    stats[k] += v
+        return dict(stats)
+
+    def get_rpc_stats(self) -> Dict[str, dict]:
+        """Per-method request statistics of each connected server,
+        and the state of the request scheduler for it."""
+        with self.interfaces_lock:
+            interfaces = list(self.interfaces.values())
+        scheduler_stats = self.request_scheduler.get_stats()
+        return {str(interface.server): {
+                    'methods': interface.session.rpc_stats.to_json(),
+                    'rpc_cache': dict(interface.session.rpc_cache_stats),
+                    'scheduler': scheduler_stats.get(str(interface.server)),
+                }
+                for interface in interfaces if interface.session}
+
+    def dump_rpc_stats(self, path: str) -> None:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.get_rpc_stats(), f, indent=4, sort_keys=True)
+
     def get_fee_estimates(self):
         from statistics import median
         from .simple_config import FEE_ETA_TARGETS
@@ -574,11 +754,14 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
                     continue
                 if not self._can_retry_addr(server, now=now):
                     continue
+                if self.server_scores.is_much_worse(server, recent_servers):
+                    continue
                 return server
-        # try all servers we know about, pick one at random
+        # try all servers we know about, pick one at random,
+        # weighted by score: we keep exploring, but better servers are preferred
         hostmap = self.get_servers()
         servers = list(set(filter_protocol(hostmap, allowed_protocols=self._allowed_protocols)) - connected_servers)
-        random.shuffle(servers)
+        servers = self.server_scores.weighted_shuffle(servers)
         for server in servers:
             if not self._can_retry_addr(server, now=now):
                 continue
@@ -636,17 +819,40 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         if self.default_server in servers:
             servers.remove(self.default_server)
         if servers:
-            await self.switch_to_interface(random.choice(servers))
+            await self.switch_to_interface(self.server_scores.choose_main(servers))
+
+    async def _switch_away_from_bad_interface(self):
+        """If auto_connect, and the main server scores much worse than
+        another connected one on the same chain, switch to a better one.
+        Checked every BAD_MAIN_SERVER_CHECK_INTERVAL seconds, and only once
+        the main server has been so for MIN_MAIN_SERVER_DWELL seconds.
+        """
+        if not self.auto_connect or not self.interface:
+            return
+        now = time.monotonic()
+        if now - self._last_bad_interface_check < BAD_MAIN_SERVER_CHECK_INTERVAL:
+            return
+        self._last_bad_interface_check = now
+        if now - self._main_interface_since < MIN_MAIN_SERVER_DWELL:
+            return
+        with self.interfaces_lock: interfaces = list(self.interfaces.values())
+        others = [iface.server for iface in interfaces
+                  if iface != self.interface and iface.blockchain == self.interface.blockchain]
+        if self.server_scores.is_much_worse(self.interface.server, others, ratio=MAIN_SERVER_SWITCH_RATIO):
+            chosen = self.server_scores.choose_main(others)
+            self.logger.info(f"switching away from badly scoring server {self.interface.server} to {chosen}")
+            await self.switch_to_interface(chosen)
 
     async def switch_lagging_interface(self):
         """If auto_connect and lagging, switch interface (only within fork)."""
+        self._record_server_lags()
         if self.auto_connect and await self._server_is_lagging():
             # switch to one that has the correct header (not height)
             best_header = self.blockchain().header_at_tip()
             with self.interfaces_lock: interfaces = list(self.interfaces.values())
             filtered = list(filter(lambda iface: iface.tip_header == best_header, interfaces))
             if filtered:
-                chosen_iface = random.choice(filtered)
+                chosen_iface = self.server_scores.choose_main(filtered, key=lambda iface: iface.server)
                 await self.switch_to_interface(chosen_iface.server)
 
     async def switch_unwanted_fork_interface(self) -> None:
@@ -671,7 +877,7 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
                         if iface.blockchain == chain]
             if filtered:
                 self.logger.info(f"switching to (more) preferred fork (rank {rank})")
-                chosen_iface = random.choice(filtered)
+                chosen_iface = self.server_scores.choose_main(filtered, key=lambda iface: iface.server)
                 await self.switch_to_interface(chosen_iface.server)
                 return
         self.logger.info("tried to switch to (more) preferred fork but no interfaces are on any")
@@ -702,6 +908,7 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
             assert i.ready.done(), "interface we are switching to is not ready yet"
             blockchain_updated = i.blockchain != self.blockchain()
             self.interface = i
+            self._main_interface_since = time.monotonic()
             await i.taskgroup.spawn(self._request_server_info(i))
             util.trigger_callback('default_server_changed')
             self.default_server_changed_event.set()
@@ -738,6 +945,7 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         self._recent_servers.insert(0, server)
         self._recent_servers = self._recent_servers[:NUM_RECENT_SERVERS]
         self._save_recent_servers()
+        self.server_scores.save()
 
     async def connection_down(self, interface: Interface):
         '''A connection to server either went down, or was never made.
@@ -748,12 +956,29 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         await self._close_interface(interface)
         util.trigger_callback('network_updated')
 
-    def get_network_timeout_seconds(self, request_type=NetworkTimeout.Generic) -> int:
-        if self.oneserver and not self.auto_connect:
+    def get_network_timeout_seconds(self, request_type=NetworkTimeout.Generic, *,
+                                    interface: Interface = None, method: str = None) -> float:
+        """If interface is given, and it has an RTT estimate for method,
+        the timeout adapts to the RTT of the server, up to the usual timeout."""
+        if not self.has_adaptive_timeouts():
             return request_type.MOST_RELAXED
-        if self.proxy:
-            return request_type.RELAXED
-        return request_type.NORMAL
+        max_timeout = request_type.RELAXED if self.proxy else request_type.NORMAL
+        if interface and interface.session:
+            timeout = interface.session.get_adaptive_timeout(method, request_type)
+            if timeout is not None:
+                return min(timeout, max_timeout)
+        return max_timeout
+
+    def has_adaptive_timeouts(self) -> bool:
+        """With a single server, we wait for it as long as it takes."""
+        return not (self.oneserver and not self.auto_connect)
+
+    def get_server_timeouts(self) -> Dict[str, Dict[str, dict]]:
+        """RTT estimates and the resulting timeouts of the connected servers,
+        per RPC method."""
+        with self.interfaces_lock: interfaces = list(self.interfaces.values())
+        return {str(iface.server): iface.session.get_timeout_stats()
+                for iface in interfaces if iface.session}
 
     @ignore_exceptions  # do not kill outer taskgroup
     @log_exceptions
@@ -775,6 +1000,7 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
             await asyncio.wait_for(interface.ready, timeout)
         except BaseException as e:
             self.logger.info(f"couldn't launch iface {server} -- {repr(e)}")
+            self.server_scores.record_request(server, error=True)
             await interface.close()
             return
         else:
@@ -831,7 +1057,11 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
                 assert iface.ready.done(), "interface not ready yet"
                 # try actual request
                 success_fut = asyncio.ensure_future(func(self, *args, **kwargs))
-                await asyncio.wait([success_fut, iface.got_disconnected.wait()], return_when=asyncio.FIRST_COMPLETED)
+                disconnect_fut = asyncio.ensure_future(iface.got_disconnected.wait())
+                try:
+                    await asyncio.wait([success_fut, disconnect_fut], return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    disconnect_fut.cancel()
                 if success_fut.done() and not success_fut.cancelled():
                     if success_fut.exception():
                         try:
@@ -861,15 +1091,38 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
 
     @best_effort_reliable
     @catch_server_exceptions
-    async def get_merkle_for_transaction(self, tx_hash: str, tx_height: int) -> dict:
-        return await self.interface.get_merkle_for_transaction(tx_hash=tx_hash, tx_height=tx_height)
+    async def get_merkle_for_transaction(self, tx_hash: str, tx_height: int, *, batched: bool = False) -> dict:
+        return await self.interface.get_merkle_for_transaction(tx_hash=tx_hash, tx_height=tx_height, batched=batched)
 
     @best_effort_reliable
     async def broadcast_transaction(self, tx: 'Transaction', *, timeout=None) -> None:
+        """Broadcasts tx via the main interface.
+        If the 'broadcast_num_servers' config option is above 1, tx is sent to
+        that many servers concurrently instead; see broadcast_transaction_to_servers.
+        """
+        num_servers = self.config.get('broadcast_num_servers', 1)
+        with self.interfaces_lock:
+            num_interfaces = len(self.interfaces)
+        if num_servers > 1 and num_interfaces > 1:
+            ifaces = self._get_broadcast_interfaces(num_servers)
+            if ifaces:
+                _, errors = await self._broadcast_transaction_to_interfaces(tx, ifaces, timeout=timeout)
+                if errors is None:
+                    return
+                self._raise_broadcast_rejection(errors)
+            # no definite answer: fall back to the main interface, as usual
+        await self._broadcast_transaction_on_interface(self.interface, tx, timeout=timeout)
+
+    @best_effort_reliable
+    async def _broadcast_transaction_to_main_interface(self, tx: 'Transaction', *, timeout=None) -> None:
+        await self._broadcast_transaction_on_interface(self.interface, tx, timeout=timeout)
+
+    async def _broadcast_transaction_on_interface(self, iface: Interface, tx: 'Transaction', *, timeout=None) -> None:
         if timeout is None:
-            timeout = self.get_network_timeout_seconds(NetworkTimeout.Urgent)
+            timeout = self.get_network_timeout_seconds(
+                NetworkTimeout.Urgent, interface=iface, method='blockchain.transaction.broadcast')
         try:
-            out = await self.interface.session.send_request('blockchain.transaction.broadcast', [tx.serialize()], timeout=timeout)
+            out = await iface.session.send_request('blockchain.transaction.broadcast', [tx.serialize()], timeout=timeout)
             # note: both 'out' and exception messages are untrusted input from the server
         except (RequestTimedOut, asyncio.CancelledError, asyncio.TimeoutError):
             raise  # pass-through
@@ -884,6 +1137,106 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
             self.logger.info(f"unexpected txid for broadcast_transaction [DO NOT TRUST THIS MESSAGE]: {out} != {tx.txid()}")
             raise TxBroadcastHashMismatch(_("Server returned unexpected transaction ID."))
 
+    def _get_broadcast_interfaces(self, num_servers: int) -> List[Interface]:
+        """The main interface, and up to num_servers-1 other interfaces
+        following the same chain, better scoring ones being more likely.
+        """
+        main_iface = self.interface
+        if not main_iface:
+            return []
+        with self.interfaces_lock:
+            others = [iface for iface in self.interfaces.values()
+                      if iface is not main_iface and iface.blockchain is main_iface.blockchain]
+        others = self.server_scores.weighted_shuffle(others, key=lambda iface: iface.server)
+        return [main_iface] + others[:num_servers - 1]
+
+    async def broadcast_transaction_to_servers(self, tx: 'Transaction', *, num_servers: int,
+                                               timeout=None) -> Dict[str, str]:
+        """Sends tx to the main interface and up to num_servers-1 other ones concurrently,
+        and returns as soon as one of them accepts it.
+
+        Returns the outcome for each server, as far as known at that point
+        ('pending' for the ones that have not answered yet; their outcome
+        gets logged later). A server answering that it already knows tx counts
+        as accepting it, as it may have got tx from one of the other servers.
+        If no server accepts tx, the rejection of a server is raised in
+        preference to other errors. If no server gave a definite answer,
+        e.g. they all timed out, we fall back to broadcast_transaction's
+        usual retries on the main interface.
+        """
+        ifaces = self._get_broadcast_interfaces(num_servers)
+        if not ifaces:
+            await self._broadcast_transaction_to_main_interface(tx, timeout=timeout)
+            return {str(self.interface.server): 'accepted'} if self.interface else {}
+        outcomes, errors = await self._broadcast_transaction_to_interfaces(tx, ifaces, timeout=timeout)
+        if errors is None:
+            return outcomes
+        self._raise_broadcast_rejection(errors)
+        await self._broadcast_transaction_to_main_interface(tx, timeout=timeout)
+        outcomes[str(self.interface.server)] = 'accepted'
+        return outcomes
+
+    async def _broadcast_transaction_to_interfaces(
+            self, tx: 'Transaction', ifaces: Sequence[Interface], *,
+            timeout=None) -> Tuple[Dict[str, str], Optional[List[BaseException]]]:
+        """Sends tx to ifaces concurrently, until one of them accepts it.
+        Returns the outcome for each server, and unless one accepted tx, their errors.
+        """
+        outcomes = {str(iface.server): 'pending' for iface in ifaces}
+        futs = {asyncio.ensure_future(self._broadcast_transaction_on_interface(iface, tx, timeout=timeout)): iface
+                for iface in ifaces}
+
+        def on_done(fut):
+            iface = futs[fut]
+            outcomes[str(iface.server)] = outcome = self._get_broadcast_outcome(fut)
+            if outcome == 'hash mismatch':
+                self.server_scores.record_request(iface.server, error=True)
+            self.logger.info(f"broadcast of {tx.txid()} to {iface.server}: {outcome}")
+
+        for fut in futs:
+            fut.add_done_callback(on_done)
+        pending = set(futs)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for fut in done:
+                    outcomes[str(futs[fut].server)] = self._get_broadcast_outcome(fut)
+                if any(self._get_broadcast_outcome(fut) in ('accepted', 'already known') for fut in done):
+                    return dict(outcomes), None
+        except asyncio.CancelledError:
+            for fut in pending:
+                fut.cancel()
+            raise
+        errors = [fut.exception() for fut in futs if not fut.cancelled()]
+        return dict(outcomes), errors
+
+    @staticmethod
+    def _raise_broadcast_rejection(errors: Sequence[BaseException]) -> None:
+        """Raises the most definite of errors, if any was not just a timeout.
+        A rejection by a server is raised in preference to other errors.
+        """
+        for error_type in (TxBroadcastServerReturnedError, TxBroadcastHashMismatch, TxBroadcastUnknownError):
+            for e in errors:
+                if isinstance(e, error_type):
+                    raise e
+
+    @staticmethod
+    def _get_broadcast_outcome(fut: asyncio.Future) -> str:
+        if fut.cancelled():
+            return 'cancelled'
+        e = fut.exception()
+        if e is None:
+            return 'accepted'
+        if isinstance(e, TxBroadcastServerReturnedError):
+            if str(e) in TX_ALREADY_KNOWN_MESSAGES:
+                return 'already known'
+            return f'rejected: {e}'
+        if isinstance(e, TxBroadcastHashMismatch):
+            return 'hash mismatch'
+        if isinstance(e, (RequestTimedOut, asyncio.TimeoutError)):
+            return 'timed out'
+        return 'error'
+
     async def try_broadcasting(self, tx, name):
         try:
             await self.broadcast_transaction(tx)
@@ -1036,15 +1389,52 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
     async def request_chunk(self, height: int, tip=None, *, can_return_early=False):
         return await self.interface.request_chunk(height, tip=tip, can_return_early=can_return_early)
 
+    async def download_header_chunks(self, interface: Interface, height: int, tip: int) -> Tuple[int, bool]:
+        """Downloads and connects the header chunks from height to tip for interface,
+        using all connected servers. Returns the height after the last connected header,
+        and whether the chunks of interface itself could be connected up to there.
+        """
+        return await HeaderChunkScheduler(self, interface).run(height, tip)
+
+    async def get_transaction(self, tx_hash: str, *, timeout=None, batched: bool = False) -> str:
+        raw_tx = await self.get_cached_transaction(tx_hash)
+        if raw_tx is None:
+            raw_tx = await self._get_transaction_from_server(tx_hash, timeout=timeout, batched=batched)
+            await self.cache_transaction(tx_hash, raw_tx)
+        return raw_tx
+
     @best_effort_reliable
     @catch_server_exceptions
-    async def get_transaction(self, tx_hash: str, *, timeout=None) -> str:
-        return await self.interface.get_transaction(tx_hash=tx_hash, timeout=timeout)
+    async def _get_transaction_from_server(self, tx_hash: str, *, timeout=None, batched: bool = False) -> str:
+        return await self.interface.get_transaction(tx_hash=tx_hash, timeout=timeout, batched=batched)
+
+    async def get_cached_transaction(self, tx_hash: str) -> Optional[str]:
+        """Returns the raw tx from the tx cache, or None.
+        The txid of the cached tx is verified.
+        """
+        if self.tx_cache is None or not is_hash256_str(tx_hash):
+            return None
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(None, self.tx_cache.get_raw_tx, tx_hash)
+        except sqlite3.Error as e:
+            self.logger.warning(f"cannot read from tx cache: {repr(e)}")
+            return None
+
+    async def cache_transaction(self, tx_hash: str, raw_tx: str) -> None:
+        """Adds a raw tx, whose txid has been verified, to the tx cache."""
+        if self.tx_cache is None:
+            return
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, self.tx_cache.add_raw_tx, tx_hash, raw_tx)
+        except sqlite3.Error as e:
+            self.logger.warning(f"cannot write to tx cache: {repr(e)}")
 
     @best_effort_reliable
     @catch_server_exceptions
-    async def get_history_for_scripthash(self, sh: str) -> List[dict]:
-        return await self.interface.get_history_for_scripthash(sh)
+    async def get_history_for_scripthash(self, sh: str, *, batched: bool = False) -> List[dict]:
+        return await self.interface.get_history_for_scripthash(sh, batched=batched)
 
     @best_effort_reliable
     @catch_server_exceptions
@@ -1155,6 +1545,8 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
                 # will NOT raise, and the group will keep the other tasks running
                 async with taskgroup as group:
                     await group.spawn(self._maintain_sessions())
+                    await group.spawn(self._maintain_headers_files())
+                    await group.spawn(self._verify_deferred_pow())
                     [await group.spawn(job) for job in self._jobs]
             except asyncio.CancelledError:
                 raise
@@ -1187,8 +1579,11 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         self.interfaces = {}
         self._connecting_ifaces.clear()
         self._closing_ifaces.clear()
+        self.server_scores.save()
         if not full_shutdown:
             util.trigger_callback('network_updated')
+        else:
+            blockchain.shutdown_pow_executor()
 
     def stop(self):
         assert self._loop_thread != threading.current_thread(), 'must not be called from network thread'
@@ -1196,6 +1591,8 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         try:
             fut.result(timeout=2)
         except (concurrent.futures.TimeoutError, concurrent.futures.CancelledError): pass
+        if self.tx_cache is not None:
+            self.tx_cache.flush()
 
     async def _ensure_there_is_a_main_interface(self):
         if self.is_connected():
@@ -1226,6 +1623,7 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
                     await self._close_interface(iface)
         async def maintain_main_interface():
             await self._ensure_there_is_a_main_interface()
+            await self._switch_away_from_bad_interface()
             if self.is_connected():
                 if self.config.is_fee_estimates_update_required():
                     await self.interface.taskgroup.spawn(self._request_fee_estimates, self.interface)
@@ -1242,6 +1640,33 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
                     raise
             await asyncio.sleep(0.1)
 
+    async def _maintain_headers_files(self):
+        # forks that swapped with their parents still read headers from each
+        # other's files; rewrite them in the background, off the network thread
+        while True:
+            await asyncio.sleep(60)
+            if blockchain.needs_compaction():
+                await aiorpcx.run_in_thread(blockchain.compact_chains)
+
+    async def _verify_deferred_pow(self):
+        verifier = self.pow_verifier
+        while True:
+            if not verifier.has_work():
+                await asyncio.sleep(10)
+                continue
+            changed_chains = await aiorpcx.run_in_thread(verifier.verify_next_chunk)
+            if changed_chains:
+                # whoever served those headers cannot be trusted;
+                # they get fully verified when we reconnect
+                with self.interfaces_lock: interfaces = list(self.interfaces.values())
+                for iface in interfaces:
+                    if iface.blockchain in changed_chains:
+                        await self._close_interface(iface)
+                util.trigger_callback('blockchain_updated')
+                util.trigger_callback('network_updated')
+            # low priority: leave the thread pool and CPU to everything else in between
+            await asyncio.sleep(1)
+
     @classmethod
     async def _send_http_on_proxy(cls, method: str, url: str, params: str = None,
                                   body: bytes = None, json: dict = None, headers=None,
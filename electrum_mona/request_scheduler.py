@@ -0,0 +1,213 @@
+"""Bounded concurrency for the requests of network jobs.
+
+Each server gets a limit on the number of requests in flight. Jobs wait
+for a slot before sending a request, and get slots in order of priority:
+headers first, then merkle proofs, then address histories, then
+transactions. Producers of many requests, e.g. the Synchronizer when
+restoring a wallet, use spawn(), which waits for a slot before even
+creating the task, so that they cannot run ahead of the server.
+
+Slots are released as soon as the response is in, not when the job is
+done, so that jobs waiting for something else (e.g. SPV waiting for
+header sync) cannot starve the requests they are waiting for.
+
+The limits adapt to the server, the way TCP adapts its window: requests
+being answered raise the limit, quickly until the server first shows
+signs of overload, and slowly from then on. A request timing out or the
+server saying it is busy halves it (at most once per round of requests).
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from enum import IntEnum
+from typing import Dict, List, Tuple, Optional, Callable, Awaitable, TYPE_CHECKING
+
+from aiorpcx.curio import TaskTimeout
+from aiorpcx.jsonrpc import CodeMessageError, JSONRPC
+
+from .logging import Logger
+
+if TYPE_CHECKING:
+    from .interface import ServerAddr
+
+
+class JobPriority(IntEnum):
+    HEADERS = 0
+    PROOFS = 1
+    HISTORY = 2
+    TX = 3
+
+
+INITIAL_LIMIT = 32
+MIN_LIMIT = 4
+DEFAULT_MAX_LIMIT = 256
+
+
+def _get_cause(e: Optional[BaseException], exc_types) -> Optional[BaseException]:
+    """The exception of exc_types that caused e, if any (e.g. RequestTimedOut is raised from timeouts)."""
+    while e is not None:
+        if isinstance(e, exc_types):
+            return e
+        e = e.__cause__
+    return None
+
+
+def _get_server_error(e: Optional[BaseException]) -> Optional[CodeMessageError]:
+    """The error returned by the server, if it caused e."""
+    return _get_cause(e, CodeMessageError)
+
+
+def is_congestion_error(e: Optional[BaseException]) -> bool:
+    """Whether e means that the server is overloaded, or throttling us."""
+    if _get_cause(e, (TaskTimeout, asyncio.TimeoutError)) is not None:
+        return True
+    server_error = _get_server_error(e)
+    return (server_error is not None
+            and server_error.code in (JSONRPC.EXCESSIVE_RESOURCE_USAGE, JSONRPC.SERVER_BUSY))
+
+
+class _ServerState:
+
+    def __init__(self, max_limit: int):
+        self.limit = float(min(INITIAL_LIMIT, max_limit))
+        self.max_limit = max_limit
+        self.in_flight = 0
+        self.waiters = []  # type: List[Tuple[int, int, asyncio.Future]]  # heap
+        self.last_decrease = 0.0
+        self.num_decreases = 0
+
+    def can_start(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+
+class RequestSlot:
+    """Permission to have one request in flight to a server.
+    Use as an async context manager, which acquires the slot unless that
+    was done already, and releases it on exit.
+    """
+
+    def __init__(self, scheduler: 'RequestScheduler', server: 'ServerAddr', priority: JobPriority):
+        self.scheduler = scheduler
+        self.server = server
+        self.priority = priority
+        self.start_time = None  # type: Optional[float]
+        self._released = False
+
+    @property
+    def acquired(self) -> bool:
+        return self.start_time is not None
+
+    async def acquire(self) -> 'RequestSlot':
+        assert not self.acquired
+        await self.scheduler._acquire(self.server, self.priority)
+        self.start_time = time.monotonic()
+        return self
+
+    def release(self, *, error: BaseException = None) -> None:
+        if not self.acquired or self._released:
+            return
+        self._released = True
+        self.scheduler._release(self, error=error)
+
+    async def __aenter__(self) -> 'RequestSlot':
+        if not self.acquired:
+            await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release(error=exc)
+
+
+class RequestScheduler(Logger):
+
+    def __init__(self, *, max_limit: int = DEFAULT_MAX_LIMIT):
+        Logger.__init__(self)
+        self.max_limit = max(MIN_LIMIT, max_limit)
+        self._servers = {}  # type: Dict[ServerAddr, _ServerState]
+        self._counter = itertools.count()
+
+    def _get_state(self, server: 'ServerAddr') -> _ServerState:
+        state = self._servers.get(server)
+        if state is None:
+            state = self._servers[server] = _ServerState(self.max_limit)
+        return state
+
+    def slot(self, server: 'ServerAddr', priority: JobPriority) -> RequestSlot:
+        return RequestSlot(self, server, priority)
+
+    async def spawn(self, group, server: 'ServerAddr', priority: JobPriority,
+                    func: Callable[..., Awaitable], *args) -> asyncio.Task:
+        """Waits for a slot, then spawns func(*args, slot=slot) in group.
+        func should release the slot as soon as it got its response, e.g. by
+        making the request within 'async with slot'. Failing that, the slot
+        is released when the task is done.
+        """
+        slot = self.slot(server, priority)
+        await slot.acquire()
+        try:
+            task = await group.spawn(func(*args, slot=slot))
+        except BaseException:
+            slot.release()
+            raise
+
+        def on_done(task):
+            slot.release(error=None if task.cancelled() else task.exception())
+        task.add_done_callback(on_done)
+        return task
+
+    async def _acquire(self, server: 'ServerAddr', priority: JobPriority) -> None:
+        state = self._get_state(server)
+        while state.waiters and state.waiters[0][2].done():  # cancelled
+            heapq.heappop(state.waiters)
+        # do not overtake jobs of the same or a higher priority that are already waiting
+        if state.can_start() and not (state.waiters and state.waiters[0][0] <= priority):
+            state.in_flight += 1
+            return
+        fut = asyncio.get_event_loop().create_future()
+        heapq.heappush(state.waiters, (int(priority), next(self._counter), fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # we were given the slot just as we got cancelled
+                state.in_flight -= 1
+                self._wake(state)
+            raise
+
+    def _release(self, slot: RequestSlot, *, error: Optional[BaseException]) -> None:
+        state = self._get_state(slot.server)
+        state.in_flight -= 1
+        if is_congestion_error(error):
+            # decrease once per round: not again for the requests that were
+            # already in flight when we last decreased
+            if slot.start_time >= state.last_decrease:
+                state.limit = max(MIN_LIMIT, state.limit / 2)
+                state.last_decrease = time.monotonic()
+                state.num_decreases += 1
+                self.logger.info(f"{slot.server} seems overloaded ({error!r}); "
+                                 f"limiting it to {int(state.limit)} requests in flight")
+        elif error is None or _get_server_error(error) is not None:
+            # the server answered. until it first shows signs of overload,
+            # the limit doubles with each round (slow start), then grows by one
+            increase = 1 if state.num_decreases == 0 else 1 / state.limit
+            state.limit = min(state.max_limit, state.limit + increase)
+        self._wake(state)
+
+    def _wake(self, state: _ServerState) -> None:
+        while state.waiters and state.can_start():
+            priority, _, fut = heapq.heappop(state.waiters)
+            if fut.done():  # cancelled
+                continue
+            state.in_flight += 1
+            fut.set_result(None)
+
+    def get_stats(self) -> Dict[str, dict]:
+        return {str(server): {
+                    'limit': int(state.limit),
+                    'in_flight': state.in_flight,
+                    'waiting': sum(1 for _, _, fut in state.waiters if not fut.done()),
+                    'num_decreases': state.num_decreases,
+                }
+                for server, state in self._servers.items()}
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+
+# Benchmarks the header pipeline on a throwaway data directory, without network:
+# parsing, proof of work per algorithm, verify_chunk, header reads, DGWv3,
+# fork creation and swaps, and connect_chunk end to end.
+# Prints the results as JSON, so that they can be compared between releases.
+#
+# usage: header_benchmark.py [--chunks N] [--repeat N] [--pow-headers N] [--output FILE]
+#                            [--headers FILE --first-height HEIGHT]
+#
+# Synthetic headers do not have valid proof of work. Where it matters, their
+# hashes are checked against the maximum target, which costs the same.
+# --headers takes recorded raw headers, e.g. a copy of a blockchain_headers
+# file, and runs the read-only benchmarks on them with their real targets.
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from unittest import mock
+
+from electrum_mona import blockchain, constants
+from electrum_mona.blockchain import (Blockchain, DGWv3Calculator, HeaderBatch, PowJob, HEADER_SIZE,
+                                      LYRA2REV2_HEIGHT, MAX_TARGET, deserialize_header, verify_pow_batch)
+from electrum_mona.crypto import sha256d
+from electrum_mona.scrypt import HAS_HASHLIB_SCRYPT
+from electrum_mona.simple_config import SimpleConfig
+from electrum_mona.util import make_dir
+from electrum_mona.version import ELECTRUM_VERSION
+
+
+# mainnet headers 2206513 to 2206543
+RECORDED_FIRST_HEIGHT = 2206513
+RECORDED_HEADERS = (
+    '000000207fb365a400a97906b88669510c25c3e0c5bb79f8a50510db23c8f1468acff9797dd4e80d9ea183144049ac22f5f44a5cb9979a578c535c54e2f213d898476fdf2a2dee5f0010061ab1886c83',
+    '00000020fbb2e1f644acf17f9a7d214cc42dd8ca09a5f5e9e10b4951b2b3bf9940faa9a3d7f09cfb702370183926879741f47d4f89cd4fc4bfd5f9d3e44d58666bbba9065e2dee5f4460061a7689aa13',
+    '00000020f736f8539fce0ea0fb3d7f29e06e6fc7ea7f270b34c0971a6d4180ead30b9b1086836dd8bad367fad73f5bd22dc875b9d625c594f52f220276c4d4008007b471d92dee5fc37c061a91ef8456',
+    '00000020d474736de4e60c5309e98275c4ccfaf6d706dc72a6ee7cee02818e8b77edb81f04ab1cf7c45c207e6f61f0f59a0665958cb3cac6b86b0a787a54eaa391677957ea2dee5f465d061a368eba96',
+    '0000002037a6fca5f587aa59e4f40baad58a947e56ce922e2ea9e6195f4a47682b9d385d4b4a50e1408b932684b64782732a79868afb9b78d5cb4bfe755ea915c297bc5c822eee5f8c1a061a60a3acbe',
+    '000000206c3dcdb240b346be9e9d3bf6900104de9dc091893bbcc5b2fc3220d6425981842c613492aa3f18383cfddeffef38a7eb30ba416dad31232abcf5bf17cb13dac0be2fee5f057a061a872a0761',
+    '000000208bee22580a76a91cffa53c4f250f162518735ecb0152a96f1c721adf91c15cc44df559ea414c9daee634171d2b60a337da6a0e2f5c9d33924250127a170a8637d62fee5f3a78061aa2b5419d',
+    '000000203ef61f12917c1af347a7d7ad4553c327b1073e322315bfd0aae4e1270946f2ada664668fbf2a4e738c3124d135a7080e05e7d3e34dfa2a5959920c7c8d107091d530ee5f83a0051a251520d8',
+    '00000020caee99dd2d8045e7a9985c135c3c73ec244fa987799001923fb191afdb5317a29ea0585c7b1f1cfeb63e7adba380ef9c7825faec064afc4dccdffd982c0efc145131ee5f675b061a2f6341e9',
+    '000000208df63c3e973b6a4e4e7fee99fdaa3dc8c0566af8ce59435bf79d07ca4da415c0d070aafaf3cf9630dfdc4085765e87ff7da34b9399e7f8731731228588ff6f848c31ee5ff074061a43ceb091',
+    '00000020d5a8cac7a71e7c8c4fdeb673eed776d6df87d6bfb211cefc8d2e305774c5684adfc25d39c061f65d190cd214cfe87f650fe15e754865a7d0a00fe6a3025a9df8b531ee5f8e7b061a2f92ed46',
+    '000000200420e37a89304b205511ee235cf8f997f9f8f0767961ab27f459308a304ffbf8dcde76a62aba4714c4294d3dfb3227ee9ef56564d54f52e165a0675534e94d1dc531ee5f665e061a21f3ffd7',
+    '0000002015cd042f42aadf2104a3046cb735437fe4f285474f1917bbbcba8fecdb7a391a340aeec300126199be45119b2882db6ec77f67d9f91544927ecb902cc99b8a42d531ee5fd53e061a4581b625',
+    '00000020b45a0288aa952d981d996e3f3fc8d6f316b2503dbb5c6191bb01a6dfe875dce323bd30c4224c51514de0b1866ef2a6b86711a18dcf4f674c696f9189e9816f836d32ee5f6e14061a7e8ffe7e',
+    '00000020cfea05600ac01e84be68a344a8c3ee788e6f894d219d68cd6716056228ff0e241ed0f4871c3f1ed39d312315c3f6940dc6f57b4c6c874b2ac5ba5fea6153681cb032ee5f634f061aa37ffac7',
+    '000000209cb778de8812dbec7152ca5f72d2e6f8cb8d9210780b5236e1749525525bcf170755f5d4885d63a1f26659e7cc9c0241d2186b9d3da268d1b997d375cb7834e5d132ee5f7b53061a0767ad90',
+    '00000020b0709f38978be208fcb52f8b6064899463c0e0bdd879b72877cd92b75eb3cece562f9cd0b5bcf6f81ff1246ef1609313f9faf428c23c03fa048cd666c024e700dc32ee5f473f061a44dfba00',
+    '00000020c1c93b740b2a28c9e3a0145898e1b558cbb51ff54afae6890369a9661db8be9f3106f874b686ee294df1b4d362f0098ed96aeba2143f5785c4fff029f7550a904134ee5f7126061a11f598b9',
+    '00000020eabcf3b6ccc111a9ae099960bd4e9ede4ce5e1d75412a339286970ec6c2be383d5d1ba5e826ee1ce5f32718b05b5999d6d54c939af08ddd600ce0708fbae53875f34ee5f0bcb061a65eb77f0',
+    '0000002048a198039841c4f7c69d6d959b39539e64fedd707a79c85aec57cc708abe7249ad8c8cfa1ce7cb6a44263f0d73315edf94531fbbad0c4c32be13aef0cb36a0fb8a34ee5f2ac7061ab5d12aee',
+    '0000002045bea42689e1c573db7e01deee59f638a92854f11e6f69ca67f38fec237082eee7a9f7cc8c5c9d17e4f6c2ca6aeeb5ea8cba5698767c8ef9c01b245ec6f5773a1f35ee5fc55d061a32bb0eb5',
+    '00000020a5e4c4e47a682437ed6c9f7bc843b014eae7dc23bfd354f7f630fc3694bacb1ee0b67f3fdfbe71265c395cfd7920a26fc3366a9d25686cbd2f8dc539e68052b3a035ee5feea8061a546c0322',
+    '00000020b75bd1ef557fc262aedf7a3069791cb2625536bf26726443508d2a563847244f0069e11def84296e242e7bf3dcef1ac7e109f0fc45ada1ee2dcd02fc4d1d5d9a0f36ee5fcc05071aa65a47bf',
+    '000000205bc8f48d410415b7ffdc9abda523c99d8a0225331865d6be79ca924391f458847fd1c0628abe6dfbab77fc7e46c54112a0c0808db1e4a364a805af4edcb1a0c81c36ee5fcb2e071a865ce75c',
+    '0000002046b77b1ddd642cc3d07df344e729c56ca07ae10d41c6b5e6c47423de6f1e0e95708cc0ac853c92f9d551429b30a0c33c942c18f02da6353d89f3cd09dc9fd8ae4237ee5f9cd3061a198bc161',
+    '00000020b9d0462928a662540b731e6190ef2770eae3c774e14576565fd1b07add9fbc289b672597edf45461bac1235dec0e813d2745ed3c8f932c619819361d3963a3727137ee5f3091071a9bc4ceef',
+    '000000208f171f63660d9b7f63a6d19611ebf6cf6d6a12582702557303bf7615128e557ac8830dc8a0447c8eed3f49596d8f44fba5938eaec0545b2fc6330af2858450b5d837ee5f886d071a1208132c',
+    '0000002032fee79316fc6ae34d5c9b5284bac8b7629f1f9254cc25fc7a432a496afd8f9187989bb4ec311a6d35cd8287821fbcf24b9689673bc06fd81e5eea55dbafaed5f537ee5fc6b9071a3aeefe70',
+    '000000205254517d8e827c5a60e2199b86d74eebb2506010b065011037f8c2ced15c75023f6d9511c0ba2adc501bf7add7ff8b28269111b3fbb624d3fd86d9689242e01c1f38ee5f1a6d071a0bc828a6',
+    '00000020beb3802b7de464f0fe97e3b452bf2429ffddf88933d3b43aaec3fe035a4927d241d13f4af03ff648328423d77224b99088994aff5a0c09800c03cd170f539ce54c38ee5f2aa0061a2fc4bfd8',
+    '00000020f3332e27c4a8b90bd14c1698409817f13578ccac32b573baa39220b28146593049d5cccf3174568002acb29158b70311cc3e8a3a10a1479df637907c4a5aad666d38ee5f15aa061a09a4b432',
+)
+
+ANY_TARGET = 2 ** 256 - 1
+
+
+class Results:
+
+    def __init__(self):
+        self.results = {}
+
+    def add(self, name: str, seconds: float, count: int, unit: str = 'headers'):
+        self.results[name] = {
+            'count': count,
+            'unit': unit,
+            'seconds': round(seconds, 6),
+            'per_second': round(count / seconds, 1) if seconds > 0 else None,
+            'us_per_item': round(seconds / count * 1e6, 3) if count else None,
+        }
+        print(f"{name:>36}: {count / seconds:12.1f} {unit}/s ({seconds:.3f} s)", file=sys.stderr)
+
+    def add_error(self, name: str, e: Exception):
+        self.results[name] = {'error': repr(e)}
+        print(f"{name:>36}: failed: {e!r}", file=sys.stderr)
+
+
+def timed(func, *args, **kwargs) -> float:
+    t0 = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - t0
+
+
+class SyntheticChain:
+    """Generates headers after the last checkpoint that pass every check of
+    verify_chunk except the proof of work: they link up, and their bits are
+    what DGWv3 expects.
+    """
+
+    def __init__(self, rnd: random.Random):
+        self.rnd = rnd
+        self.height = constants.net.max_checkpoint()
+        self.prev_hash = bytes.fromhex(constants.net.CHECKPOINTS[-1][0])[::-1]
+        self.timestamp = 1609447533
+        self.dgw = DGWv3Calculator()
+        self.first_bits = Blockchain.target_to_bits(constants.net.CHECKPOINTS[-1][1])
+
+    def _random_bytes(self, n: int) -> bytes:
+        return bytes(self.rnd.getrandbits(8) for _ in range(n))
+
+    def next_headers(self, count: int) -> bytes:
+        headers = []
+        for i in range(count):
+            self.height += 1
+            target = self.dgw.get_target(self.height)
+            bits = Blockchain.target_to_bits(target) if target else self.first_bits
+            self.timestamp += self.rnd.randint(30, 150)
+            raw_header = (0x20000000.to_bytes(4, 'little') + self.prev_hash + self._random_bytes(32)
+                          + self.timestamp.to_bytes(4, 'little') + bits.to_bytes(4, 'little')
+                          + self._random_bytes(4))
+            headers.append(raw_header)
+            self.dgw.append(self.height, bits, self.timestamp)
+            self.prev_hash = sha256d(raw_header)
+        return b''.join(headers)
+
+
+def new_best_chain(config: SimpleConfig) -> Blockchain:
+    blockchain.blockchains = {}
+    chain = Blockchain(config=config, forkpoint=0, parent=None,
+                       forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+    blockchain.blockchains[constants.net.GENESIS] = chain
+    # the checkpoint region is not stored, so a sparse file will do
+    with open(chain.path(), 'wb') as f:
+        f.truncate((constants.net.max_checkpoint() + 1) * HEADER_SIZE)
+    chain.update_size()
+    return chain
+
+
+def pow_jobs_at(raw_headers: bytes, first_height: int, targets=None):
+    count = len(raw_headers) // HEADER_SIZE
+    return [PowJob(raw_headers[i*HEADER_SIZE:(i+1)*HEADER_SIZE], first_height + i,
+                   targets[i] if targets else ANY_TARGET)
+            for i in range(count)]
+
+
+def bench_parsing(results: Results, name: str, data: bytes, first_height: int, repeat: int):
+    count = len(data) // HEADER_SIZE
+    def parse_dicts():
+        for i in range(count):
+            deserialize_header(data[i*HEADER_SIZE:(i+1)*HEADER_SIZE], first_height + i)
+    def parse_batch():
+        batch = HeaderBatch(data, first_height)
+        batch.bits.tolist(), batch.timestamp.tolist()
+        batch.hashes()
+    results.add(f'{name}.deserialize_header', sum(timed(parse_dicts) for i in range(repeat)), count * repeat)
+    results.add(f'{name}.header_batch', sum(timed(parse_batch) for i in range(repeat)), count * repeat)
+
+
+def bench_pow(results: Results, name: str, data: bytes, num_headers: int, targets=None, heights=None):
+    data = data[:num_headers * HEADER_SIZE]
+    count = len(data) // HEADER_SIZE
+    if heights is None:
+        heights = {'scrypt': LYRA2REV2_HEIGHT - count, 'lyra2rev2': LYRA2REV2_HEIGHT}
+    for algo, first_height in heights.items():
+        jobs = pow_jobs_at(data, first_height, targets)
+        try:
+            results.add(f'{name}.{algo}', timed(verify_pow_batch, jobs), count)
+        except Exception as e:
+            results.add_error(f'{name}.{algo}', e)
+
+
+def bench_dgw(results: Results, name: str, batch: HeaderBatch, chain: Blockchain = None):
+    bits, timestamps = batch.bits.tolist(), batch.timestamp.tolist()
+    start = batch.start_height
+    def sliding_window():
+        dgw = DGWv3Calculator()
+        for i in range(len(batch)):
+            height = start + i
+            if dgw.is_ready(height):
+                target = dgw.get_target(height)
+                if chain is None and Blockchain.target_to_bits(target) != bits[i]:
+                    raise Exception(f"DGWv3 target mismatch at height {height}")
+            dgw.append(height, bits[i], timestamps[i])
+    results.add(f'{name}.dgwv3_window', timed(sliding_window), len(batch))
+    if chain is not None:
+        heights = range(start + DGWv3Calculator.PAST_BLOCKS + 1, start + len(batch))
+        def get_target_dgwv3():
+            for height in heights:
+                chain.get_target_dgwv3(height)
+        results.add(f'{name}.get_target_dgwv3', timed(get_target_dgwv3), len(heights))
+
+
+def bench_reads(results: Results, chain: Blockchain, first_height: int, rnd: random.Random, num_reads: int):
+    heights = [rnd.randint(first_height, chain.height()) for i in range(num_reads)]
+    def read(func):
+        for height in heights:
+            func(height)
+    results.add('read.read_raw_header', timed(read, chain.read_raw_header), num_reads, 'calls')
+    results.add('read.read_header', timed(read, chain.read_header), num_reads, 'calls')
+    results.add('read.get_hash', timed(read, chain.get_hash), num_reads, 'calls')
+    hashes = [(height, chain.get_hash(height)) for height in heights]
+    def check_hashes():
+        for height, header_hash in hashes:
+            chain.check_hash(height, header_hash)
+    results.add('read.check_hash', timed(check_hashes), num_reads, 'calls')
+    chunk_starts = [rnd.randint(first_height, chain.height() - 2015) for i in range(20)]
+    def read_batches():
+        for height in chunk_starts:
+            chain.read_header_batch(height, 2016)
+    results.add('read.read_header_batch', timed(read_batches), len(chunk_starts) * 2016)
+
+
+def bench_verify_chunk(results: Results, chain: Blockchain, index: int, data: bytes, repeat: int):
+    count = len(data) // HEADER_SIZE
+    results.add('verify_chunk.without_pow', sum(timed(chain.verify_chunk_without_pow, index, data)
+                                                for i in range(repeat)), count * repeat)
+    for algo, first_height in (('scrypt', LYRA2REV2_HEIGHT - count), ('lyra2rev2', LYRA2REV2_HEIGHT)):
+        # the real targets are out of reach for synthetic headers; hash them all the same
+        def verify_chunk():
+            jobs = chain.verify_chunk_without_pow(index, data)
+            verify_pow_batch([PowJob(job.raw_header, first_height + job.height - index * 2016, ANY_TARGET)
+                              for job in jobs])
+        try:
+            results.add(f'verify_chunk.{algo}', timed(verify_chunk), count)
+        except Exception as e:
+            results.add_error(f'verify_chunk.{algo}', e)
+
+
+def bench_connect_chunk(results: Results, chain: Blockchain, index: int, data: bytes, repeat: int):
+    hexdata = data.hex()
+    offset = (index * 2016 - chain.forkpoint) * HEADER_SIZE
+    seconds = 0
+    for i in range(repeat):
+        if i > 0:
+            chain.write(b'', offset)  # drop it again
+        seconds += timed(chain.connect_chunk, index, hexdata)
+        if chain.height() != index * 2016 + len(data) // HEADER_SIZE - 1:
+            raise Exception("connect_chunk failed")
+    results.add('connect_chunk.deferred_pow', seconds, repeat * len(data) // HEADER_SIZE)
+
+
+def bench_forks(results: Results, synthetic: SyntheticChain, repeat: int):
+    # fork() checks the proof of work of the forking header, which synthetic
+    # headers do not have. the cost of hashing one header is in pow.*
+    with mock.patch.object(blockchain, 'verify_pow_batch', lambda jobs: None):
+        _bench_forks(results, synthetic, repeat)
+
+
+def _bench_forks(results: Results, synthetic: SyntheticChain, repeat: int):
+    fork_seconds = swap_seconds = 0
+    for i in range(repeat):
+        chain = blockchain.get_best_chain()
+        forkpoint = chain.height() - 5
+        gen = SyntheticChain(synthetic.rnd)
+        gen.height, gen.prev_hash = forkpoint - 1, bytes.fromhex(chain.get_hash(forkpoint - 1))[::-1]
+        gen.dgw.seed(chain, forkpoint)
+        data = gen.next_headers(7)
+        t0 = time.perf_counter()
+        fork = chain.fork(deserialize_header(data[:HEADER_SIZE], forkpoint))
+        fork_seconds += time.perf_counter() - t0
+        fork.write(data[HEADER_SIZE:], HEADER_SIZE)
+        t0 = time.perf_counter()
+        fork.swap_with_parent()
+        swap_seconds += time.perf_counter() - t0
+        if blockchain.get_best_chain() is not fork:
+            raise Exception("fork did not swap with its parent")
+    results.add('fork.create', fork_seconds, repeat, 'forks')
+    results.add('fork.swap_with_parent', swap_seconds, repeat, 'swaps')
+    results.add('fork.compact_chains', timed(blockchain.compact_chains), len(blockchain.blockchains), 'chains')
+
+
+def run_synthetic(results: Results, args, rnd: random.Random):
+    tmp_dir = tempfile.mkdtemp(prefix='header_benchmark_')
+    try:
+        make_dir(os.path.join(tmp_dir, 'forks'))
+        config = SimpleConfig({'electrum_path': tmp_dir, 'deferred_pow_verification': True})
+        chain = new_best_chain(config)
+        synthetic = SyntheticChain(rnd)
+        first_index = len(constants.net.CHECKPOINTS)
+        chunks = [synthetic.next_headers(2016) for i in range(max(args.chunks, 2))]
+        chain.write(chunks[0], chain.size() * HEADER_SIZE)
+
+        bench_parsing(results, 'parse', chunks[1], (first_index + 1) * 2016, args.repeat)
+        bench_pow(results, 'pow', chunks[1], args.pow_headers)
+        bench_verify_chunk(results, chain, first_index + 1, chunks[1], args.repeat)
+        bench_connect_chunk(results, chain, first_index + 1, chunks[1], args.repeat)
+        for data in chunks[2:]:
+            chain.write(data, chain.size() * HEADER_SIZE)
+        bench_reads(results, chain, first_index * 2016, rnd, args.reads)
+        bench_dgw(results, 'dgw', chain.read_header_batch(first_index * 2016, len(chunks) * 2016), chain)
+        bench_forks(results, synthetic, args.repeat)
+    finally:
+        for chain in blockchain.blockchains.values():
+            chain.close_header_store()
+        blockchain.blockchains = {}
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def run_recorded(results: Results, name: str, data: bytes, first_height: int, args):
+    batch = HeaderBatch(data, first_height)
+    bench_parsing(results, f'{name}.parse', data, first_height, args.repeat)
+    try:
+        bench_dgw(results, f'{name}.dgw', batch)
+    except Exception as e:
+        results.add_error(f'{name}.dgw.dgwv3_window', e)
+    targets = [Blockchain.bits_to_target(bits) for bits in batch.bits.tolist()]
+    algo = 'lyra2rev2' if first_height >= LYRA2REV2_HEIGHT else 'scrypt'
+    # real headers must pass with their real targets
+    bench_pow(results, f'{name}.pow', data, args.pow_headers, targets, heights={algo: first_height})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the block header pipeline.")
+    parser.add_argument('--chunks', type=int, default=4, help="number of synthetic chunks")
+    parser.add_argument('--repeat', type=int, default=3, help="repetitions of the cheaper benchmarks")
+    parser.add_argument('--reads', type=int, default=20000, help="number of random header reads")
+    parser.add_argument('--pow-headers', type=int, default=500, help="number of headers hashed per algorithm")
+    parser.add_argument('--headers', help="file with recorded raw headers")
+    parser.add_argument('--first-height', type=int, help="height of the first header in --headers")
+    parser.add_argument('--seed', type=int, default=0, help="seed for the synthetic headers")
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+    if args.headers and args.first_height is None:
+        parser.error("--headers needs --first-height")
+
+    constants.set_mainnet()
+    results = Results()
+    run_recorded(results, 'recorded', bytes.fromhex(''.join(RECORDED_HEADERS)), RECORDED_FIRST_HEIGHT, args)
+    if args.headers:
+        with open(args.headers, 'rb') as f:
+            data = f.read()
+        run_recorded(results, 'file', data[:len(data) - len(data) % HEADER_SIZE], args.first_height, args)
+    run_synthetic(results, args, random.Random(args.seed))
+    blockchain.shutdown_pow_executor()
+
+    report = {
+        'electrum_version': ELECTRUM_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': blockchain.HAS_NUMPY,
+        'hashlib_scrypt': HAS_HASHLIB_SCRYPT,
+        'time': int(time.time()),
+        'args': vars(args),
+        'results': results.results,
+    }
+    output = json.dumps(report, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
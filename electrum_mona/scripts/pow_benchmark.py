@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+# Compares the proof-of-work hash backends on synthetic block headers.
+# usage: pow_benchmark.py [<num_headers>]
+
+import os
+import sys
+import time
+
+from electrum_mona.scrypt import SCRYPT_BACKENDS
+from electrum_mona.blockchain import LYRA2REV2_HEIGHT, PowJob, verify_pow_batch, HEADER_SIZE
+
+try:
+    num_headers = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+except ValueError:
+    print("usage: pow_benchmark.py [<num_headers>]")
+    sys.exit(1)
+
+headers = [os.urandom(HEADER_SIZE) for i in range(num_headers)]
+
+
+def report(name, seconds):
+    print(f"{name:>24}: {num_headers / seconds:10.1f} headers/s ({seconds:.3f} s)")
+
+
+for name, scrypt_func in sorted(SCRYPT_BACKENDS.items()):
+    t0 = time.perf_counter()
+    for raw_header in headers:
+        scrypt_func(raw_header)
+    report(f"scrypt ({name})", time.perf_counter() - t0)
+
+# targets are set to the maximum so that random headers pass
+max_target = 2 ** 256 - 1
+for name, first_height in (("scrypt", 0), ("lyra2rev2", LYRA2REV2_HEIGHT)):
+    jobs = [PowJob(raw_header, first_height + i, max_target) for i, raw_header in enumerate(headers)]
+    t0 = time.perf_counter()
+    try:
+        verify_pow_batch(jobs)
+    except Exception as e:
+        print(f"verify_pow_batch ({name}) failed: {e!r}")
+        continue
+    report(f"verify_pow_batch ({name})", time.perf_counter() - t0)
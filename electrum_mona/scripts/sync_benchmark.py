@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+# Benchmarks header sync, the Synchronizer and SPV against an in-process
+# StandinServer serving a synthetic regtest chain, without network access.
+# Prints the results as JSON, so that they can be compared between releases.
+#
+# usage: sync_benchmark.py [--headers N] [--addresses N] [--depth N] [--txs-per-block N]
+#                          [--latency SECONDS] [--jitter SECONDS] [--output FILE]
+#
+# The wallet gets addresses * depth transactions, e.g. --addresses 1000 --depth 1000
+# for a million. --latency and --jitter are added to every server response.
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from electrum_mona import constants, blockchain
+from electrum_mona.network import Network
+from electrum_mona.simple_config import SimpleConfig
+from electrum_mona.standin_server import SyntheticChain, StandinServer, add_wallet_history
+from electrum_mona.util import create_and_start_event_loop
+from electrum_mona.version import ELECTRUM_VERSION
+from electrum_mona.wallet import restore_wallet_from_text
+
+
+SEED = 'bitter grass shiver impose acquire brush forget axis eager alone wine silver'
+
+
+class Results:
+
+    def __init__(self):
+        self.results = {}
+
+    def add(self, name: str, seconds: float, count: int, unit: str):
+        self.results[name] = {
+            'count': count,
+            'unit': unit,
+            'seconds': round(seconds, 6),
+            'per_second': round(count / seconds, 1) if seconds > 0 else None,
+        }
+        print(f"{name:>24}: {count / seconds:12.1f} {unit}/s ({seconds:.3f} s)", file=sys.stderr)
+
+
+def wait_for(condition, timeout: float) -> float:
+    t0 = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - t0 > timeout:
+            raise Exception('timed out')
+        time.sleep(0.05)
+    return time.perf_counter() - t0
+
+
+def run(results: Results, args, tmp_dir: str) -> dict:
+    config = SimpleConfig({'electrum_path': tmp_dir})
+    wallet = restore_wallet_from_text(SEED, path=os.path.join(tmp_dir, 'wallet'), config=config,
+                                      encrypt_file=False, gap_limit=args.addresses + 20)['wallet']
+    addresses = wallet.get_receiving_addresses()[:args.addresses]
+
+    t0 = time.perf_counter()
+    chain = SyntheticChain(seed=args.seed)
+    chain.add_blocks(args.headers)
+    txids = add_wallet_history(chain, addresses, depth=args.depth, txs_per_block=args.txs_per_block)
+    results.add('generate', time.perf_counter() - t0, len(chain.headers), 'headers')
+    constants.net = chain.make_net()
+
+    loop, stop_loop, loop_thread = create_and_start_event_loop()
+    server = StandinServer(chain, latency=args.latency, jitter=args.jitter)
+    network = None
+    try:
+        server_addr = asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+        config = SimpleConfig({'electrum_path': tmp_dir, 'server': str(server_addr),
+                               'oneserver': True, 'auto_connect': False})
+        network = Network(config)
+        network.start()
+        seconds = wait_for(lambda: network.get_local_height() == chain.height, args.timeout)
+        results.add('header_sync', seconds, chain.height, 'headers')
+
+        t0 = time.perf_counter()
+        wallet.start_network(network)
+        seconds = wait_for(lambda: wallet.is_up_to_date(), args.timeout)
+        results.add('synchronizer', seconds, len(txids), 'txs')
+        wait_for(lambda: all(wallet.get_tx_height(txid).conf > 0 for txid in txids), args.timeout)
+        results.add('synchronizer_and_spv', time.perf_counter() - t0, len(txids), 'txs')
+        return {
+            'server_requests': server.num_requests,
+            'rpc_stats': network.get_rpc_stats(),
+        }
+    finally:
+        wallet.stop()
+        if network:
+            network.stop()
+        asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+        loop.call_soon_threadsafe(stop_loop.set_result, 1)
+        loop_thread.join(timeout=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks syncing against an in-process stand-in server.")
+    parser.add_argument('--headers', type=int, default=10000, help="number of empty blocks before the wallet history")
+    parser.add_argument('--addresses', type=int, default=100, help="number of wallet addresses with history")
+    parser.add_argument('--depth', type=int, default=100, help="number of transactions per address")
+    parser.add_argument('--txs-per-block', type=int, default=100, help="wallet transactions per block")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every server response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="up to this many more seconds, at random")
+    parser.add_argument('--timeout', type=float, default=3600, help="seconds to wait for each phase")
+    parser.add_argument('--seed', type=int, default=0, help="seed for the synthetic chain")
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    constants.set_regtest()
+    results = Results()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        details = run(results, args, tmp_dir)
+    finally:
+        blockchain.shutdown_pow_executor()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    report = {
+        'electrum_version': ELECTRUM_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': int(time.time()),
+        'args': vars(args),
+        'results': results.results,
+        'details': details,
+    }
+    output = json.dumps(report, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
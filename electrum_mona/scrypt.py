@@ -18,11 +18,46 @@
 
 import hashlib
 import hmac
+from typing import Callable, Dict
 
-def scrypt_1024_1_1_80(header):
+
+HAS_HASHLIB_SCRYPT = False
+try:
+    # hashlib.scrypt is only there if python was linked against OpenSSL 1.1+
+    hashlib.scrypt(b'', salt=b'', n=2, r=1, p=1)
+except (AttributeError, ValueError):
+    pass
+else:
+    HAS_HASHLIB_SCRYPT = True
+
+
+def _check_header(header) -> None:
     if not isinstance(header, bytes) or len(header) != 80:
         raise ValueError('header must be 80 bytes')
 
+
+def scrypt_1024_1_1_80_hashlib(header):
+    _check_header(header)
+    return hashlib.scrypt(header, salt=header, n=1024, r=1, p=1, dklen=32)
+
+
+def scrypt_1024_1_1_80_python(header):
+    _check_header(header)
+    return _scrypt_1024_1_1_80_python(header)
+
+
+# name -> implementation, for tests and benchmarks
+SCRYPT_BACKENDS = {
+    'python': scrypt_1024_1_1_80_python,
+}  # type: Dict[str, Callable[[bytes], bytes]]
+if HAS_HASHLIB_SCRYPT:
+    SCRYPT_BACKENDS['hashlib'] = scrypt_1024_1_1_80_hashlib
+
+# the fastest implementation available, chosen once
+scrypt_1024_1_1_80 = SCRYPT_BACKENDS['hashlib' if HAS_HASHLIB_SCRYPT else 'python']  # type: Callable[[bytes], bytes]
+
+
+def _scrypt_1024_1_1_80_python(header):
     mac = hmac.new(header, digestmod=hashlib.sha256)
 
     V = [0]*32*1024
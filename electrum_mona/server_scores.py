@@ -0,0 +1,185 @@
+"""Scores of the servers we have been connected to.
+
+For each server we keep moving averages of its round-trip time, its error
+rate, how far its tip is behind ours, and its throughput when sending us
+header chunks. The scores are used to weight the choice of servers:
+servers are still picked at random, so that we do not always talk to the
+same few servers, but bad servers are picked less often, and do not get
+to be our main server while better ones are connected.
+"""
+
+import os
+import json
+import random
+import threading
+from typing import Optional, Dict, Sequence, List, Iterable, TypeVar
+
+from .interface import ServerAddr
+from .logging import Logger
+
+
+# weight of a new sample in the moving averages
+EWMA_ALPHA = 0.2
+# request and error counts decay, so old errors are forgotten eventually
+COUNT_DECAY = 0.99
+# an RTT of RTT_REF seconds halves the score
+RTT_REF = 0.3
+# a throughput of THROUGHPUT_REF bytes/sec halves the score
+THROUGHPUT_REF = 100_000
+# weight of a server we know nothing about, relative to a perfect one
+DEFAULT_FACTOR = 0.5
+# even the worst servers keep being picked sometimes when exploring
+MIN_WEIGHT = 0.05
+# a candidate for main server must score at least this much of the best one
+MAIN_SERVER_MIN_RATIO = 0.25
+# but the main server is only replaced once it scores below this much of the
+# best one, so that servers scoring around MAIN_SERVER_MIN_RATIO do not flap
+MAIN_SERVER_SWITCH_RATIO = 0.125
+# the main server only gets replaced once we have seen it for a while
+MIN_REQUESTS_TO_JUDGE = 10
+
+T = TypeVar('T')
+
+
+class ServerStats:
+
+    def __init__(self, *, rtt: float = None, throughput: float = None, lag: float = 0,
+                 num_requests: float = 0, num_errors: float = 0):
+        self.rtt = rtt  # type: Optional[float]
+        self.throughput = throughput  # type: Optional[float]
+        self.lag = lag
+        self.num_requests = num_requests
+        self.num_errors = num_errors
+
+    @classmethod
+    def from_json(cls, d: dict) -> 'ServerStats':
+        return ServerStats(**{k: d[k] for k in ('rtt', 'throughput', 'lag', 'num_requests', 'num_errors')
+                              if k in d})
+
+    def to_json(self) -> dict:
+        return {
+            'rtt': self.rtt,
+            'throughput': self.throughput,
+            'lag': self.lag,
+            'num_requests': self.num_requests,
+            'num_errors': self.num_errors,
+        }
+
+    def score(self) -> float:
+        rtt_factor = RTT_REF / (RTT_REF + self.rtt) if self.rtt is not None else DEFAULT_FACTOR
+        tput_factor = (self.throughput / (self.throughput + THROUGHPUT_REF)
+                       if self.throughput is not None else DEFAULT_FACTOR)
+        error_factor = 1 - self.num_errors / (self.num_requests + 2)
+        lag_factor = 1 / (1 + self.lag)
+        return rtt_factor * tput_factor * error_factor * lag_factor
+
+
+def _ewma(old: Optional[float], new: float) -> float:
+    if old is None:
+        return new
+    return (1 - EWMA_ALPHA) * old + EWMA_ALPHA * new
+
+
+class ServerScores(Logger):
+
+    def __init__(self, path: Optional[str]):
+        Logger.__init__(self)
+        self.path = path
+        self.lock = threading.Lock()
+        self._stats = self._read()  # type: Dict[ServerAddr, ServerStats]
+
+    def _read(self) -> Dict[ServerAddr, ServerStats]:
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding='utf-8') as f:
+                data = json.loads(f.read())
+            return {ServerAddr.from_str(k): ServerStats.from_json(v) for k, v in data.items()}
+        except Exception as e:
+            self.logger.info(f"failed to read server scores: {repr(e)}")
+            return {}
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self.lock:
+            data = {str(server): stats.to_json() for server, stats in self._stats.items()}
+        s = json.dumps(data, indent=4, sort_keys=True)
+        try:
+            with open(self.path, "w", encoding='utf-8') as f:
+                f.write(s)
+        except Exception as e:
+            self.logger.info(f"failed to save server scores: {repr(e)}")
+
+    def _get_stats(self, server: ServerAddr) -> ServerStats:
+        stats = self._stats.get(server)
+        if stats is None:
+            stats = self._stats[server] = ServerStats()
+        return stats
+
+    def record_request(self, server: ServerAddr, *, rtt: float = None, error: bool = False) -> None:
+        """Records the outcome of a request, or of a connection attempt.
+        rtt is the time it took to get the response, if any.
+        """
+        with self.lock:
+            stats = self._get_stats(server)
+            stats.num_requests = stats.num_requests * COUNT_DECAY + 1
+            stats.num_errors = stats.num_errors * COUNT_DECAY + int(error)
+            if rtt is not None:
+                stats.rtt = _ewma(stats.rtt, rtt)
+
+    def record_lag(self, server: ServerAddr, num_blocks: int) -> None:
+        with self.lock:
+            stats = self._get_stats(server)
+            stats.lag = _ewma(stats.lag, max(0, num_blocks))
+
+    def record_throughput(self, server: ServerAddr, num_bytes: int, seconds: float) -> None:
+        with self.lock:
+            stats = self._get_stats(server)
+            stats.throughput = _ewma(stats.throughput, num_bytes / max(seconds, 1e-3))
+
+    def get_stats(self, server: ServerAddr) -> Optional[ServerStats]:
+        with self.lock:
+            return self._stats.get(server)
+
+    def score(self, server: ServerAddr) -> float:
+        with self.lock:
+            stats = self._stats.get(server)
+            if stats is None:
+                stats = ServerStats()
+            return stats.score()
+
+    def weighted_shuffle(self, servers: Iterable[T], *, key=lambda x: x) -> List[T]:
+        """Returns servers in random order, better ones tending to come first.
+        key maps the items to their ServerAddr.
+        """
+        # Efraimidis-Spirakis: sort by u^(1/weight), u uniform in (0, 1]
+        def sort_key(item):
+            weight = max(self.score(key(item)), MIN_WEIGHT)
+            return (1.0 - random.random()) ** (1 / weight)
+        return sorted(servers, key=sort_key, reverse=True)
+
+    def choose(self, servers: Sequence[T], *, key=lambda x: x) -> Optional[T]:
+        """Picks a random server, weighted by score."""
+        if not servers:
+            return None
+        return self.weighted_shuffle(servers, key=key)[0]
+
+    def choose_main(self, servers: Sequence[T], *, key=lambda x: x) -> Optional[T]:
+        """Like choose, but never picks a server scoring much worse than the best one."""
+        if not servers:
+            return None
+        best = max(self.score(key(s)) for s in servers)
+        good = [s for s in servers if self.score(key(s)) >= best * MAIN_SERVER_MIN_RATIO]
+        return self.choose(good, key=key)
+
+    def is_much_worse(self, server: ServerAddr, others: Iterable[ServerAddr], *,
+                      ratio: float = MAIN_SERVER_MIN_RATIO) -> bool:
+        """Whether, based on enough samples, server scores less than ratio of the best of others."""
+        stats = self.get_stats(server)
+        if stats is None or stats.num_requests < MIN_REQUESTS_TO_JUDGE:
+            return False
+        scores = [self.score(s) for s in others]
+        if not scores:
+            return False
+        return self.score(server) < max(scores) * ratio
@@ -0,0 +1,701 @@
+"""SQLite wallet files.
+
+The transaction history of a wallet (txi, txo, transactions, spent
+outpoints, address histories, verified txs, fees and prevouts by
+scripthash) is kept in tables with a row per entry, and read on demand,
+so that large wallets only keep their working set in memory, and saving
+only writes the rows that changed. Note that loading still lists the
+first keys of the history tables (see _list_first_keys), as the address
+synchronizer needs them, so load time still grows with the history.
+Everything else (keystores, addresses, labels, channels, invoices...) is
+small, and is kept in memory as in json wallet files, with a row per
+top-level key.
+
+Encrypted files use a key derived from the same password as json files
+(see WalletStorage.get_eckey_from_password), so this works with both user
+and hardware-device passwords. Key columns then hold keyed hashes, so that
+rows can still be looked up, and rows are encrypted with ChaCha20-Poly1305.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import closing
+from typing import Dict, Optional, List, Tuple, Set, Iterable, Sequence, Any, Union, TYPE_CHECKING
+
+from . import ecc
+from .crypto import hmac_oneshot, chacha20_poly1305_encrypt, chacha20_poly1305_decrypt
+from .json_db import StoredDict, JsonDBJsonEncoder, locked, modifier
+from .transaction import Transaction, TxOutpoint, tx_from_any, PartialTransaction
+from .util import profiler, WalletFileException, TxMinedInfo, InvalidPassword
+from .wallet_db import WalletDB, TxFeesValue
+
+if TYPE_CHECKING:
+    from .storage import WalletStorage
+
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+FORMAT_VERSION = 1
+
+# table (named after the key in json wallet files) -> key columns
+TABLES = OrderedDict([
+    ('txi', ('txid', 'address')),                   # value: prev_outpoint -> value
+    ('txo', ('txid', 'address')),                   # value: output_index -> (value, is_coinbase)
+    ('transactions', ('txid',)),                    # value: raw tx
+    ('spent_outpoints', ('prevout_hash', 'prevout_n')),  # value: spending txid
+    ('addr_history', ('address',)),                 # value: list of (txid, height)
+    ('verified_tx3', ('txid',)),                    # value: (height, timestamp, txpos, header_hash)
+    ('tx_fees', ('txid',)),                         # value: TxFeesValue
+    ('prevouts_by_scripthash', ('scripthash', 'prevout')),  # value: value of prevout
+])
+
+# the keys of a table row are in 'keys' if the file is encrypted
+create_table = """
+CREATE TABLE IF NOT EXISTS {table} (
+{key_columns},
+keys BLOB,
+value BLOB NOT NULL,
+PRIMARY KEY ({primary_key})
+)"""
+
+create_meta = """
+CREATE TABLE IF NOT EXISTS meta (
+key TEXT PRIMARY KEY,
+value TEXT NOT NULL
+)"""
+
+# top-level keys of the json data, other than the tables
+create_kv = """
+CREATE TABLE IF NOT EXISTS kv (
+key TEXT PRIMARY KEY,
+value BLOB NOT NULL
+)"""
+
+TX_CACHE_SIZE = 1000
+
+
+def is_sqlite_file(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+
+def read_meta(path: str) -> Dict[str, str]:
+    with closing(sqlite3.connect(path)) as conn:
+        return dict(conn.execute("SELECT key, value FROM meta").fetchall())
+
+
+class RowCipher:
+    """Encrypts the rows of a wallet file. Without a secret, rows are stored in the clear."""
+
+    def __init__(self, secret: Optional[bytes]):
+        self.is_encrypted = bool(secret)
+        if self.is_encrypted:
+            k = hmac_oneshot(b'electrum sqlite wallet', secret, hashlib.sha512)
+            self._encryption_key, self._blinding_key = k[:32], k[32:]
+
+    @classmethod
+    def from_eckey(cls, ec_key: ecc.ECPrivkey) -> 'RowCipher':
+        return cls(ec_key.get_secret_bytes())
+
+    def get_password_check(self) -> str:
+        if not self.is_encrypted:
+            return ''
+        return hmac_oneshot(self._blinding_key, b'password check', hashlib.sha256).hex()
+
+    def blind(self, key: str) -> str:
+        if not self.is_encrypted:
+            return key
+        return hmac_oneshot(self._blinding_key, key.encode('utf8'), hashlib.sha256)[:16].hex()
+
+    def seal(self, data: bytes, associated_data: bytes) -> bytes:
+        if not self.is_encrypted:
+            return data
+        nonce = os.urandom(12)
+        return nonce + chacha20_poly1305_encrypt(
+            key=self._encryption_key, nonce=nonce, associated_data=associated_data, data=data)
+
+    def unseal(self, data: bytes, associated_data: bytes) -> bytes:
+        if not self.is_encrypted:
+            return data
+        try:
+            return chacha20_poly1305_decrypt(
+                key=self._encryption_key, nonce=data[:12], associated_data=associated_data, data=data[12:])
+        except ValueError as e:
+            raise WalletFileException("Cannot read wallet file. (row failed authentication)") from e
+
+
+def _associated_data(table: str, blinded_keys: Sequence[str]) -> bytes:
+    # binds rows to their table and keys, so that they cannot be swapped
+    return '\x00'.join((table,) + tuple(blinded_keys)).encode('utf8')
+
+
+def _encode(value) -> bytes:
+    return json.dumps(value, separators=(',', ':'), cls=JsonDBJsonEncoder).encode('utf8')
+
+
+def _put_row(conn: sqlite3.Connection, cipher: RowCipher, table: str, keys: Sequence[str], value) -> None:
+    blinded_keys = [cipher.blind(k) for k in keys]
+    ad = _associated_data(table, blinded_keys)
+    keys_blob = cipher.seal(_encode(keys), ad + b'\x00keys') if cipher.is_encrypted else None
+    columns = TABLES[table]
+    conn.execute(f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}, keys, value) "
+                 f"VALUES ({', '.join('?' for c in columns)}, ?, ?)",
+                 blinded_keys + [keys_blob, cipher.seal(_encode(value), ad)])
+
+
+def _put_kv(conn: sqlite3.Connection, cipher: RowCipher, key: str, value) -> None:
+    conn.execute("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                 (key, cipher.seal(_encode([key, value]), _associated_data('kv', [key]))))
+
+
+def _iter_table_rows(table: str, data) -> Iterable[Tuple[List[str], Any]]:
+    """The rows of a table, from the json of a wallet file."""
+    if table == 'prevouts_by_scripthash':
+        for scripthash, prevouts in data.items():
+            for prevout, value in prevouts:
+                yield [scripthash, prevout], value
+    elif len(TABLES[table]) == 2:
+        for k1, d in data.items():
+            for k2, value in d.items():
+                yield [k1, k2], value
+    else:
+        for k, value in data.items():
+            yield [k], value
+
+
+def _get_row_keys(cipher: RowCipher, table: str, blinded_keys: Sequence[str],
+                  keys_blob: Optional[bytes]) -> List[str]:
+    if not cipher.is_encrypted:
+        return list(blinded_keys)
+    ad = _associated_data(table, blinded_keys) + b'\x00keys'
+    return json.loads(cipher.unseal(keys_blob, ad))
+
+
+def _select_rows(conn: sqlite3.Connection, cipher: RowCipher, table: str,
+                 *keys: str) -> List[Tuple[List[str], Any]]:
+    """Returns (keys, value) of the rows of table whose keys start with keys."""
+    columns = TABLES[table]
+    blinded = [cipher.blind(k) for k in keys]
+    where = ' AND '.join(f"{c}=?" for c in columns[:len(keys)]) or '1'
+    rows = conn.execute(
+        f"SELECT {', '.join(columns)}, keys, value FROM {table} WHERE {where}", blinded).fetchall()
+    result = []
+    for row in rows:
+        blinded_keys, keys_blob, value = row[:-2], row[-2], row[-1]
+        value = json.loads(cipher.unseal(value, _associated_data(table, blinded_keys)))
+        result.append((_get_row_keys(cipher, table, blinded_keys, keys_blob), value))
+    return result
+
+
+def _read_kv(conn: sqlite3.Connection, cipher: RowCipher) -> dict:
+    data = {}
+    for key, value in conn.execute("SELECT key, value FROM kv").fetchall():
+        k, v = json.loads(cipher.unseal(value, _associated_data('kv', [key])))
+        if k != key:
+            raise WalletFileException("Cannot read wallet file. (inconsistent row)")
+        data[key] = v
+    if not data:
+        raise WalletFileException("Cannot read wallet file. (no data)")
+    return data
+
+
+def _read_table_as_json(conn: sqlite3.Connection, cipher: RowCipher, table: str):
+    """The inverse of _iter_table_rows."""
+    d = {}  # type: Dict[str, Any]
+    for keys, value in _select_rows(conn, cipher, table):
+        if table == 'prevouts_by_scripthash':
+            d.setdefault(keys[0], []).append((keys[1], value))
+        elif len(keys) == 2:
+            d.setdefault(keys[0], {})[keys[1]] = value
+        else:
+            d[keys[0]] = value
+    return d
+
+
+def _create_tables(conn: sqlite3.Connection) -> None:
+    conn.execute(create_meta)
+    conn.execute(create_kv)
+    for table, columns in TABLES.items():
+        conn.execute(create_table.format(
+            table=table,
+            key_columns=',\n'.join(f"{c} TEXT NOT NULL" for c in columns),
+            primary_key=', '.join(columns)))
+
+
+def _set_meta(conn: sqlite3.Connection, cipher: RowCipher, encryption_version: int) -> None:
+    for key, value in (('format_version', FORMAT_VERSION),
+                       ('encryption_version', int(encryption_version)),
+                       ('password_check', cipher.get_password_check())):
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+
+def create_sqlite_wallet_file(path: str, data: dict, *, cipher: RowCipher, encryption_version: int) -> None:
+    """Creates a wallet file at path, from the json data of a wallet."""
+    assert not os.path.exists(path)
+    with closing(sqlite3.connect(path)) as conn:
+        _create_tables(conn)
+        _set_meta(conn, cipher, encryption_version)
+        for key, value in data.items():
+            if key in TABLES:
+                for keys, v in _iter_table_rows(key, value):
+                    _put_row(conn, cipher, key, keys, v)
+            else:
+                _put_kv(conn, cipher, key, value)
+        conn.commit()
+
+
+def convert_to_sqlite(path: str, *, password: Optional[str] = None) -> str:
+    """Converts the json wallet file at path to an sqlite wallet file, with
+    the same encryption. The json file is kept as a backup, whose path is returned.
+    """
+    from .storage import WalletStorage
+    storage = WalletStorage(path)
+    if not storage.file_exists():
+        raise WalletFileException(f"no wallet file at {path}")
+    if storage.is_sqlite():
+        raise WalletFileException("this wallet file is already an sqlite file")
+    cipher = RowCipher(None)
+    if storage.is_encrypted():
+        if not password:
+            raise InvalidPassword()
+        storage.decrypt(password)
+        cipher = RowCipher.from_eckey(storage.get_eckey_from_password(password))
+    db = WalletDB(storage.read(), manual_upgrades=True)
+    if db.requires_split() or db.requires_upgrade() or db.get_action():
+        raise WalletFileException("this wallet file has to be opened, and upgraded, first")
+    backup_path = path + '.json_backup'
+    if os.path.exists(backup_path):
+        raise WalletFileException(f"{backup_path} already exists")
+    temp_path = f"{path}.sqlite.tmp.{os.getpid()}"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    create_sqlite_wallet_file(temp_path, json.loads(db.dump(human_readable=False)),
+                              cipher=cipher, encryption_version=storage.get_encryption_version())
+    shutil.copy2(path, backup_path)
+    shutil.copymode(path, temp_path)
+    os.replace(temp_path, path)
+    return backup_path
+
+
+def convert_to_json(path: str, *, password: Optional[str] = None) -> str:
+    """Converts the sqlite wallet file at path back to a json wallet file,
+    with the same encryption. It is not upgraded, so that this works with
+    files that are too old for SqliteWalletDB. The sqlite file is kept as a
+    backup, whose path is returned.
+    """
+    from .storage import WalletStorage
+    storage = WalletStorage(path)
+    if not storage.file_exists():
+        raise WalletFileException(f"no wallet file at {path}")
+    if not storage.is_sqlite():
+        raise WalletFileException("this wallet file is not an sqlite file")
+    if storage.is_encrypted():
+        if not password:
+            raise InvalidPassword()
+        storage.decrypt(password)
+    with closing(sqlite3.connect(path)) as conn:
+        data = _read_kv(conn, storage.row_cipher)
+        for table in TABLES:
+            data[table] = _read_table_as_json(conn, storage.row_cipher, table)
+    backup_path = path + '.sqlite_backup'
+    if os.path.exists(backup_path):
+        raise WalletFileException(f"{backup_path} already exists")
+    temp_path = f"{path}.json.tmp.{os.getpid()}"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    json_storage = WalletStorage(temp_path)
+    if storage.is_encrypted():
+        json_storage.set_password(password, storage.get_encryption_version())
+    json_storage.write(json.dumps(data, indent=None if storage.is_encrypted() else 4,
+                                  cls=JsonDBJsonEncoder))
+    shutil.copy2(path, backup_path)
+    shutil.copymode(path, temp_path)
+    os.replace(temp_path, path)
+    return backup_path
+
+
+class SqliteWalletDB(WalletDB):
+    """A WalletDB with the transaction history in tables (see module docstring)."""
+
+    def __init__(self, storage: 'WalletStorage', *, manual_upgrades: bool):
+        assert storage.is_past_initial_decryption()
+        self._cipher = storage.row_cipher
+        self.conn = sqlite3.connect(storage.path, check_same_thread=False)
+        self._tx_cache = OrderedDict()  # type: OrderedDict[str, Transaction]
+        data = _read_kv(self.conn, self._cipher)
+        WalletDB.__init__(self, data, manual_upgrades=manual_upgrades)
+
+    def load_data(self, data: dict):
+        self.data = data
+        if self.requires_upgrade():
+            raise WalletFileException("This wallet file has to be converted back to json to be upgraded. "
+                                      "Use the convert_to_json command.")
+        self._after_upgrade_tasks()
+
+    def requires_split(self):
+        return False
+
+    def _load_transactions(self):
+        # unlike json wallets, we do not look for unreferenced txs here,
+        # as that would need to read the whole history
+        self.data = StoredDict(self.data, self, [])
+
+    def _select(self, table: str, *keys: str) -> List[Tuple[List[str], Any]]:
+        """Returns (keys, value) of the rows of table whose keys start with keys."""
+        return _select_rows(self.conn, self._cipher, table, *keys)
+
+    def _get(self, table: str, *keys: str, default=None):
+        assert len(keys) == len(TABLES[table])
+        rows = self._select(table, *keys)
+        return rows[0][1] if rows else default
+
+    def _list_first_keys(self, table: str) -> List[str]:
+        column = TABLES[table][0]
+        rows = self.conn.execute(
+            f"SELECT {', '.join(TABLES[table])}, keys FROM {table} GROUP BY {column}").fetchall()
+        return [_get_row_keys(self._cipher, table, row[:-1], row[-1])[0] for row in rows]
+
+    def _exists(self, table: str, *keys: str) -> bool:
+        columns = TABLES[table]
+        where = ' AND '.join(f"{c}=?" for c in columns[:len(keys)])
+        return self.conn.execute(f"SELECT 1 FROM {table} WHERE {where} LIMIT 1",
+                                 [self._cipher.blind(k) for k in keys]).fetchone() is not None
+
+    def _put(self, table: str, keys: Sequence[str], value) -> None:
+        _put_row(self.conn, self._cipher, table, keys, value)
+
+    def _delete(self, table: str, *keys: str) -> None:
+        columns = TABLES[table]
+        where = ' AND '.join(f"{c}=?" for c in columns[:len(keys)]) or '1'
+        self.conn.execute(f"DELETE FROM {table} WHERE {where}", [self._cipher.blind(k) for k in keys])
+
+    @locked
+    def dump(self, *, human_readable: bool = True) -> str:
+        """Serializes the whole wallet as json, e.g. for backups."""
+        data = dict(self.data)
+        for table in TABLES:
+            data[table] = _read_table_as_json(self.conn, self._cipher, table)
+        return json.dumps(
+            data,
+            indent=4 if human_readable else None,
+            sort_keys=bool(human_readable),
+            cls=JsonDBJsonEncoder,
+        )
+
+    @profiler
+    def _write(self, storage: 'WalletStorage'):
+        if threading.current_thread().daemon:
+            self.logger.warning('daemon thread cannot write db')
+            return
+        if not self.modified():
+            return
+        if storage.row_cipher is not self._cipher:
+            # the password changed
+            self._rekey(storage.row_cipher, storage.get_encryption_version())
+        if self._full_write_needed:
+            keys = set(self.data.keys())
+            for key, in self.conn.execute("SELECT key FROM kv").fetchall():
+                if key not in keys:
+                    self.conn.execute("DELETE FROM kv WHERE key=?", (key,))
+        else:
+            keys = {path[0] for path in self._pending_changes}
+        for key in keys:
+            if key in self.data:
+                _put_kv(self.conn, self._cipher, key, self.data[key])
+            else:
+                self.conn.execute("DELETE FROM kv WHERE key=?", (key,))
+        self.conn.commit()
+        self.set_modified(False)
+        self.logger.info(f"saved {storage.path}")
+
+    def _rekey(self, cipher: RowCipher, encryption_version: int) -> None:
+        for table in TABLES:
+            rows = self._select(table)
+            self._delete(table)
+            for keys, value in rows:
+                _put_row(self.conn, cipher, table, keys, value)
+        self._cipher = cipher
+        _set_meta(self.conn, cipher, encryption_version)
+        self.set_modified(True)  # rewrite kv
+
+    @modifier
+    def clear_history(self):
+        for table in TABLES:
+            self._delete(table)
+        self._tx_cache.clear()
+
+    @locked
+    def get_txi_addresses(self, tx_hash: str) -> List[str]:
+        assert isinstance(tx_hash, str)
+        return [keys[1] for keys, d in self._select('txi', tx_hash)]
+
+    @locked
+    def get_txo_addresses(self, tx_hash: str) -> List[str]:
+        assert isinstance(tx_hash, str)
+        return [keys[1] for keys, d in self._select('txo', tx_hash)]
+
+    @locked
+    def get_txi_addr(self, tx_hash: str, address: str) -> Iterable[Tuple[str, int]]:
+        assert isinstance(tx_hash, str)
+        assert isinstance(address, str)
+        return list(self._get('txi', tx_hash, address, default={}).items())
+
+    @locked
+    def get_txo_addr(self, tx_hash: str, address: str) -> Dict[int, Tuple[int, bool]]:
+        assert isinstance(tx_hash, str)
+        assert isinstance(address, str)
+        d = self._get('txo', tx_hash, address, default={})
+        return {int(n): (v, cb) for (n, (v, cb)) in d.items()}
+
+    @modifier
+    def add_txi_addr(self, tx_hash: str, addr: str, ser: str, v: int) -> None:
+        assert isinstance(tx_hash, str)
+        assert isinstance(addr, str)
+        assert isinstance(ser, str)
+        assert isinstance(v, int)
+        d = self._get('txi', tx_hash, addr, default={})
+        d[ser] = v
+        self._put('txi', (tx_hash, addr), d)
+
+    @modifier
+    def add_txo_addr(self, tx_hash: str, addr: str, n: Union[int, str], v: int, is_coinbase: bool) -> None:
+        n = str(n)
+        assert isinstance(tx_hash, str)
+        assert isinstance(addr, str)
+        assert isinstance(v, int)
+        assert isinstance(is_coinbase, bool)
+        d = self._get('txo', tx_hash, addr, default={})
+        d[n] = (v, is_coinbase)
+        self._put('txo', (tx_hash, addr), d)
+
+    @locked
+    def list_txi(self) -> Sequence[str]:
+        return self._list_first_keys('txi')
+
+    @locked
+    def list_txo(self) -> Sequence[str]:
+        return self._list_first_keys('txo')
+
+    @modifier
+    def remove_txi(self, tx_hash: str) -> None:
+        assert isinstance(tx_hash, str)
+        self._delete('txi', tx_hash)
+
+    @modifier
+    def remove_txo(self, tx_hash: str) -> None:
+        assert isinstance(tx_hash, str)
+        self._delete('txo', tx_hash)
+
+    @locked
+    def list_spent_outpoints(self) -> Sequence[Tuple[str, str]]:
+        return [(keys[0], keys[1]) for keys, txid in self._select('spent_outpoints')]
+
+    @locked
+    def get_spent_outpoints(self, prevout_hash: str) -> Sequence[str]:
+        assert isinstance(prevout_hash, str)
+        return [keys[1] for keys, txid in self._select('spent_outpoints', prevout_hash)]
+
+    @locked
+    def get_spent_outpoint(self, prevout_hash: str, prevout_n: Union[int, str]) -> Optional[str]:
+        assert isinstance(prevout_hash, str)
+        return self._get('spent_outpoints', prevout_hash, str(prevout_n))
+
+    @modifier
+    def remove_spent_outpoint(self, prevout_hash: str, prevout_n: Union[int, str]) -> None:
+        assert isinstance(prevout_hash, str)
+        self._delete('spent_outpoints', prevout_hash, str(prevout_n))
+
+    @modifier
+    def set_spent_outpoint(self, prevout_hash: str, prevout_n: Union[int, str], tx_hash: str) -> None:
+        assert isinstance(prevout_hash, str)
+        assert isinstance(tx_hash, str)
+        self._put('spent_outpoints', (prevout_hash, str(prevout_n)), tx_hash)
+
+    @modifier
+    def add_prevout_by_scripthash(self, scripthash: str, *, prevout: TxOutpoint, value: int) -> None:
+        assert isinstance(scripthash, str)
+        assert isinstance(prevout, TxOutpoint)
+        assert isinstance(value, int)
+        self._put('prevouts_by_scripthash', (scripthash, prevout.to_str()), value)
+
+    @modifier
+    def remove_prevout_by_scripthash(self, scripthash: str, *, prevout: TxOutpoint, value: int) -> None:
+        assert isinstance(scripthash, str)
+        assert isinstance(prevout, TxOutpoint)
+        assert isinstance(value, int)
+        if self._get('prevouts_by_scripthash', scripthash, prevout.to_str()) == value:
+            self._delete('prevouts_by_scripthash', scripthash, prevout.to_str())
+
+    @locked
+    def get_prevouts_by_scripthash(self, scripthash: str) -> Set[Tuple[TxOutpoint, int]]:
+        assert isinstance(scripthash, str)
+        return {(TxOutpoint.from_str(keys[1]), value)
+                for keys, value in self._select('prevouts_by_scripthash', scripthash)}
+
+    def _cache_tx(self, tx_hash: str, tx: Transaction) -> None:
+        self._tx_cache[tx_hash] = tx
+        self._tx_cache.move_to_end(tx_hash)
+        while len(self._tx_cache) > TX_CACHE_SIZE:
+            self._tx_cache.popitem(last=False)
+
+    @modifier
+    def add_transaction(self, tx_hash: str, tx: Transaction) -> None:
+        assert isinstance(tx_hash, str)
+        assert isinstance(tx, Transaction), tx
+        # note that tx might be a PartialTransaction
+        if not tx_hash:
+            raise Exception("trying to add tx to db without txid")
+        if tx_hash != tx.txid():
+            raise Exception(f"trying to add tx to db with inconsistent txid: {tx_hash} != {tx.txid()}")
+        # don't allow overwriting complete tx with partial tx
+        tx_we_already_have = self.get_transaction(tx_hash)
+        if tx_we_already_have is None or isinstance(tx_we_already_have, PartialTransaction):
+            self._put('transactions', (tx_hash,), tx)
+            self._cache_tx(tx_hash, tx)
+
+    @modifier
+    def remove_transaction(self, tx_hash: str) -> Optional[Transaction]:
+        assert isinstance(tx_hash, str)
+        tx = self.get_transaction(tx_hash)
+        self._delete('transactions', tx_hash)
+        self._tx_cache.pop(tx_hash, None)
+        return tx
+
+    @locked
+    def get_transaction(self, tx_hash: Optional[str]) -> Optional[Transaction]:
+        if tx_hash is None:
+            return None
+        assert isinstance(tx_hash, str)
+        tx = self._tx_cache.get(tx_hash)
+        if tx is None:
+            raw = self._get('transactions', tx_hash)
+            if raw is None:
+                return None
+            # note: for performance, "deserialize=False" so that we will deserialize these on-demand
+            tx = tx_from_any(raw, deserialize=False)
+        self._cache_tx(tx_hash, tx)
+        return tx
+
+    @locked
+    def list_transactions(self) -> Sequence[str]:
+        return self._list_first_keys('transactions')
+
+    @locked
+    def get_history(self) -> Sequence[str]:
+        return self._list_first_keys('addr_history')
+
+    @locked
+    def is_addr_in_history(self, addr: str) -> bool:
+        # does not mean history is non-empty!
+        assert isinstance(addr, str)
+        return self._exists('addr_history', addr)
+
+    @locked
+    def get_addr_history(self, addr: str) -> Sequence[Tuple[str, int]]:
+        assert isinstance(addr, str)
+        return self._get('addr_history', addr, default=[])
+
+    @modifier
+    def set_addr_history(self, addr: str, hist) -> None:
+        assert isinstance(addr, str)
+        self._put('addr_history', (addr,), hist)
+
+    @modifier
+    def remove_addr_history(self, addr: str) -> None:
+        assert isinstance(addr, str)
+        self._delete('addr_history', addr)
+
+    @locked
+    def list_verified_tx(self) -> Sequence[str]:
+        return self._list_first_keys('verified_tx3')
+
+    @locked
+    def get_verified_tx(self, txid: str) -> Optional[TxMinedInfo]:
+        assert isinstance(txid, str)
+        v = self._get('verified_tx3', txid)
+        if v is None:
+            return None
+        height, timestamp, txpos, header_hash = v
+        return TxMinedInfo(height=height,
+                           conf=None,
+                           timestamp=timestamp,
+                           txpos=txpos,
+                           header_hash=header_hash)
+
+    @modifier
+    def add_verified_tx(self, txid: str, info: TxMinedInfo):
+        assert isinstance(txid, str)
+        assert isinstance(info, TxMinedInfo)
+        self._put('verified_tx3', (txid,), (info.height, info.timestamp, info.txpos, info.header_hash))
+
+    @modifier
+    def remove_verified_tx(self, txid: str):
+        assert isinstance(txid, str)
+        self._delete('verified_tx3', txid)
+
+    @locked
+    def is_in_verified_tx(self, txid: str) -> bool:
+        assert isinstance(txid, str)
+        return self._exists('verified_tx3', txid)
+
+    def _get_tx_fees_value(self, txid: str) -> Optional[TxFeesValue]:
+        v = self._get('tx_fees', txid)
+        return TxFeesValue(*v) if v is not None else None
+
+    @modifier
+    def add_tx_fee_from_server(self, txid: str, fee_sat: Optional[int]) -> None:
+        assert isinstance(txid, str)
+        # note: when called with (fee_sat is None), rm currently saved value
+        tx_fees_value = self._get_tx_fees_value(txid) or TxFeesValue()
+        if tx_fees_value.is_calculated_by_us:
+            return
+        self._put('tx_fees', (txid,), tx_fees_value._replace(fee=fee_sat, is_calculated_by_us=False))
+
+    @modifier
+    def add_tx_fee_we_calculated(self, txid: str, fee_sat: Optional[int]) -> None:
+        assert isinstance(txid, str)
+        if fee_sat is None:
+            return
+        assert isinstance(fee_sat, int)
+        tx_fees_value = self._get_tx_fees_value(txid) or TxFeesValue()
+        self._put('tx_fees', (txid,), tx_fees_value._replace(fee=fee_sat, is_calculated_by_us=True))
+
+    @locked
+    def get_tx_fee(self, txid: str, *, trust_server: bool = False) -> Optional[int]:
+        assert isinstance(txid, str)
+        """Returns tx_fee."""
+        tx_fees_value = self._get_tx_fees_value(txid)
+        if tx_fees_value is None:
+            return None
+        if not trust_server and not tx_fees_value.is_calculated_by_us:
+            return None
+        return tx_fees_value.fee
+
+    @modifier
+    def add_num_inputs_to_tx(self, txid: str, num_inputs: int) -> None:
+        assert isinstance(txid, str)
+        assert isinstance(num_inputs, int)
+        tx_fees_value = self._get_tx_fees_value(txid) or TxFeesValue()
+        self._put('tx_fees', (txid,), tx_fees_value._replace(num_inputs=num_inputs))
+
+    @locked
+    def get_num_all_inputs_of_tx(self, txid: str) -> Optional[int]:
+        assert isinstance(txid, str)
+        tx_fees_value = self._get_tx_fees_value(txid)
+        if tx_fees_value is None:
+            return None
+        return tx_fees_value.num_inputs
+
+    @locked
+    def get_num_ismine_inputs_of_tx(self, txid: str) -> int:
+        assert isinstance(txid, str)
+        return sum(len(d) for keys, d in self._select('txi', txid))
+
+    @modifier
+    def remove_tx_fee(self, txid: str) -> None:
+        assert isinstance(txid, str)
+        self._delete('tx_fees', txid)
@@ -0,0 +1,373 @@
+"""An in-process stand-in for an Electrum protocol server, for load tests.
+
+SyntheticChain generates linked Monacoin headers over blocks of synthetic
+transactions, and add_wallet_history fills it with the history of a set
+of addresses. StandinServer serves such a chain over TCP on localhost,
+with optional injected latency, so that Network, Synchronizer and SPV
+can be run against it without a node or an ElectrumX instance:
+
+    chain = SyntheticChain()
+    add_wallet_history(chain, addresses, depth=100)
+    constants.net = chain.make_net()
+    server = StandinServer(chain, latency=0.05)
+    server_addr = await server.start()  # a ServerAddr, e.g. for the 'server' config key
+
+Synthetic chains run on regtest parameters (with their own genesis), where
+headers are linked and their merkle roots checked, but neither their
+targets nor their proof of work are. With mine=True the headers are mined
+anyway, against the easy target of their bits, using the proof of work of
+their height: scrypt below LYRA2REV2_HEIGHT and Lyra2REv2 from there on.
+"""
+
+import asyncio
+import hashlib
+import random
+import ssl
+from typing import List, Dict, Sequence, Optional, Tuple, Set, Type
+
+from aiorpcx import RPCSession, RPCError, handler_invocation, serve_rs
+
+from . import constants
+from . import version
+from .bitcoin import address_to_script, script_to_scripthash, hash_encode, var_int
+from .blockchain import serialize_header, pow_hash_header
+from .crypto import sha256d
+from .interface import ServerAddr
+from .logging import Logger
+from .util import bfh, bh2u
+
+
+REGTEST_BITS = 0x207fffff
+BLOCK_INTERVAL = 90  # seconds, as on mainnet
+GENESIS_TIMESTAMP = 1388479472
+
+
+def merkle_root(txids: Sequence[bytes]) -> bytes:
+    """txids in internal byte order."""
+    level = list(txids)
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        level = [sha256d(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
+    return level[0]
+
+
+def merkle_branch(txids: Sequence[bytes], pos: int) -> List[bytes]:
+    branch = []
+    level = list(txids)
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        branch.append(level[pos ^ 1])
+        level = [sha256d(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
+        pos >>= 1
+    return branch
+
+
+class SyntheticChain:
+    """Headers and blocks of synthetic transactions, from a synthetic genesis."""
+
+    def __init__(self, *, seed: int = 0, bits: int = REGTEST_BITS, mine: bool = False):
+        self.rng = random.Random(seed)
+        self.bits = bits
+        self.mine = mine
+        self.headers = []  # type: List[bytes]
+        self.block_txids = []  # type: List[List[bytes]]
+        self.txs = {}  # type: Dict[str, bytes]
+        self.tx_positions = {}  # type: Dict[str, Tuple[int, int]]  # txid -> (height, pos)
+        self.histories = {}  # type: Dict[str, List[Tuple[str, int]]]  # scripthash -> [(txid, height)]
+        self.add_block([])
+
+    @property
+    def height(self) -> int:
+        return len(self.headers) - 1
+
+    def get_hash(self, height: int) -> str:
+        return hash_encode(sha256d(self.headers[height]))
+
+    @property
+    def genesis_hash(self) -> str:
+        return self.get_hash(0)
+
+    def make_net(self) -> Type[constants.BitcoinRegtest]:
+        """The network parameters to set as constants.net to use this chain."""
+        class SyntheticNet(constants.BitcoinRegtest):
+            GENESIS = self.genesis_hash
+            DEFAULT_SERVERS = {}
+        return SyntheticNet
+
+    def make_tx(self, script: bytes, value: int) -> str:
+        """Creates a transaction paying value to script, to be put in the next block."""
+        prevout = self.rng.getrandbits(256).to_bytes(32, 'little')
+        raw = (b'\x02\x00\x00\x00'
+               + b'\x01' + prevout + b'\x00\x00\x00\x00' + b'\x00' + b'\xff\xff\xff\xff'
+               + b'\x01' + value.to_bytes(8, 'little') + bfh(var_int(len(script))) + script
+               + b'\x00\x00\x00\x00')
+        txid = hash_encode(sha256d(raw))
+        self.txs[txid] = raw
+        return txid
+
+    def add_block(self, txids: Sequence[str]) -> int:
+        """Appends a block with the given transactions. Returns its height."""
+        height = len(self.headers)
+        txids_bytes = [bfh(txid)[::-1] for txid in txids]
+        # blocks need at least one tx for a merkle root; the coinbase is not served
+        coinbase = sha256d(b'coinbase' + height.to_bytes(4, 'little'))
+        leaves = [coinbase] + txids_bytes
+        for pos, txid in enumerate(txids, start=1):
+            self.tx_positions[txid] = (height, pos)
+        header = {
+            'version': 0x20000000,
+            'prev_block_hash': self.get_hash(height - 1) if height > 0 else '00' * 32,
+            'merkle_root': hash_encode(merkle_root(leaves)),
+            'timestamp': GENESIS_TIMESTAMP + height * BLOCK_INTERVAL,
+            'bits': self.bits,
+            'nonce': 0,
+        }
+        raw = bfh(serialize_header(header))
+        if self.mine:
+            raw = mine_header(raw, height, self.bits)
+        self.headers.append(raw)
+        self.block_txids.append(leaves)
+        return height
+
+    def add_blocks(self, num_blocks: int) -> None:
+        for i in range(num_blocks):
+            self.add_block([])
+
+    def add_to_history(self, scripthash: str, txid: str) -> None:
+        height, pos = self.tx_positions[txid]
+        self.histories.setdefault(scripthash, []).append((txid, height))
+
+    def get_merkle(self, txid: str) -> dict:
+        height, pos = self.tx_positions[txid]
+        branch = merkle_branch(self.block_txids[height], pos)
+        return {
+            'block_height': height,
+            'merkle': [hash_encode(h) for h in branch],
+            'pos': pos,
+        }
+
+    def get_status(self, scripthash: str) -> Optional[str]:
+        history = self.histories.get(scripthash)
+        if not history:
+            return None
+        status = ''.join(f'{txid}:{height}:' for txid, height in history)
+        return bh2u(hashlib.sha256(status.encode('ascii')).digest())
+
+
+def bits_to_target(bits: int) -> int:
+    """Like Blockchain.bits_to_target, but also for the exponent of regtest bits."""
+    return (bits & 0xffffff) << (8 * ((bits >> 24) - 3))
+
+
+def mine_header(raw_header: bytes, height: int, bits: int) -> bytes:
+    """Searches a nonce for which the proof of work of height meets bits."""
+    target = bits_to_target(bits)
+    raw = bytearray(raw_header)
+    for nonce in range(2 ** 32):
+        raw[76:80] = nonce.to_bytes(4, 'little')
+        if int.from_bytes(pow_hash_header(bytes(raw), height), 'little') <= target:
+            return bytes(raw)
+    raise Exception(f'no nonce found for header at height {height}')
+
+
+def add_wallet_history(chain: SyntheticChain, addresses: Sequence[str], *, depth: int,
+                       txs_per_block: int = 100, value: int = 100_000) -> List[str]:
+    """Gives each address depth transactions paying to it, in new blocks
+    of at most txs_per_block transactions, in random order.
+    Returns the txids.
+    """
+    payments = []
+    for addr in addresses:
+        script = bfh(address_to_script(addr))
+        scripthash = script_to_scripthash(bh2u(script))
+        payments.extend([(scripthash, script)] * depth)
+    chain.rng.shuffle(payments)
+    txids = []
+    for i in range(0, len(payments), txs_per_block):
+        block = [(scripthash, chain.make_tx(script, value))
+                 for scripthash, script in payments[i:i + txs_per_block]]
+        chain.add_block([txid for scripthash, txid in block])
+        for scripthash, txid in block:
+            chain.add_to_history(scripthash, txid)
+            txids.append(txid)
+    return txids
+
+
+class StandinSession(RPCSession):
+
+    def __init__(self, server: 'StandinServer', *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.server = server
+        self.chain = server.chain
+        self.subscribed_headers = False
+        self.subscribed_scripthashes = set()  # type: Set[str]
+        self.handlers = {
+            'server.version': self.server_version,
+            'server.ping': self.ping,
+            'server.banner': self.banner,
+            'server.donation_address': self.donation_address,
+            'server.peers.subscribe': self.peers_subscribe,
+            'blockchain.relayfee': self.relayfee,
+            'blockchain.estimatefee': self.estimatefee,
+            'mempool.get_fee_histogram': self.fee_histogram,
+            'blockchain.headers.subscribe': self.headers_subscribe,
+            'blockchain.block.header': self.block_header,
+            'blockchain.block.headers': self.block_headers,
+            'blockchain.scripthash.subscribe': self.scripthash_subscribe,
+            'blockchain.scripthash.get_history': self.get_history,
+            'blockchain.transaction.get': self.transaction_get,
+            'blockchain.transaction.get_merkle': self.transaction_get_merkle,
+            'blockchain.transaction.broadcast': self.transaction_broadcast,
+        }
+
+    async def connection_lost(self):
+        await super().connection_lost()
+        self.server.sessions.discard(self)
+
+    async def handle_request(self, request):
+        self.server.num_requests += 1
+        await self.server.delay()
+        handler = self.handlers.get(request.method)
+        return await handler_invocation(handler, request)()
+
+    async def server_version(self, client_name='', protocol_version=None):
+        return ['StandinServer', version.PROTOCOL_VERSION]
+
+    async def ping(self):
+        return None
+
+    async def banner(self):
+        return ''
+
+    async def donation_address(self):
+        return ''
+
+    async def peers_subscribe(self):
+        return []
+
+    async def relayfee(self):
+        return 0.001
+
+    async def estimatefee(self, num_blocks):
+        return 0.001
+
+    async def fee_histogram(self):
+        return []
+
+    def _tip(self) -> dict:
+        height = self.chain.height
+        return {'hex': bh2u(self.chain.headers[height]), 'height': height}
+
+    async def headers_subscribe(self):
+        self.subscribed_headers = True
+        return self._tip()
+
+    async def block_header(self, height):
+        if not 0 <= height <= self.chain.height:
+            raise RPCError(1, f'height {height:,d} out of range')
+        return bh2u(self.chain.headers[height])
+
+    async def block_headers(self, start_height, count):
+        count = max(0, min(count, 2016, self.chain.height + 1 - start_height))
+        raw = b''.join(self.chain.headers[start_height:start_height + count])
+        return {'hex': bh2u(raw), 'count': count, 'max': 2016}
+
+    async def scripthash_subscribe(self, scripthash):
+        self.subscribed_scripthashes.add(scripthash)
+        return self.chain.get_status(scripthash)
+
+    async def get_history(self, scripthash):
+        return [{'tx_hash': txid, 'height': height}
+                for txid, height in self.chain.histories.get(scripthash, [])]
+
+    async def transaction_get(self, txid, verbose=False):
+        raw = self.chain.txs.get(txid) or self.server.mempool.get(txid)
+        if raw is None:
+            raise RPCError(2, 'No such mempool or blockchain transaction')
+        return bh2u(raw)
+
+    async def transaction_get_merkle(self, txid, height=None):
+        if txid not in self.chain.tx_positions:
+            raise RPCError(2, f'tx {txid} not in a block')
+        return self.chain.get_merkle(txid)
+
+    async def transaction_broadcast(self, raw_tx):
+        if self.server.broadcast_error is not None:
+            raise RPCError(1, self.server.broadcast_error)
+        raw = bfh(raw_tx)
+        txid = hash_encode(sha256d(raw))
+        if txid in self.chain.tx_positions:
+            raise RPCError(1, 'transaction already in block chain')
+        if txid in self.server.mempool:
+            raise RPCError(1, 'txn-already-in-mempool')
+        self.server.mempool[txid] = raw
+        return txid
+
+
+class StandinServer(Logger):
+    """Serves a SyntheticChain over TCP on localhost.
+    Each request is answered after latency seconds, plus up to jitter seconds.
+    With an ssl_context, the server talks TLS.
+    Broadcast transactions go to the mempool of the server, unless
+    broadcast_error is set, which is then returned as the error message.
+    """
+
+    def __init__(self, chain: SyntheticChain, *, latency: float = 0.0, jitter: float = 0.0,
+                 host: str = '127.0.0.1', port: int = 0, ssl_context: ssl.SSLContext = None):
+        Logger.__init__(self)
+        self.chain = chain
+        self.ssl_context = ssl_context
+        self.latency = latency
+        self.jitter = jitter
+        self.host = host
+        self.port = port
+        self.sessions = set()  # type: Set[StandinSession]
+        self.num_requests = 0
+        self.mempool = {}  # type: Dict[str, bytes]
+        self.broadcast_error = None  # type: Optional[str]
+        self._server = None
+        self._rng = random.Random(0)
+
+    async def delay(self) -> None:
+        delay = self.latency + self.jitter * self._rng.random()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _make_session(self, *args, **kwargs) -> StandinSession:
+        session = StandinSession(self, *args, **kwargs)
+        self.sessions.add(session)
+        return session
+
+    async def start(self) -> ServerAddr:
+        self._server = await serve_rs(self._make_session, self.host, self.port, ssl=self.ssl_context)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self.logger.info(f'serving {self.chain.height + 1} headers and {len(self.chain.txs)} txs '
+                         f'on {self.host}:{self.port}')
+        return self.server_addr
+
+    @property
+    def server_addr(self) -> ServerAddr:
+        return ServerAddr(self.host, self.port, protocol='s' if self.ssl_context else 't')
+
+    async def stop(self) -> None:
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        for session in list(self.sessions):
+            await session.close()
+        self._server = None
+
+    async def notify(self, scripthashes: Sequence[str] = ()) -> None:
+        """Tells the subscribed sessions about the current tip,
+        and about the new status of scripthashes.
+        """
+        for session in list(self.sessions):
+            if session.subscribed_headers:
+                await session.send_notification('blockchain.headers.subscribe', (session._tip(),))
+            for scripthash in scripthashes:
+                if scripthash in session.subscribed_scripthashes:
+                    await session.send_notification('blockchain.scripthash.subscribe',
+                                                    (scripthash, self.chain.get_status(scripthash)))
@@ -27,14 +27,19 @@ import threading
 import stat
 import hashlib
 import base64
+import json
 import zlib
 from enum import IntEnum
+from typing import Optional, Tuple
 
 from . import ecc
+from .crypto import hmac_oneshot, chacha20_poly1305_encrypt, chacha20_poly1305_decrypt
 from .util import (profiler, InvalidPassword, WalletFileException, bfh, standardize_path,
                    test_read_write_permissions)
 
 from .wallet_db import WalletDB
+from .json_db import split_journal
+from .sqlite_wallet_db import is_sqlite_file, read_meta, RowCipher
 from .logging import Logger
 
 
@@ -48,11 +53,119 @@ class StorageEncryptionVersion(IntEnum):
     PLAINTEXT = 0
     USER_PASSWORD = 1
     XPUB_PASSWORD = 2
+    USER_PASSWORD_BLOCKS = 3
+    XPUB_PASSWORD_BLOCKS = 4
+
+
+# the versions that changes can be appended to, used once the journal is
+# enabled (see Abstract_Wallet.enable_file_journal). older versions cannot read them
+_BLOCKS_VERSIONS = {
+    StorageEncryptionVersion.USER_PASSWORD: StorageEncryptionVersion.USER_PASSWORD_BLOCKS,
+    StorageEncryptionVersion.XPUB_PASSWORD: StorageEncryptionVersion.XPUB_PASSWORD_BLOCKS,
+}
+
+_ENCRYPTION_MAGIC = {
+    StorageEncryptionVersion.USER_PASSWORD: b'BIE1',
+    StorageEncryptionVersion.XPUB_PASSWORD: b'BIE2',
+    StorageEncryptionVersion.USER_PASSWORD_BLOCKS: b'BLK1',
+    StorageEncryptionVersion.XPUB_PASSWORD_BLOCKS: b'BLK2',
+}
+
+BLOCK_SIZE = 1024 * 1024  # of the json, before compression
 
 
 class StorageReadWriteError(Exception): pass
 
 
+class BlockCipher:
+    """Encrypts the blocks of a wallet file, for the *_BLOCKS encryption versions.
+
+    The file is made of lines, each an encrypted and authenticated block:
+    an index first, then the blocks of the last full write, then the
+    journal records appended since (see WalletDB._write). The index holds
+    the number of blocks, and a random id of the full write, which every
+    block is bound to along with its position, so that blocks cannot be
+    moved around or mixed between files.
+    """
+
+    def __init__(self, secret: bytes):
+        self._key = hmac_oneshot(b'electrum wallet file blocks', secret, hashlib.sha256)
+
+    @classmethod
+    def from_eckey(cls, ec_key: ecc.ECPrivkey) -> 'BlockCipher':
+        return cls(ec_key.get_secret_bytes())
+
+    def seal(self, data: bytes, associated_data: bytes) -> str:
+        nonce = os.urandom(12)
+        c = chacha20_poly1305_encrypt(key=self._key, nonce=nonce, associated_data=associated_data,
+                                      data=zlib.compress(data, level=zlib.Z_BEST_SPEED))
+        return base64.b64encode(nonce + c).decode('ascii')
+
+    def unseal(self, line: str, associated_data: bytes) -> bytes:
+        """Raises ValueError if the block is not authentic."""
+        c = base64.b64decode(line, validate=True)
+        data = chacha20_poly1305_decrypt(key=self._key, nonce=c[:12], associated_data=associated_data,
+                                         data=c[12:])
+        return zlib.decompress(data)
+
+    @staticmethod
+    def _block_ad(magic: bytes, file_id: bytes, kind: bytes, i: int) -> bytes:
+        return magic + file_id + kind + i.to_bytes(4, 'big')
+
+    def encrypt(self, plaintext: str, magic: bytes) -> Tuple[str, bytes]:
+        """Returns the contents of the file, and the id of this full write."""
+        file_id = os.urandom(16)
+        data = plaintext.encode('utf8')
+        blocks = [data[i:i+BLOCK_SIZE] for i in range(0, len(data), BLOCK_SIZE)] or [b'']
+        index = json.dumps({'file_id': file_id.hex(), 'num_blocks': len(blocks)})
+        lines = [base64.b64encode(magic).decode('ascii') + self.seal(index.encode('utf8'), magic)]
+        for i, block in enumerate(blocks):
+            lines.append(self.seal(block, self._block_ad(magic, file_id, b'block', i)))
+        return '\n'.join(lines), file_id
+
+    def encrypt_journal_record(self, record: str, magic: bytes, file_id: bytes, i: int) -> str:
+        return self.seal(record.encode('utf8'), self._block_ad(magic, file_id, b'journal', i))
+
+    def decrypt(self, raw: str, magic: bytes) -> Tuple[str, bytes, int, int, bool]:
+        """Returns the json with its journal, the id of the full write,
+        the size of the full write, the number of journal records, and
+        whether the last record was written completely.
+        """
+        lines = raw.split('\n')
+        header = lines[0]
+        magic_prefix = base64.b64encode(magic).decode('ascii')
+        assert header.startswith(magic_prefix)
+        try:
+            index = json.loads(self.unseal(header[len(magic_prefix):], magic))
+        except ValueError:
+            raise InvalidPassword()
+        file_id = bytes.fromhex(index['file_id'])
+        num_blocks = index['num_blocks']
+        if len(lines) < 1 + num_blocks:
+            raise WalletFileException("Cannot read wallet file. (blocks missing)")
+        try:
+            data = b''.join(self.unseal(lines[1 + i], self._block_ad(magic, file_id, b'block', i))
+                            for i in range(num_blocks))
+        except ValueError as e:
+            raise WalletFileException("Cannot read wallet file. (block failed authentication)") from e
+        parts = [data.decode('utf8')]
+        snapshot_size = sum(len(line) + 1 for line in lines[:1 + num_blocks]) - 1
+        records = lines[1 + num_blocks:]
+        is_complete = True
+        for i, line in enumerate(records):
+            try:
+                record = self.unseal(line, self._block_ad(magic, file_id, b'journal', i))
+            except ValueError as e:
+                if i == len(records) - 1:
+                    # interrupted while appending it
+                    is_complete = False
+                    break
+                raise WalletFileException("Cannot read wallet file. (journal failed authentication)") from e
+            parts.append(record.decode('utf8'))
+        num_records = len(records) if is_complete else len(records) - 1
+        return '\n'.join(parts), file_id, snapshot_size, num_records, is_complete
+
+
 # TODO: Rename to Storage
 class WalletStorage(Logger):
 
@@ -63,23 +176,47 @@ class WalletStorage(Logger):
         self.logger.info(f"wallet path {self.path}")
         self.pubkey = None
         self.decrypted = ''
+        # for the *_BLOCKS encryption versions
+        self.block_cipher = None  # type: Optional[BlockCipher]
+        self._file_id = None  # type: Optional[bytes]
+        self._num_journal_records = 0
+        # for sqlite files, which are read by the db (see load_wallet_db)
+        self._is_sqlite = False
+        self.row_cipher = None  # type: Optional[RowCipher]
         try:
             test_read_write_permissions(self.path)
         except IOError as e:
             raise StorageReadWriteError(e) from e
-        if self.file_exists():
+        if self.file_exists() and is_sqlite_file(self.path):
+            self._is_sqlite = True
+            self.raw = ''
+            self._encryption_version = StorageEncryptionVersion(int(read_meta(self.path)['encryption_version']))
+            if not self.is_encrypted():
+                self.row_cipher = RowCipher(None)
+        elif self.file_exists():
             with open(self.path, "r", encoding='utf-8') as f:
                 self.raw = f.read()
             self._encryption_version = self._init_encryption_version()
         else:
             self.raw = ''
             self._encryption_version = StorageEncryptionVersion.PLAINTEXT
+        # sizes of the last full write, and of the journal appended to it since
+        snapshot, journal = split_journal(self.raw) if not self.is_encrypted() else (self.raw, '')
+        self._snapshot_size = len(snapshot)
+        self._journal_size = len(journal)
+        # whether the journal can be appended to the file on disk, with the current key
+        self._can_append = self.file_exists() and not self.is_encrypted() and not self.is_sqlite()
 
     def read(self):
+        assert not self.is_sqlite()
         return self.decrypted if self.is_encrypted() else self.raw
 
     def write(self, data: str) -> None:
-        s = self.encrypt_before_writing(data)
+        assert not self.is_sqlite()
+        if self.uses_blocks():
+            s, file_id = self.block_cipher.encrypt(data, self._get_encryption_magic())
+        else:
+            s, file_id = self.encrypt_before_writing(data), None
         temp_path = "%s.tmp.%s" % (self.path, os.getpid())
         with open(temp_path, "w", encoding='utf-8') as f:
             f.write(s)
@@ -97,11 +234,46 @@ class WalletStorage(Logger):
         os.replace(temp_path, self.path)
         os.chmod(self.path, mode)
         self._file_exists = True
+        self._snapshot_size = len(s)
+        self._journal_size = 0
+        self._file_id = file_id
+        self._num_journal_records = 0
+        self._can_append = not self.is_encrypted() or self.uses_blocks()
         self.logger.info(f"saved {self.path}")
 
+    def append(self, data: str) -> None:
+        """Appends a line to the journal of the file (see can_append)."""
+        assert self.can_append()
+        if self.is_encrypted():
+            data = self.block_cipher.encrypt_journal_record(
+                data, self._get_encryption_magic(), self._file_id, self._num_journal_records)
+            self._num_journal_records += 1
+        s = '\n' + data
+        with open(self.path, "a", encoding='utf-8') as f:
+            f.write(s)
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_size += len(s)
+
+    def can_append(self) -> bool:
+        """Whether changes can be appended to the file, instead of rewriting it.
+        Files encrypted with the legacy versions are always rewritten. Note
+        that changes are only appended once the wallet enabled it.
+        """
+        return self._can_append
+
+    def needs_compaction(self) -> bool:
+        """Whether the file should be rewritten, as replaying its journal
+        would take longer than reading a full write.
+        """
+        return self._journal_size > self._snapshot_size
+
     def file_exists(self) -> bool:
         return self._file_exists
 
+    def is_sqlite(self) -> bool:
+        return self._is_sqlite
+
     def is_past_initial_decryption(self):
         """Return if storage is in a usable state for normal operations.
 
@@ -116,10 +288,16 @@ class WalletStorage(Logger):
         return self.get_encryption_version() != StorageEncryptionVersion.PLAINTEXT
 
     def is_encrypted_with_user_pw(self):
-        return self.get_encryption_version() == StorageEncryptionVersion.USER_PASSWORD
+        return self.get_encryption_version() in (StorageEncryptionVersion.USER_PASSWORD,
+                                                 StorageEncryptionVersion.USER_PASSWORD_BLOCKS)
 
     def is_encrypted_with_hw_device(self):
-        return self.get_encryption_version() == StorageEncryptionVersion.XPUB_PASSWORD
+        return self.get_encryption_version() in (StorageEncryptionVersion.XPUB_PASSWORD,
+                                                 StorageEncryptionVersion.XPUB_PASSWORD_BLOCKS)
+
+    def uses_blocks(self) -> bool:
+        """Whether the file is written as encrypted blocks, which the journal can be appended to."""
+        return self.get_encryption_version() in _BLOCKS_VERSIONS.values()
 
     def get_encryption_version(self):
         """Return the version of encryption used for this storage.
@@ -129,18 +307,21 @@ class WalletStorage(Logger):
         ECIES, private key derived from a password,
         1: password is provided by user
         2: password is derived from an xpub; used with hw wallets
+
+        ChaCha20-Poly1305 blocks (see BlockCipher), key derived from the private key,
+        3: password is provided by user
+        4: password is derived from an xpub; used with hw wallets
         """
         return self._encryption_version
 
     def _init_encryption_version(self):
         try:
-            magic = base64.b64decode(self.raw)[0:4]
-            if magic == b'BIE1':
-                return StorageEncryptionVersion.USER_PASSWORD
-            elif magic == b'BIE2':
-                return StorageEncryptionVersion.XPUB_PASSWORD
-            else:
-                return StorageEncryptionVersion.PLAINTEXT
+            # the blocks of the *_BLOCKS versions are on separate lines
+            magic = base64.b64decode(self.raw.split('\n', 1)[0][:8])[0:4]
+            for version, m in _ENCRYPTION_MAGIC.items():
+                if magic == m:
+                    return version
+            return StorageEncryptionVersion.PLAINTEXT
         except:
             return StorageEncryptionVersion.PLAINTEXT
 
@@ -152,10 +333,8 @@ class WalletStorage(Logger):
 
     def _get_encryption_magic(self):
         v = self._encryption_version
-        if v == StorageEncryptionVersion.USER_PASSWORD:
-            return b'BIE1'
-        elif v == StorageEncryptionVersion.XPUB_PASSWORD:
-            return b'BIE2'
+        if v in _ENCRYPTION_MAGIC:
+            return _ENCRYPTION_MAGIC[v]
         else:
             raise WalletFileException('no encryption magic for version: %s' % v)
 
@@ -163,12 +342,30 @@ class WalletStorage(Logger):
         if self.is_past_initial_decryption():
             return
         ec_key = self.get_eckey_from_password(password)
-        if self.raw:
+        if self.is_sqlite():
+            row_cipher = RowCipher.from_eckey(ec_key)
+            if row_cipher.get_password_check() != read_meta(self.path)['password_check']:
+                raise InvalidPassword()
+            self.row_cipher = row_cipher
+            self.pubkey = ec_key.get_public_key_hex()
+            return
+        block_cipher = BlockCipher.from_eckey(ec_key)
+        if self.uses_blocks():
+            s, file_id, snapshot_size, num_records, is_complete = block_cipher.decrypt(
+                self.raw, self._get_encryption_magic())
+            self._file_id = file_id
+            self._num_journal_records = num_records
+            self._snapshot_size = snapshot_size
+            self._journal_size = len(self.raw) - snapshot_size
+            # an interrupted append is overwritten by a full write
+            self._can_append = is_complete
+        elif self.raw:
             enc_magic = self._get_encryption_magic()
             s = zlib.decompress(ec_key.decrypt_message(self.raw, enc_magic))
             s = s.decode('utf8')
         else:
             s = ''
+        self.block_cipher = block_cipher
         self.pubkey = ec_key.get_public_key_hex()
         self.decrypted = s
 
@@ -193,19 +390,37 @@ class WalletStorage(Logger):
         if self.pubkey != self.get_eckey_from_password(password).get_public_key_hex():
             raise InvalidPassword()
 
-    def set_password(self, password, enc_version=None):
-        """Set a password to be used for encrypting this storage."""
+    def set_password(self, password, enc_version=None, *, use_blocks: bool = None):
+        """Set a password to be used for encrypting this storage.
+        With use_blocks, the file is encrypted as blocks that changes can be
+        appended to. It defaults to whether the file already is, or whether
+        enc_version is one of the *_BLOCKS versions.
+        """
         if not self.is_past_initial_decryption():
             raise Exception("storage needs to be decrypted before changing password")
         if enc_version is None:
             enc_version = self._encryption_version
+        if use_blocks is None:
+            use_blocks = self.uses_blocks() or enc_version in _BLOCKS_VERSIONS.values()
+        for legacy_version, blocks_version in _BLOCKS_VERSIONS.items():
+            if enc_version in (legacy_version, blocks_version):
+                enc_version = blocks_version if use_blocks and not self.is_sqlite() else legacy_version
+        # the file has to be rewritten with the new key
+        self._can_append = False
         if password and enc_version != StorageEncryptionVersion.PLAINTEXT:
             ec_key = self.get_eckey_from_password(password)
             self.pubkey = ec_key.get_public_key_hex()
             self._encryption_version = enc_version
+            if self.is_sqlite():
+                self.row_cipher = RowCipher.from_eckey(ec_key)
+            else:
+                self.block_cipher = BlockCipher.from_eckey(ec_key)
         else:
             self.pubkey = None
             self._encryption_version = StorageEncryptionVersion.PLAINTEXT
+            self.block_cipher = None
+            if self.is_sqlite():
+                self.row_cipher = RowCipher(None)
 
     def basename(self) -> str:
         return os.path.basename(self.path)
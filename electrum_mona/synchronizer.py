@@ -36,6 +36,7 @@ from .util import bh2u, make_aiohttp_session, NetworkJobOnDefaultServer, random_
 from .bitcoin import address_to_scripthash, is_address
 from .logging import Logger
 from .interface import GracefulDisconnect
+from .request_scheduler import JobPriority, RequestSlot
 
 if TYPE_CHECKING:
     from .network import Network
@@ -167,7 +168,9 @@ class Synchronizer(SynchronizerBase):
         self.requested_histories.add((addr, status))
         h = address_to_scripthash(addr)
         self._requests_sent += 1
-        result = await self.interface.get_history_for_scripthash(h)
+        # requests for many addresses at once, e.g. when restoring a wallet, go out in batches
+        async with self.network.request_scheduler.slot(self.interface.server, JobPriority.HISTORY):
+            result = await self.interface.get_history_for_scripthash(h, batched=True)
         self._requests_answered += 1
         self.logger.info(f"receiving history {addr} {len(result)}")
         hashes = set(map(lambda item: item['tx_hash'], result))
@@ -203,14 +206,24 @@ class Synchronizer(SynchronizerBase):
             self.requested_tx[tx_hash] = tx_height
 
         if not transaction_hashes: return
+        # the requests are spawned as fast as the scheduler lets us,
+        # and the ones spawned at once get sent as JSON-RPC batches
+        scheduler = self.network.request_scheduler
         async with TaskGroup() as group:
             for tx_hash in transaction_hashes:
-                await group.spawn(self._get_transaction(tx_hash, allow_server_not_finding_tx=allow_server_not_finding_tx))
-
-    async def _get_transaction(self, tx_hash, *, allow_server_not_finding_tx=False):
+                # cache hits do not take a slot: the server is not asked
+                raw_tx = await self.network.get_cached_transaction(tx_hash)
+                if raw_tx is not None:
+                    self._receive_tx(tx_hash, raw_tx)
+                    continue
+                await scheduler.spawn(group, self.interface.server, JobPriority.TX,
+                                      self._get_transaction, tx_hash, allow_server_not_finding_tx)
+
+    async def _get_transaction(self, tx_hash, allow_server_not_finding_tx=False, *, slot: RequestSlot):
         self._requests_sent += 1
         try:
-            raw_tx = await self.interface.get_transaction(tx_hash)
+            async with slot:
+                raw_tx = await self.interface.get_transaction(tx_hash, batched=True)
         except RPCError as e:
             # most likely, "No such mempool or blockchain transaction"
             if allow_server_not_finding_tx:
@@ -220,6 +233,10 @@ class Synchronizer(SynchronizerBase):
                 raise
         finally:
             self._requests_answered += 1
+        self._receive_tx(tx_hash, raw_tx)
+        await self.network.cache_transaction(tx_hash, raw_tx)
+
+    def _receive_tx(self, tx_hash: str, raw_tx: str) -> None:
         tx = Transaction(raw_tx)
         if tx_hash != tx.txid():
             raise SynchronizerFailure(f"received tx does not match expected txid ({tx_hash} != {tx.txid()})")
@@ -1,15 +1,25 @@
+import asyncio
 import shutil
 import tempfile
 import os
+import random
+import threading
+import time
+from unittest import mock
 
 from electrum_mona import constants, blockchain
 from electrum_mona.simple_config import SimpleConfig
-from electrum_mona.blockchain import Blockchain, deserialize_header, hash_header
+from electrum_mona.blockchain import (Blockchain, deserialize_header, hash_header, hash_raw_header, DGWv3Calculator,
+                                     MissingHeader, InvalidHeader, HeaderBatch, HEADER_SIZE, serialize_header)
 from electrum_mona.util import bh2u, bfh, make_dir
 
 from . import ElectrumTestCase
 
 
+# mainnet headers 2206513 to 2206543, just after the checkpoints
+DGW_CHECKPOINT_HEADERS = {2206513: {'version': 536870912, 'prev_block_hash': '79f9cf8a46f1c823db1005a5f879bbc5e0c3250c516986b80679a900a465b37f', 'merkle_root': 'df6f4798d813f2e2545c538c579a97b95c4af4f522ac49401483a19e0de8d47d', 'timestamp': 1609444650, 'bits': 436604928, 'nonce': 2204928177, 'block_height': 2206513}, 2206514: {'version': 536870912, 'prev_block_hash': 'a3a9fa4099bfb3b251490be1e9f5a509cad82dc44c217d9a7ff1ac44f6e1b2fb', 'merkle_root': '06a9bb6b66584de4d3f9d5bfc44fcd894f7df4419787263918702370fb9cf0d7', 'timestamp': 1609444702, 'bits': 436625476, 'nonce': 329943414, 'block_height': 2206514}, 2206515: {'version': 536870912, 'prev_block_hash': '109b0bd3ea80416d1a97c0340b277feac76f6ee0297f3dfba00ece9f53f836f7', 'merkle_root': '71b4078000d4c47602222ff594c525d6b975c82dd25b3fd7fa67d3bad86d8386', 'timestamp': 1609444825, 'bits': 436632771, 'nonce': 1451552657, 'block_height': 2206515}, 2206516: {'version': 536870912, 'prev_block_hash': '1fb8ed778b8e8102ee7ceea672dc06d7f6faccc47582e909530ce6e46d7374d4', 'merkle_root': '57796791a3ea547a780a6bb8c6cab38c9565069af5f0616f7e205cc4f71cab04', 'timestamp': 1609444842, 'bits': 436624710, 'nonce': 2528808502, 'block_height': 2206516}, 2206517: {'version': 536870912, 'prev_block_hash': '5d389d2b68474a5f19e6a92e2e92ce567e948ad5aa0bf4e459aa87f5a5fca637', 'merkle_root': '5cbc97c215a95e75fe4bcbd5789bfb8a86792a738247b68426938b40e1504a4b', 'timestamp': 1609444994, 'bits': 436607628, 'nonce': 3198985056, 'block_height': 2206517}, 2206518: {'version': 536870912, 'prev_block_hash': '84815942d62032fcb2c5bc3b8991c09dde040190f63b9d9ebe46b340b2cd3d6c', 'merkle_root': 'c0da13cb17bff5bc2a2331ad6d41ba30eba738efffdefd3c38183faa9234612c', 'timestamp': 1609445310, 'bits': 436632069, 'nonce': 1627859591, 'block_height': 2206518}, 2206519: {'version': 536870912, 'prev_block_hash': 'c45cc191df1a721c6fa95201cb5e731825160f254f3ca5ff1ca9760a5822ee8b', 'merkle_root': '37860a177a12504292339d5c2f0e6ada37a3602b1d1734e6ae9d4c41ea59f54d', 'timestamp': 1609445334, 'bits': 436631610, 'nonce': 2638329250, 'block_height': 2206519}, 2206520: {'version': 536870912, 'prev_block_hash': 'adf2460927e1e4aad0bf1523323e07b127c35345add7a747f31a7c91121ff63e', 'merkle_root': '9170108d7c0c9259592afa4de3d3e7050e08a735d124318c734e2abf8f6664a6', 'timestamp': 1609445589, 'bits': 436576387, 'nonce': 3625981221, 'block_height': 2206520}, 2206521: {'version': 536870912, 'prev_block_hash': 'a21753dbaf91b13f9201907987a94f24ec733c5c135c98a9e745802ddd99eeca', 'merkle_root': '14fc0e2c98fddfcc4dfc4a06ecfa25789cef80a3db7a3eb6fe1c1f7b5c58a09e', 'timestamp': 1609445713, 'bits': 436624231, 'nonce': 3913376559, 'block_height': 2206521}, 2206522: {'version': 536870912, 'prev_block_hash': 'c015a44dca079df75b4359cef86a56c0c83daafd99ee7f4e4e6a3b973e3cf68d', 'merkle_root': '846fff888522311773f8e799934ba37dff875e768540dcdf3096cff3faaa70d0', 'timestamp': 1609445772, 'bits': 436630768, 'nonce': 2444283459, 'block_height': 2206522}, 2206523: {'version': 536870912, 'prev_block_hash': '4a68c57457302e8dfcce11b2bfd687dfd676d7ee73b6de4f8c7c1ea7c7caa8d5', 'merkle_root': 'f89d5a02a3e60fa0d0a76548755ee10f657fe8cf14d20c195df661c0395dc2df', 'timestamp': 1609445813, 'bits': 436632462, 'nonce': 1189974575, 'block_height': 2206523}, 2206524: {'version': 536870912, 'prev_block_hash': 'f8fb4f308a3059f427ab617976f0f8f997f9f85c23ee1155204b30897ae32004', 'merkle_root': '1d4de9345567a065e1524fd56465f59eee2732fb3d4d29c41447ba2aa676dedc', 'timestamp': 1609445829, 'bits': 436624998, 'nonce': 3623875361, 'block_height': 2206524}, 2206525: {'version': 536870912, 'prev_block_hash': '1a397adbec8fbabcbb17194f4785f2e47f4335b76c04a30421dfaa422f04cd15', 'merkle_root': '428a9bc92c90cb7e924415f9d9677fc76edb82289b1145be99611200c3ee0a34', 'timestamp': 1609445845, 'bits': 436616917, 'nonce': 632717637, 'block_height': 2206525}, 2206526: {'version': 536870912, 'prev_block_hash': 'e3dc75e8dfa601bb91615cbb3d50b216f3d6c83f3f6e991d982d95aa88025ab4', 'merkle_root': '836f81e989916f694c674fcf8da11167b8a6f26e86b1e04d51514c22c430bd23', 'timestamp': 1609445997, 'bits': 436606062, 'nonce': 2130612094, 'block_height': 2206526}, 2206527: {'version': 536870912, 'prev_block_hash': '240eff2862051667cd689d214d896f8e78eec3a844a368be841ec00a6005eacf', 'merkle_root': '1c685361ea5fbac52a4b876c4c7bf5c60d94f6c31523319dd31e3f1c87f4d01e', 'timestamp': 1609446064, 'bits': 436621155, 'nonce': 3355082659, 'block_height': 2206527}, 2206528: {'version': 536870912, 'prev_block_hash': '17cf5b52259574e136520b7810928dcbf8e6d2725fca5271ecdb1288de78b79c', 'merkle_root': 'e53478cb75d397b9d168a23d9d6b18d241029ccce75966f2a1635d88d4f55507', 'timestamp': 1609446097, 'bits': 436622203, 'nonce': 2427283207, 'block_height': 2206528}, 2206529: {'version': 536870912, 'prev_block_hash': 'ceceb35eb792cd7728b779d8bde0c063948964608b2fb5fc08e28b97389f70b0', 'merkle_root': '00e724c066d68c04fa033cc228f4faf9139360f16e24f11ff8f6bcb5d09c2f56', 'timestamp': 1609446108, 'bits': 436617031, 'nonce': 12246852, 'block_height': 2206529}, 2206530: {'version': 536870912, 'prev_block_hash': '9fbeb81d66a9690389e6fa4af51fb5cb58b5e1985814a0e3c9282a0b743bc9c1', 'merkle_root': '900a55f729f0ffc485573f14a2eb6ad98e09f062d3b4f14d29ee86b674f80631', 'timestamp': 1609446465, 'bits': 436610673, 'nonce': 3113809169, 'block_height': 2206530}, 2206531: {'version': 536870912, 'prev_block_hash': '83e32b6cec70692839a31254d7e1e54cde9e4ebd609909aea911c1ccb6f3bcea', 'merkle_root': '8753aefb0807ce00d6dd08af39c9546d9d99b5058b71325fcee16e825ebad1d5', 'timestamp': 1609446495, 'bits': 436652811, 'nonce': 4034390885, 'block_height': 2206531}, 2206532: {'version': 536870912, 'prev_block_hash': '4972be8a70cc57ec5ac8797a70ddfe649e53399b956d9dc6f7c441980398a148', 'merkle_root': 'fba036cbf0ae13be324c0cadbb1f5394df5e31730d3f26446acbe71cfa8c8cad', 'timestamp': 1609446538, 'bits': 436651818, 'nonce': 3995783605, 'block_height': 2206532}, 2206533: {'version': 536870912, 'prev_block_hash': 'ee827023ec8ff367ca696f1ef15428a938f659eede017edb73c5e18926a4be45', 'merkle_root': '3a77f5c65e241bc0f98e7c769856ba8ceab5ee6acac2f6e4179d5c8cccf7a9e7', 'timestamp': 1609446687, 'bits': 436624837, 'nonce': 3037641522, 'block_height': 2206533}, 2206534: {'version': 536870912, 'prev_block_hash': '1ecbba9436fc30f6f754d3bf23dce7ea14b043c87b9f6ced3724687ae4c4e4a5', 'merkle_root': 'b35280e639c58d2fbd6c68259d6a36c36fa22079fd5c395c2671bedf3f7fb6e0', 'timestamp': 1609446816, 'bits': 436644078, 'nonce': 570649684, 'block_height': 2206534}, 2206535: {'version': 536870912, 'prev_block_hash': '4f244738562a8d5043647226bf365562b21c7969307adfae62c27f55efd15bb7', 'merkle_root': '9a5d1d4dfc02cd2deea1ad45fcf009e1c71aefdcf37b2e246e2984ef1de16900', 'timestamp': 1609446927, 'bits': 436667852, 'nonce': 3209124518, 'block_height': 2206535}, 2206536: {'version': 536870912, 'prev_block_hash': '8458f4914392ca79bed665183325028a9dc923a5bd9adcffb71504418df4c85b', 'merkle_root': 'c8a0b1dc4eaf05a864a3e4b18d80c0a01241c5467efc77abfb6dbe8a62c0d17f', 'timestamp': 1609446940, 'bits': 436678347, 'nonce': 1558666374, 'block_height': 2206536}, 2206537: {'version': 536870912, 'prev_block_hash': '950e1e6fde2374c4e6b5c6410de17aa06cc529e744f37dd0c32c64dd1d7bb746', 'merkle_root': 'aed89fdc09cdf3893d35a62df0182c943cc3a0309b4251d5f9923c85acc08c70', 'timestamp': 1609447234, 'bits': 436655004, 'nonce': 1640074009, 'block_height': 2206537}, 2206538: {'version': 536870912, 'prev_block_hash': '28bc9fdd7ab0d15f567645e174c7e3ea7027ef90611e730b5462a6282946d0b9', 'merkle_root': '72a363391d361998612c938f3ced45273d810eec5d23c1ba6154f4ed9725679b', 'timestamp': 1609447281, 'bits': 436703536, 'nonce': 4023305371, 'block_height': 2206538}, 2206539: {'version': 536870912, 'prev_block_hash': '7a558e121576bf037355022758126a6dcff6eb1196d1a6637f9b0d66631f178f', 'merkle_root': 'b5508485f20a33c62f5b54c0ae8e93a5fb448f6d59493fed8e7c44a0c80d83c8', 'timestamp': 1609447384, 'bits': 436694408, 'nonce': 739444754, 'block_height': 2206539}, 2206540: {'version': 536870912, 'prev_block_hash': '918ffd6a492a437afc25cc54921f9f62b7c8ba84529b5c4de36afc1693e7fe32', 'merkle_root': 'd5aeafdb55ea5e1ed86fc03b6789964bf2bc1f828782cd356d1a31ecb49b9887', 'timestamp': 1609447413, 'bits': 436713926, 'nonce': 1895755322, 'block_height': 2206540}, 2206541: {'version': 536870912, 'prev_block_hash': '02755cd1cec2f837100165b0106050b2eb4ed7869b19e2605a7c828e7d515452', 'merkle_root': '1ce0429268d986fdd324b6fbb3119126288bffd7adf71b50dc2abac011956d3f', 'timestamp': 1609447455, 'bits': 436694298, 'nonce': 2787690507, 'block_height': 2206541}, 2206542: {'version': 536870912, 'prev_block_hash': 'd227495a03fec3ae3ab4d33389f8ddff2924bf52b4e397fef064e47d2b80b3be', 'merkle_root': 'e59c530f17cd030c80090c5aff4a998890b92472d723843248f63ff04a3fd141', 'timestamp': 1609447500, 'bits': 436641834, 'nonce': 3636446255, 'block_height': 2206542}, 2206543: {'version': 536870912, 'prev_block_hash': '30594681b22092a3ba73b532accc7835f117984098164cd10bb9a8c4272e33f3', 'merkle_root': '66ad5a4a7c9037f69d47a1103a8a3ecc1103b75891b2ac0280567431cfccd549', 'timestamp': 1609447533, 'bits': 436644373, 'nonce': 850699273, 'block_height': 2206543}}
+
+
 class TestBlockchain(ElectrumTestCase):
 
     HEADERS = {
@@ -166,6 +176,223 @@ class TestBlockchain(ElectrumTestCase):
         self._append_header(chain_z, self.HEADERS['Y'])
         self._append_header(chain_z, self.HEADERS['Z'])
 
+    def test_header_store_follows_writes_and_swaps(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEFOPQR':
+            self._append_header(chain_u, self.HEADERS[name])
+
+        raw = chain_u.read_raw_header(3)
+        self.assertIsInstance(raw, memoryview)
+        self.assertEqual(hash_header(self.HEADERS['D']), hash_raw_header(bh2u(raw)))
+        self.assertIsNone(chain_u.read_raw_header(10))
+
+        chain_l = chain_u.fork(self.HEADERS['G'])
+        for name in 'HIJK':
+            self._append_header(chain_l, self.HEADERS[name])
+
+        # chain_l overtook chain_u and they swapped files
+        self.assertEqual(None, chain_l.parent)
+        self.assertEqual(chain_l, chain_u.parent)
+        for name in 'ABCDEFGHIJK':
+            header = self.HEADERS[name]
+            self.assertEqual(header, chain_l.read_header(header['block_height']))
+        for name in 'ABCDEFOPQR':
+            header = self.HEADERS[name]
+            self.assertEqual(header, chain_u.read_header(header['block_height']))
+
+    def test_hash_index_follows_writes_and_swaps(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEFOPQR':
+            self._append_header(chain_u, self.HEADERS[name])
+        chain_l = chain_u.fork(self.HEADERS['G'])
+        for name in 'HIJK':
+            self._append_header(chain_l, self.HEADERS[name])
+        self.assertEqual(chain_l, chain_u.parent)
+
+        def check_hashes(chain_l, chain_u):
+            for chain, names in ((chain_l, 'BCDEFGHIJK'), (chain_u, 'BCDEFOPQR')):
+                for name in names:
+                    header = self.HEADERS[name]
+                    height = header['block_height']
+                    self.assertEqual(hash_header(header), chain.get_hash(height))
+                    self.assertTrue(chain.check_hash(height, hash_header(header)))
+                    self.assertFalse(chain.check_hash(height + 1, hash_header(header)))
+                with self.assertRaises(MissingHeader):
+                    chain.get_hash(chain.height() + 1)
+        check_hashes(chain_l, chain_u)
+        # hashes are stored next to the file that holds the header: the files
+        # were not rewritten when chain_l overtook chain_u, just renamed
+        self.assertEqual(10 * 32, os.path.getsize(chain_l.path() + '.hashes'))
+        self.assertEqual(5 * 32, os.path.getsize(chain_u.path() + '.hashes'))
+
+        # headers saved without an index get indexed on first use
+        for chain in (chain_l, chain_u):
+            os.unlink(chain.path() + '.hashes')
+        reloaded_l = Blockchain(config=self.config, forkpoint=0, parent=None,
+                                forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        reloaded_u = Blockchain(config=self.config, forkpoint=chain_u.forkpoint, parent=reloaded_l,
+                                forkpoint_hash=chain_u.get_id(), prev_hash=chain_u._prev_hash)
+        check_hashes(reloaded_l, reloaded_u)
+        self.assertEqual(10 * 32, os.path.getsize(chain_l.path() + '.hashes'))
+        self.assertEqual(5 * 32, os.path.getsize(chain_u.path() + '.hashes'))
+
+    def test_writes_are_synced_once_per_batch(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        data = b''.join(bfh(serialize_header(self.HEADERS[name])) for name in 'ABCDEF')
+        with mock.patch('os.fsync', wraps=os.fsync) as fsync:
+            chain_u.save_chunk(0, data)
+        # the headers, then their hashes
+        self.assertEqual(2, fsync.call_count)
+        # rebuilding the hash index on reads does not sync
+        chain_u._own_segment().delete_hashes()
+        with mock.patch('os.fsync', wraps=os.fsync) as fsync:
+            self.assertEqual(hash_header(self.HEADERS['D']), chain_u.get_hash(3))
+        self.assertEqual(0, fsync.call_count)
+
+    def test_swap_shares_files_until_compacted(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEFOPQR':
+            self._append_header(chain_u, self.HEADERS[name])
+        chain_l = chain_u.fork(self.HEADERS['G'])
+        for name in 'HIJK':
+            self._append_header(chain_l, self.HEADERS[name])
+        self.assertEqual(chain_l, chain_u.parent)
+
+        def check_headers(chain_l, chain_u):
+            for chain, names in ((chain_l, 'ABCDEFGHIJK'), (chain_u, 'ABCDEFOPQR')):
+                self.assertEqual(len(names) - 1, chain.height())
+                for name in names:
+                    header = self.HEADERS[name]
+                    self.assertEqual(header, chain.read_header(header['block_height']))
+        check_headers(chain_l, chain_u)
+        # no headers were copied: chain_l took over the main file, the fork
+        # file was renamed, and the chains point into each other's files
+        self.assertEqual(10 * HEADER_SIZE, os.path.getsize(chain_l.path()))
+        self.assertEqual(5 * HEADER_SIZE, os.path.getsize(chain_u.path()))
+        self.assertTrue(os.path.exists(chain_l.path() + '.extents'))
+        self.assertTrue(blockchain.needs_compaction())
+
+        # the same layout is found when loading from disk
+        reloaded_l = Blockchain(config=self.config, forkpoint=0, parent=None,
+                                forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        reloaded_u = Blockchain(config=self.config, forkpoint=chain_u.forkpoint, parent=reloaded_l,
+                                forkpoint_hash=chain_u.get_id(), prev_hash=chain_u._prev_hash)
+        check_headers(reloaded_l, reloaded_u)
+
+        blockchain.compact_chains()
+        self.assertFalse(blockchain.needs_compaction())
+        check_headers(chain_l, chain_u)
+        self.assertEqual(11 * HEADER_SIZE, os.path.getsize(chain_l.path()))
+        self.assertEqual(4 * HEADER_SIZE, os.path.getsize(chain_u.path()))
+        for chain in (chain_l, chain_u):
+            self.assertFalse(os.path.exists(chain.path() + '.extents'))
+        # appending after compaction goes to the chain's own file
+        self._append_header(chain_u, self.HEADERS['S'])
+        self.assertEqual(5 * HEADER_SIZE, os.path.getsize(chain_u.path()))
+        self.assertEqual(self.HEADERS['S'], chain_u.read_header(10))
+
+    def test_swap_while_compacting_in_another_thread(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEFOPQR':
+            self._append_header(chain_u, self.HEADERS[name])
+        chain_l = chain_u.fork(self.HEADERS['G'])
+        for name in 'HIJ':
+            self._append_header(chain_l, self.HEADERS[name])
+
+        # chain_u.compact() holds its lock, and is about to take blockchains_lock,
+        # when the swap starts
+        compaction_started = threading.Event()
+        def compact():
+            with chain_u.lock:
+                compaction_started.set()
+                time.sleep(0.2)
+                chain_u.compact()
+        def swap():
+            compaction_started.wait()
+            self._append_header(chain_l, self.HEADERS['K'])
+        threads = [threading.Thread(target=compact, daemon=True), threading.Thread(target=swap, daemon=True)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+            self.assertFalse(thread.is_alive(), 'deadlock')
+
+        self.assertEqual(chain_l, blockchain.get_best_chain())
+        blockchain.compact_chains()
+        self.assertFalse(blockchain.needs_compaction())
+        for chain, names in ((chain_l, 'ABCDEFGHIJK'), (chain_u, 'ABCDEFOPQR')):
+            self.assertEqual(len(names) - 1, chain.height())
+            for name in names:
+                header = self.HEADERS[name]
+                self.assertEqual(header, chain.read_header(header['block_height']))
+
+    def test_chunk_is_not_saved_if_chain_changed_while_hashing(self):
+        chain = Blockchain(config=self.config, forkpoint=0, parent=None,
+                           forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        hashes = {2015: 'aa' * 32}
+
+        async def verify_pow_batch_in_process_pool(pow_jobs):
+            hashes[2015] = 'bb' * 32  # e.g. swapped with a fork meanwhile
+        loop = asyncio.new_event_loop()
+        try:
+            with mock.patch.object(chain, 'get_hash', lambda height: hashes[height]), \
+                    mock.patch.object(chain, 'verify_chunk_without_pow', return_value=[]), \
+                    mock.patch.object(chain, 'save_chunk') as save_chunk:
+                self.assertTrue(loop.run_until_complete(chain.connect_chunk_async(1, '')))
+                self.assertEqual(1, save_chunk.call_count)
+                with mock.patch.object(blockchain, 'verify_pow_batch_in_process_pool',
+                                       verify_pow_batch_in_process_pool):
+                    self.assertFalse(loop.run_until_complete(chain.connect_chunk_async(1, '')))
+                self.assertEqual(1, save_chunk.call_count)
+        finally:
+            loop.close()
+
+    def test_header_batch(self):
+        names = 'ABCDEFOPQR'
+        data = b''.join(bfh(serialize_header(self.HEADERS[name])) for name in names)
+        for has_numpy in {blockchain.HAS_NUMPY, False}:
+            with mock.patch.object(blockchain, 'HAS_NUMPY', has_numpy):
+                batch = HeaderBatch(data, 0)
+            self.assertEqual(len(names), len(batch))
+            for i, name in enumerate(names):
+                self.assertEqual(self.HEADERS[name], batch.header(i))
+                self.assertEqual(hash_header(self.HEADERS[name]), bh2u(batch.hashes()[i][::-1]))
+            self.assertEqual([self.HEADERS[name]['bits'] for name in names], batch.bits.tolist())
+        with self.assertRaises(InvalidHeader):
+            HeaderBatch(data[:-1], 0)
+
+        # batches read across a fork and its parent
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in names:
+            self._append_header(chain_u, self.HEADERS[name])
+        chain_l = chain_u.fork(self.HEADERS['G'])
+        for name in 'HIJK':
+            self._append_header(chain_l, self.HEADERS[name])
+        for chain in (chain_l, chain_u):
+            batch = chain.read_header_batch(3, 100)
+            self.assertEqual(chain.height() - 2, len(batch))
+            for i in range(len(batch)):
+                self.assertEqual(chain.read_header(3 + i), batch.header(i))
+        self.assertEqual(0, len(chain_u.read_header_batch(chain_u.height() + 1, 10)))
+
 #    def test_doing_multiple_swaps_after_single_new_header(self):
 #        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
 #            config=self.config, forkpoint=0, parent=None,
@@ -277,6 +504,150 @@ class TestBlockchain(ElectrumTestCase):
 #        self.assertEqual([chain_z, chain_l], self.get_chains_that_contain_header_helper(self.HEADERS['I']))
 
 
+class TestChainwork(ElectrumTestCase):
+
+    # keep the checkpoint region small, so the chain can be built in the test
+    CHECKPOINTS = constants.net.CHECKPOINTS[:2]
+
+    def setUp(self):
+        super().setUp()
+        self.data_dir = self.electrum_path
+        make_dir(os.path.join(self.data_dir, 'forks'))
+        self.config = SimpleConfig({'electrum_path': self.data_dir})
+        blockchain.blockchains = {}
+        self.rnd = random.Random(42)
+        patcher = mock.patch.object(constants.net, 'CHECKPOINTS', self.CHECKPOINTS)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _new_chain(self, forkpoint=0, parent=None, first_raw_header=None) -> Blockchain:
+        if parent is None:
+            chain = Blockchain(config=self.config, forkpoint=0, parent=None,
+                               forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        else:
+            chain = Blockchain(config=self.config, forkpoint=forkpoint, parent=parent,
+                               forkpoint_hash=hash_raw_header(bh2u(first_raw_header)),
+                               prev_hash=parent.get_hash(forkpoint - 1))
+        return chain
+
+    def _random_bytes(self, n: int) -> bytes:
+        return bytes(self.rnd.getrandbits(8) for _ in range(n))
+
+    def _random_headers(self, count: int, bits: int) -> bytes:
+        return b''.join(self._random_bytes(72) + bits.to_bytes(4, 'little') + self._random_bytes(4)
+                        for i in range(count))
+
+    def _expected_chainwork(self, bits: dict, height: int) -> int:
+        work = 0
+        for h in range(height + 1):
+            if h < len(self.CHECKPOINTS) * 2016:
+                target = self.CHECKPOINTS[h // 2016][1]
+            else:
+                target = Blockchain.bits_to_target(bits[h])
+            work += 2 ** 256 // (target + 1)
+        return work
+
+    def test_chainwork_index_and_fork_choice(self):
+        bits_parent, bits_child = 0x1e0ffff0, 0x1d00ffff
+        cp_height = len(self.CHECKPOINTS) * 2016
+        blockchain.blockchains[constants.net.GENESIS] = chain = self._new_chain()
+        with open(chain.path(), 'wb') as f:
+            f.truncate(cp_height * 80)
+        chain.update_size()
+        chain.write(self._random_headers(2016 + 10, bits_parent), cp_height * 80)
+        parent_bits = {h: bits_parent for h in range(cp_height, cp_height + 2016 + 10)}
+
+        for height in (0, 2015, 2016, cp_height - 1, cp_height, cp_height + 2015, chain.height()):
+            self.assertEqual(self._expected_chainwork(parent_bits, height), chain.get_chainwork(height))
+        # one entry per complete chunk, persisted and picked up by a new instance
+        self.assertEqual(3 * 32, os.path.getsize(chain.path() + '.chainwork'))
+        # written to a temporary file first, which replaces it
+        self.assertFalse(os.path.exists(chain.path() + '.chainwork.tmp'))
+        reloaded = self._new_chain()
+        self.assertEqual(chain.get_chainwork(), reloaded.get_chainwork())
+
+        # appending extends the cached work at the tip
+        chain.write(self._random_headers(5, bits_parent), chain.size() * 80)
+        parent_bits.update({h: bits_parent for h in range(chain.height() - 4, chain.height() + 1)})
+        self.assertEqual(self._expected_chainwork(parent_bits, chain.height()), chain.get_chainwork())
+
+        # a much shorter fork, but with more work
+        forkpoint = cp_height + 8
+        fork_data = self._random_headers(20, bits_child)
+        child = self._new_chain(forkpoint, chain, fork_data[:80])
+        open(child.path(), 'w+').close()
+        child.write(fork_data, 0)
+        blockchain.blockchains[child.get_id()] = child
+        child_bits = {h: bits_parent for h in range(cp_height, forkpoint)}
+        child_bits.update({h: bits_child for h in range(forkpoint, forkpoint + 20)})
+        self.assertLess(child.height(), chain.height())
+        parent_work = chain.get_chainwork()
+        child_work = self._expected_chainwork(child_bits, child.height())
+        self.assertLess(parent_work, child_work)
+
+        child.swap_with_parent()
+        self.assertIsNone(child.parent)
+        self.assertEqual(child, chain.parent)
+        self.assertEqual(forkpoint, chain.forkpoint)
+        self.assertEqual(child_work, child.get_chainwork())
+        self.assertEqual(parent_work, chain.get_chainwork())
+        self.assertEqual([child, chain], blockchain.get_chains_that_contain_header(
+            forkpoint - 1, child.get_hash(forkpoint - 1)))
+
+        # the index files on disk are consistent with the swapped headers files
+        reloaded = self._new_chain()
+        self.assertEqual(child_work, reloaded.get_chainwork())
+        reloaded_fork = Blockchain(config=self.config, forkpoint=forkpoint, parent=reloaded,
+                                   forkpoint_hash=chain.get_id(), prev_hash=chain._prev_hash)
+        self.assertEqual(parent_work, reloaded_fork.get_chainwork())
+
+    def test_deferred_pow_verification(self):
+        patcher = mock.patch.object(blockchain, '_deferred_pow_failed', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.config.set_key('deferred_pow_verification', True)
+        bits = 0x1e0ffff0
+        cp_height = len(self.CHECKPOINTS) * 2016
+        blockchain.blockchains[constants.net.GENESIS] = chain = self._new_chain()
+        with open(chain.path(), 'wb') as f:
+            f.truncate(cp_height * 80)
+        chain.update_size()
+        verifier = blockchain.DeferredPowVerifier(self.config)
+        self.assertTrue(verifier.is_active())
+        self.assertFalse(verifier.has_work())
+        # headers saved without their proof of work checked
+        chain.write(self._random_headers(2016 + 100, bits), cp_height * 80)
+        forkpoint = cp_height + 2016 + 50
+        fork_data = self._random_headers(10, bits)
+        child = self._new_chain(forkpoint, chain, fork_data[:80])
+        open(child.path(), 'w+').close()
+        child.write(fork_data, 0)
+        blockchain.blockchains[child.get_id()] = child
+        self.assertEqual(cp_height - 1, verifier.get_verified_height())
+
+        bad_height = cp_height + 2016 + 20
+        def pow_hash_header(raw_header, height):
+            return bytes(32) if height != bad_height else bytes([0xff]) * 32
+        with mock.patch.object(blockchain, 'pow_hash_header', pow_hash_header):
+            self.assertEqual([], verifier.verify_next_chunk())
+            self.assertEqual(cp_height + 2015, verifier.get_verified_height())
+            # progress is persisted
+            self.assertEqual(cp_height + 2015, blockchain.DeferredPowVerifier(self.config).get_verified_height())
+            self.assertEqual([chain, child], verifier.verify_next_chunk())
+            # the bad header is gone, with everything built on it
+            self.assertEqual(bad_height - 1, chain.height())
+            self.assertEqual([chain], list(blockchain.blockchains.values()))
+            self.assertFalse(os.path.exists(child.path()))
+            # from now on, chunks are fully verified again.
+            # the headers saved before still get checked, then the watermark goes away.
+            self.assertFalse(blockchain.deferred_pow_enabled(self.config))
+            self.assertTrue(verifier.has_work())
+            self.assertEqual([], verifier.verify_next_chunk())
+            self.assertEqual(bad_height - 1, verifier.get_verified_height())
+            self.assertEqual([], verifier.verify_next_chunk())
+        self.assertFalse(verifier.is_active())
+
+
 class TestVerifyHeader(ElectrumTestCase):
 
     # Data for Bitcoin block header #100.
@@ -341,3 +712,60 @@ class TestVerifyHeader(ElectrumTestCase):
         headers5 = {2206513: {'version': 536870912, 'prev_block_hash': '79f9cf8a46f1c823db1005a5f879bbc5e0c3250c516986b80679a900a465b37f', 'merkle_root': 'df6f4798d813f2e2545c538c579a97b95c4af4f522ac49401483a19e0de8d47d', 'timestamp': 1609444650, 'bits': 436604928, 'nonce': 2204928177, 'block_height': 2206513}, 2206514: {'version': 536870912, 'prev_block_hash': 'a3a9fa4099bfb3b251490be1e9f5a509cad82dc44c217d9a7ff1ac44f6e1b2fb', 'merkle_root': '06a9bb6b66584de4d3f9d5bfc44fcd894f7df4419787263918702370fb9cf0d7', 'timestamp': 1609444702, 'bits': 436625476, 'nonce': 329943414, 'block_height': 2206514}, 2206515: {'version': 536870912, 'prev_block_hash': '109b0bd3ea80416d1a97c0340b277feac76f6ee0297f3dfba00ece9f53f836f7', 'merkle_root': '71b4078000d4c47602222ff594c525d6b975c82dd25b3fd7fa67d3bad86d8386', 'timestamp': 1609444825, 'bits': 436632771, 'nonce': 1451552657, 'block_height': 2206515}, 2206516: {'version': 536870912, 'prev_block_hash': '1fb8ed778b8e8102ee7ceea672dc06d7f6faccc47582e909530ce6e46d7374d4', 'merkle_root': '57796791a3ea547a780a6bb8c6cab38c9565069af5f0616f7e205cc4f71cab04', 'timestamp': 1609444842, 'bits': 436624710, 'nonce': 2528808502, 'block_height': 2206516}, 2206517: {'version': 536870912, 'prev_block_hash': '5d389d2b68474a5f19e6a92e2e92ce567e948ad5aa0bf4e459aa87f5a5fca637', 'merkle_root': '5cbc97c215a95e75fe4bcbd5789bfb8a86792a738247b68426938b40e1504a4b', 'timestamp': 1609444994, 'bits': 436607628, 'nonce': 3198985056, 'block_height': 2206517}, 2206518: {'version': 536870912, 'prev_block_hash': '84815942d62032fcb2c5bc3b8991c09dde040190f63b9d9ebe46b340b2cd3d6c', 'merkle_root': 'c0da13cb17bff5bc2a2331ad6d41ba30eba738efffdefd3c38183faa9234612c', 'timestamp': 1609445310, 'bits': 436632069, 'nonce': 1627859591, 'block_height': 2206518}, 2206519: {'version': 536870912, 'prev_block_hash': 'c45cc191df1a721c6fa95201cb5e731825160f254f3ca5ff1ca9760a5822ee8b', 'merkle_root': '37860a177a12504292339d5c2f0e6ada37a3602b1d1734e6ae9d4c41ea59f54d', 'timestamp': 1609445334, 'bits': 436631610, 'nonce': 2638329250, 'block_height': 2206519}, 2206520: {'version': 536870912, 'prev_block_hash': 'adf2460927e1e4aad0bf1523323e07b127c35345add7a747f31a7c91121ff63e', 'merkle_root': '9170108d7c0c9259592afa4de3d3e7050e08a735d124318c734e2abf8f6664a6', 'timestamp': 1609445589, 'bits': 436576387, 'nonce': 3625981221, 'block_height': 2206520}, 2206521: {'version': 536870912, 'prev_block_hash': 'a21753dbaf91b13f9201907987a94f24ec733c5c135c98a9e745802ddd99eeca', 'merkle_root': '14fc0e2c98fddfcc4dfc4a06ecfa25789cef80a3db7a3eb6fe1c1f7b5c58a09e', 'timestamp': 1609445713, 'bits': 436624231, 'nonce': 3913376559, 'block_height': 2206521}, 2206522: {'version': 536870912, 'prev_block_hash': 'c015a44dca079df75b4359cef86a56c0c83daafd99ee7f4e4e6a3b973e3cf68d', 'merkle_root': '846fff888522311773f8e799934ba37dff875e768540dcdf3096cff3faaa70d0', 'timestamp': 1609445772, 'bits': 436630768, 'nonce': 2444283459, 'block_height': 2206522}, 2206523: {'version': 536870912, 'prev_block_hash': '4a68c57457302e8dfcce11b2bfd687dfd676d7ee73b6de4f8c7c1ea7c7caa8d5', 'merkle_root': 'f89d5a02a3e60fa0d0a76548755ee10f657fe8cf14d20c195df661c0395dc2df', 'timestamp': 1609445813, 'bits': 436632462, 'nonce': 1189974575, 'block_height': 2206523}, 2206524: {'version': 536870912, 'prev_block_hash': 'f8fb4f308a3059f427ab617976f0f8f997f9f85c23ee1155204b30897ae32004', 'merkle_root': '1d4de9345567a065e1524fd56465f59eee2732fb3d4d29c41447ba2aa676dedc', 'timestamp': 1609445829, 'bits': 436624998, 'nonce': 3623875361, 'block_height': 2206524}, 2206525: {'version': 536870912, 'prev_block_hash': '1a397adbec8fbabcbb17194f4785f2e47f4335b76c04a30421dfaa422f04cd15', 'merkle_root': '428a9bc92c90cb7e924415f9d9677fc76edb82289b1145be99611200c3ee0a34', 'timestamp': 1609445845, 'bits': 436616917, 'nonce': 632717637, 'block_height': 2206525}, 2206526: {'version': 536870912, 'prev_block_hash': 'e3dc75e8dfa601bb91615cbb3d50b216f3d6c83f3f6e991d982d95aa88025ab4', 'merkle_root': '836f81e989916f694c674fcf8da11167b8a6f26e86b1e04d51514c22c430bd23', 'timestamp': 1609445997, 'bits': 436606062, 'nonce': 2130612094, 'block_height': 2206526}, 2206527: {'version': 536870912, 'prev_block_hash': '240eff2862051667cd689d214d896f8e78eec3a844a368be841ec00a6005eacf', 'merkle_root': '1c685361ea5fbac52a4b876c4c7bf5c60d94f6c31523319dd31e3f1c87f4d01e', 'timestamp': 1609446064, 'bits': 436621155, 'nonce': 3355082659, 'block_height': 2206527}, 2206528: {'version': 536870912, 'prev_block_hash': '17cf5b52259574e136520b7810928dcbf8e6d2725fca5271ecdb1288de78b79c', 'merkle_root': 'e53478cb75d397b9d168a23d9d6b18d241029ccce75966f2a1635d88d4f55507', 'timestamp': 1609446097, 'bits': 436622203, 'nonce': 2427283207, 'block_height': 2206528}, 2206529: {'version': 536870912, 'prev_block_hash': 'ceceb35eb792cd7728b779d8bde0c063948964608b2fb5fc08e28b97389f70b0', 'merkle_root': '00e724c066d68c04fa033cc228f4faf9139360f16e24f11ff8f6bcb5d09c2f56', 'timestamp': 1609446108, 'bits': 436617031, 'nonce': 12246852, 'block_height': 2206529}, 2206530: {'version': 536870912, 'prev_block_hash': '9fbeb81d66a9690389e6fa4af51fb5cb58b5e1985814a0e3c9282a0b743bc9c1', 'merkle_root': '900a55f729f0ffc485573f14a2eb6ad98e09f062d3b4f14d29ee86b674f80631', 'timestamp': 1609446465, 'bits': 436610673, 'nonce': 3113809169, 'block_height': 2206530}, 2206531: {'version': 536870912, 'prev_block_hash': '83e32b6cec70692839a31254d7e1e54cde9e4ebd609909aea911c1ccb6f3bcea', 'merkle_root': '8753aefb0807ce00d6dd08af39c9546d9d99b5058b71325fcee16e825ebad1d5', 'timestamp': 1609446495, 'bits': 436652811, 'nonce': 4034390885, 'block_height': 2206531}, 2206532: {'version': 536870912, 'prev_block_hash': '4972be8a70cc57ec5ac8797a70ddfe649e53399b956d9dc6f7c441980398a148', 'merkle_root': 'fba036cbf0ae13be324c0cadbb1f5394df5e31730d3f26446acbe71cfa8c8cad', 'timestamp': 1609446538, 'bits': 436651818, 'nonce': 3995783605, 'block_height': 2206532}, 2206533: {'version': 536870912, 'prev_block_hash': 'ee827023ec8ff367ca696f1ef15428a938f659eede017edb73c5e18926a4be45', 'merkle_root': '3a77f5c65e241bc0f98e7c769856ba8ceab5ee6acac2f6e4179d5c8cccf7a9e7', 'timestamp': 1609446687, 'bits': 436624837, 'nonce': 3037641522, 'block_height': 2206533}, 2206534: {'version': 536870912, 'prev_block_hash': '1ecbba9436fc30f6f754d3bf23dce7ea14b043c87b9f6ced3724687ae4c4e4a5', 'merkle_root': 'b35280e639c58d2fbd6c68259d6a36c36fa22079fd5c395c2671bedf3f7fb6e0', 'timestamp': 1609446816, 'bits': 436644078, 'nonce': 570649684, 'block_height': 2206534}, 2206535: {'version': 536870912, 'prev_block_hash': '4f244738562a8d5043647226bf365562b21c7969307adfae62c27f55efd15bb7', 'merkle_root': '9a5d1d4dfc02cd2deea1ad45fcf009e1c71aefdcf37b2e246e2984ef1de16900', 'timestamp': 1609446927, 'bits': 436667852, 'nonce': 3209124518, 'block_height': 2206535}, 2206536: {'version': 536870912, 'prev_block_hash': '8458f4914392ca79bed665183325028a9dc923a5bd9adcffb71504418df4c85b', 'merkle_root': 'c8a0b1dc4eaf05a864a3e4b18d80c0a01241c5467efc77abfb6dbe8a62c0d17f', 'timestamp': 1609446940, 'bits': 436678347, 'nonce': 1558666374, 'block_height': 2206536}, 2206537: {'version': 536870912, 'prev_block_hash': '950e1e6fde2374c4e6b5c6410de17aa06cc529e744f37dd0c32c64dd1d7bb746', 'merkle_root': 'aed89fdc09cdf3893d35a62df0182c943cc3a0309b4251d5f9923c85acc08c70', 'timestamp': 1609447234, 'bits': 436655004, 'nonce': 1640074009, 'block_height': 2206537}, 2206538: {'version': 536870912, 'prev_block_hash': '28bc9fdd7ab0d15f567645e174c7e3ea7027ef90611e730b5462a6282946d0b9', 'merkle_root': '72a363391d361998612c938f3ced45273d810eec5d23c1ba6154f4ed9725679b', 'timestamp': 1609447281, 'bits': 436703536, 'nonce': 4023305371, 'block_height': 2206538}, 2206539: {'version': 536870912, 'prev_block_hash': '7a558e121576bf037355022758126a6dcff6eb1196d1a6637f9b0d66631f178f', 'merkle_root': 'b5508485f20a33c62f5b54c0ae8e93a5fb448f6d59493fed8e7c44a0c80d83c8', 'timestamp': 1609447384, 'bits': 436694408, 'nonce': 739444754, 'block_height': 2206539}, 2206540: {'version': 536870912, 'prev_block_hash': '918ffd6a492a437afc25cc54921f9f62b7c8ba84529b5c4de36afc1693e7fe32', 'merkle_root': 'd5aeafdb55ea5e1ed86fc03b6789964bf2bc1f828782cd356d1a31ecb49b9887', 'timestamp': 1609447413, 'bits': 436713926, 'nonce': 1895755322, 'block_height': 2206540}, 2206541: {'version': 536870912, 'prev_block_hash': '02755cd1cec2f837100165b0106050b2eb4ed7869b19e2605a7c828e7d515452', 'merkle_root': '1ce0429268d986fdd324b6fbb3119126288bffd7adf71b50dc2abac011956d3f', 'timestamp': 1609447455, 'bits': 436694298, 'nonce': 2787690507, 'block_height': 2206541}, 2206542: {'version': 536870912, 'prev_block_hash': 'd227495a03fec3ae3ab4d33389f8ddff2924bf52b4e397fef064e47d2b80b3be', 'merkle_root': 'e59c530f17cd030c80090c5aff4a998890b92472d723843248f63ff04a3fd141', 'timestamp': 1609447500, 'bits': 436641834, 'nonce': 3636446255, 'block_height': 2206542}, 2206543: {'version': 536870912, 'prev_block_hash': '30594681b22092a3ba73b532accc7835f117984098164cd10bb9a8c4272e33f3', 'merkle_root': '66ad5a4a7c9037f69d47a1103a8a3ecc1103b75891b2ac0280567431cfccd549', 'timestamp': 1609447533, 'bits': 436644373, 'nonce': 850699273, 'block_height': 2206543}}
         bits = Blockchain.get_target(self, 2206543, headers5)
         self.assertEqual(bits, 10709251786800936527318757626382864578020150972591414166005562)
+
+
+class TestDGWv3Calculator(ElectrumTestCase):
+
+    class HeaderSource:
+        def __init__(self, headers):
+            self.headers = headers
+        def read_header(self, height):
+            return self.headers.get(height)
+        def read_header_batch(self, height, count):
+            data = b''
+            for h in range(height, height + count):
+                header = self.headers.get(h)
+                data += bytes(68) + header['timestamp'].to_bytes(4, 'little') \
+                        + header['bits'].to_bytes(4, 'little') + bytes(4) if header else bytes(80)
+            return HeaderBatch(data, height)
+
+    def assert_same_targets_as_get_target_dgwv3(self, headers: dict):
+        heights = sorted(headers)
+        dgw = DGWv3Calculator()
+        checked = 0
+        for height in heights[1:] + [heights[-1] + 1]:
+            prev = headers[height - 1]
+            dgw.append(height - 1, prev['bits'], prev['timestamp'])
+            # get_target_dgwv3 looks one header further back than it uses
+            if height - DGWv3Calculator.PAST_BLOCKS - 1 < heights[0]:
+                continue
+            self.assertEqual(Blockchain.get_target_dgwv3(self, height, headers), dgw.get_target(height))
+            checked += 1
+        self.assertGreater(checked, 0)
+
+    def test_same_targets_over_checkpoint_data(self):
+        self.assert_same_targets_as_get_target_dgwv3(DGW_CHECKPOINT_HEADERS)
+        dgw = DGWv3Calculator()
+        dgw.seed(self.HeaderSource(DGW_CHECKPOINT_HEADERS), 2206543)
+        self.assertEqual(10709251786800936527318757626382864578020150972591414166005562, dgw.get_target(2206543))
+
+    def test_same_targets_over_random_headers(self):
+        rnd = random.Random(1337)
+        for trial in range(5):
+            headers = {}
+            timestamp = 1609447533
+            for height in range(3000000, 3000000 + 120):
+                timestamp += rnd.randint(-300, 600)
+                bits = rnd.randint(0x19, 0x1d) << 24 | rnd.randint(0x8000, 0x7fffff)
+                headers[height] = {'bits': bits, 'timestamp': timestamp, 'block_height': height}
+            self.assert_same_targets_as_get_target_dgwv3(headers)
+
+    def test_needs_reseed_after_gap(self):
+        dgw = DGWv3Calculator()
+        dgw.seed(self.HeaderSource(DGW_CHECKPOINT_HEADERS), 2206543)
+        header = DGW_CHECKPOINT_HEADERS[2206543]
+        dgw.append(2206545, header['bits'], header['timestamp'])
+        with self.assertRaises(MissingHeader):
+            dgw.get_target(2206546)
+        with self.assertRaises(MissingHeader):
+            dgw.get_target(2206543)
@@ -0,0 +1,106 @@
+import os
+import random
+from unittest import mock
+
+from electrum_mona import constants, blockchain
+from electrum_mona.blockchain import Blockchain, HEADER_SIZE
+from electrum_mona.crypto import sha256d
+from electrum_mona.header_snapshot import (export_snapshot, import_snapshot, read_snapshot_info,
+                                           HeaderSnapshotError)
+from electrum_mona.simple_config import SimpleConfig
+from electrum_mona.util import make_dir
+
+from . import ElectrumTestCase
+
+
+class TestHeaderSnapshot(ElectrumTestCase):
+
+    # keep the checkpoint region small, so the chain can be built in the test
+    CHECKPOINTS = constants.net.CHECKPOINTS[:2]
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(constants.net, 'CHECKPOINTS', self.CHECKPOINTS)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        blockchain.blockchains = {}
+        self.rnd = random.Random(7)
+        self.snapshot_path = os.path.join(self.electrum_path, 'headers.snapshot')
+        self.source = self._new_best_chain('source')
+        self.source.write(self._linked_headers(self.source.get_hash(self.source.height()), 5000),
+                          self.source.size() * HEADER_SIZE)
+
+    def _new_config(self, name: str, **kwargs) -> SimpleConfig:
+        path = os.path.join(self.electrum_path, name)
+        make_dir(path)
+        make_dir(os.path.join(path, 'forks'))
+        return SimpleConfig(dict(electrum_path=path, **kwargs))
+
+    def _new_best_chain(self, name: str) -> Blockchain:
+        chain = Blockchain(config=self._new_config(name), forkpoint=0, parent=None,
+                           forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        with open(chain.path(), 'wb') as f:
+            f.truncate(len(self.CHECKPOINTS) * 2016 * HEADER_SIZE)
+        chain.update_size()
+        return chain
+
+    def _linked_headers(self, prev_hash: str, count: int) -> bytes:
+        prev = bytes.fromhex(prev_hash)[::-1]
+        headers = []
+        for i in range(count):
+            raw_header = b'\x00\x00\x00\x20' + prev + bytes(self.rnd.getrandbits(8) for _ in range(44))
+            headers.append(raw_header)
+            prev = sha256d(raw_header)
+        return b''.join(headers)
+
+    def test_export_and_import_in_read_blockchains(self):
+        info = export_snapshot(self.source, self.snapshot_path)
+        self.assertEqual(info, read_snapshot_info(self.snapshot_path))
+        self.assertEqual(len(self.CHECKPOINTS) * 2016, info.first_height)
+        self.assertEqual(self.source.height(), info.tip_height)
+        self.assertEqual(self.source.get_hash(self.source.height()), info.tip_hash)
+
+        config = self._new_config('fresh', header_snapshot=self.snapshot_path, header_snapshot_tip=info.tip_hash)
+        blockchain.read_blockchains(config)
+        chain = blockchain.get_best_chain()
+        self.assertEqual(info.tip_height, chain.height())
+        self.assertEqual(info.tip_hash, chain.get_hash(chain.height()))
+        for height in (info.first_height, info.first_height + 2016, info.tip_height):
+            self.assertEqual(bytes(self.source.read_raw_header(height)), bytes(chain.read_raw_header(height)))
+
+    def test_import_refuses_bad_snapshots(self):
+        info = export_snapshot(self.source, self.snapshot_path)
+        # tip hash not configured, or not the expected one
+        for tip_hash in (None, self.source.get_hash(self.source.height() - 1)):
+            blockchain.blockchains = {}
+            config = self._new_config('fresh', header_snapshot=self.snapshot_path, header_snapshot_tip=tip_hash)
+            blockchain.read_blockchains(config)
+            self.assertLess(blockchain.get_best_chain().height(), info.first_height)
+        # corrupted file
+        with open(self.snapshot_path, 'r+b') as f:
+            f.seek(-100, os.SEEK_END)
+            byte = f.read(1)
+            f.seek(-100, os.SEEK_END)
+            f.write(bytes([byte[0] ^ 1]))
+        chain = self._new_best_chain('corrupted')
+        with self.assertRaises(HeaderSnapshotError):
+            import_snapshot(chain, self.snapshot_path, info.tip_hash)
+        self.assertEqual(constants.net.max_checkpoint(), chain.height())
+
+    def test_import_on_top_of_local_headers(self):
+        info = export_snapshot(self.source, self.snapshot_path)
+        chain = self._new_best_chain('partial')
+        first_height = chain.height() + 1
+        chain.write(b''.join(bytes(self.source.read_raw_header(height))
+                             for height in range(first_height, first_height + 2016 + 100)),
+                    chain.size() * HEADER_SIZE)
+        self.assertTrue(import_snapshot(chain, self.snapshot_path, info.tip_hash))
+        self.assertEqual(info.tip_height, chain.height())
+        self.assertEqual(info.tip_hash, chain.get_hash(chain.height()))
+        self.assertFalse(import_snapshot(chain, self.snapshot_path, info.tip_hash))
+
+        # local headers on another branch
+        chain = self._new_best_chain('conflicting')
+        chain.write(self._linked_headers(chain.get_hash(chain.height()), 10), chain.size() * HEADER_SIZE)
+        with self.assertRaises(HeaderSnapshotError):
+            import_snapshot(chain, self.snapshot_path, info.tip_hash)
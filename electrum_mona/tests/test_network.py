@@ -1,11 +1,21 @@
 import asyncio
+import os
 import tempfile
+import threading
 import unittest
+from unittest import mock
+
+import aiorpcx
+from aiorpcx import RPCSession, RPCError, handler_invocation
 
 from electrum_mona import constants
 from electrum_mona.simple_config import SimpleConfig
 from electrum_mona import blockchain
-from electrum_mona.interface import Interface, ServerAddr
+from electrum_mona.interface import (Interface, ServerAddr, NotificationSession, RequestTimedOut,
+                                     RttEstimator, NetworkTimeout)
+from electrum_mona.network import HeaderChunkScheduler, pick_random_server
+from electrum_mona.server_scores import ServerScores, MAIN_SERVER_SWITCH_RATIO
+from electrum_mona.logging import get_logger
 from electrum_mona.crypto import sha256
 from electrum_mona.util import bh2u
 
@@ -116,6 +126,396 @@ class TestNetwork(ElectrumTestCase):
         self.assertEqual(('catchup', 7), asyncio.get_event_loop().run_until_complete(ifa.sync_until(8, next_height=6)))
         self.assertEqual(self.interface.q.qsize(), 0)
 
+    def test_chunk_that_does_not_connect_is_not_fetched_again(self):
+        self.interface.tip = 5000
+        async def download_header_chunks(interface, height, tip):
+            return 2 * 2016, False  # the interface's own chunk 2 does not connect
+        self.interface.network.download_header_chunks = download_header_chunks
+        steps = []
+        async def step(height, header=None):
+            steps.append(height)
+            return 'fork', self.interface.tip + 1
+        with mock.patch.object(self.interface, 'request_chunk') as request_chunk, \
+                mock.patch.object(self.interface, 'step', side_effect=step):
+            result = asyncio.get_event_loop().run_until_complete(self.interface.sync_until(100, next_height=5000))
+        self.assertEqual(('fork', 5001), result)
+        self.assertEqual([2 * 2016], steps)
+        request_chunk.assert_not_called()
+
+
+class MockServerSession(RPCSession):
+    """Answers blockchain.transaction.get for the txids it knows."""
+    txs = {}
+
+    async def handle_request(self, request):
+        handler = {'blockchain.transaction.get': self.get_transaction}.get(request.method)
+        return await handler_invocation(handler, request)()
+
+    async def get_transaction(self, tx_hash):
+        if tx_hash not in self.txs:
+            raise RPCError(2, 'No such mempool or blockchain transaction')
+        return self.txs[tx_hash]
+
+
+class TestBatchedRequests(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path, 'network_max_batch_size': 3})
+        MockServerSession.txs = {('%064x' % i): ('%02x' % i) * 10 for i in range(10)}
+        self.loop = asyncio.get_event_loop()
+
+    def _mock_interface(self):
+        network = mock.Mock(debug=False, config=self.config)
+        return mock.Mock(debug=False, network=network, logger=get_logger(__name__))
+
+    def test_requests_of_one_iteration_are_batched(self):
+        async def run():
+            server = await aiorpcx.serve_rs(MockServerSession, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            session_factory = lambda *args, **kwargs: NotificationSession(
+                *args, **kwargs, interface=self._mock_interface())
+            try:
+                async with aiorpcx.connect_rs('127.0.0.1', port, session_factory=session_factory) as session:
+                    with mock.patch.object(session, 'send_batch', wraps=session.send_batch) as send_batch:
+                        tx_hashes = list(MockServerSession.txs) + ['ff' * 32]
+                        results = await asyncio.gather(
+                            *[session.send_batched_request('blockchain.transaction.get', [tx_hash])
+                              for tx_hash in tx_hashes],
+                            return_exceptions=True)
+                        # 11 requests, in batches of at most 3
+                        self.assertEqual(4, send_batch.call_count)
+                    # errors stay with the request that caused them
+                    self.assertEqual(list(MockServerSession.txs.values()), results[:-1])
+                    self.assertIsInstance(results[-1], RPCError)
+                    # requests made one after the other are not held back
+                    result = await session.send_batched_request('blockchain.transaction.get', [tx_hashes[0]])
+                    self.assertEqual(MockServerSession.txs[tx_hashes[0]], result)
+                    # and they feed the RTT estimate of their method, timeouts included
+                    estimator = session.rtt_estimators['blockchain.transaction.get']
+                    self.assertEqual(12, estimator.num_samples)
+                    with self.assertRaises(RequestTimedOut):
+                        await session.send_batched_request('blockchain.transaction.get', [tx_hashes[0]], timeout=0)
+                    self.assertEqual(2, estimator.backoff)
+            finally:
+                server.close()
+                await server.wait_closed()
+        self.loop.run_until_complete(run())
+
+
+class SlowServerSession(RPCSession):
+    """Counts the requests it gets, and answers them after a short delay."""
+    txs = {}
+    num_requests = 0
+
+    async def handle_request(self, request):
+        SlowServerSession.num_requests += 1
+        await asyncio.sleep(0.01)
+        if request.args[0] not in self.txs:
+            raise RPCError(2, 'No such mempool or blockchain transaction')
+        return self.txs[request.args[0]]
+
+
+class TestCoalescedRequests(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        SlowServerSession.txs = {('%064x' % i): ('%02x' % i) * 10 for i in range(3)}
+        SlowServerSession.num_requests = 0
+        self.loop = asyncio.get_event_loop()
+
+    def _mock_interface(self):
+        network = mock.Mock(debug=False, config=self.config)
+        return mock.Mock(debug=False, network=network, logger=get_logger(__name__))
+
+    def test_identical_requests_are_coalesced(self):
+        async def run():
+            server = await aiorpcx.serve_rs(SlowServerSession, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            session_factory = lambda *args, **kwargs: NotificationSession(
+                *args, **kwargs, interface=self._mock_interface())
+            try:
+                async with aiorpcx.connect_rs('127.0.0.1', port, session_factory=session_factory) as session:
+                    tx_hash = list(SlowServerSession.txs)[0]
+                    results = await asyncio.gather(
+                        *[session.send_coalesced_request('blockchain.transaction.get', [tx_hash], batched=batched)
+                          for batched in (False, True, False)])
+                    self.assertEqual([SlowServerSession.txs[tx_hash]] * 3, results)
+                    self.assertEqual(1, SlowServerSession.num_requests)
+                    # then served from the cache
+                    self.assertEqual(SlowServerSession.txs[tx_hash],
+                                     await session.send_coalesced_request('blockchain.transaction.get', [tx_hash]))
+                    self.assertEqual(1, SlowServerSession.num_requests)
+                    self.assertEqual({'hits': 3, 'misses': 1}, session.rpc_cache_stats)
+                    # until it expires
+                    for key, (expiry, result) in session._result_cache.items():
+                        session._result_cache[key] = (expiry - 3600, result)
+                    await session.send_coalesced_request('blockchain.transaction.get', [tx_hash])
+                    self.assertEqual(2, SlowServerSession.num_requests)
+                    # errors are not cached
+                    for i in range(2):
+                        with self.assertRaises(RPCError):
+                            await session.send_coalesced_request('blockchain.transaction.get', ['ff' * 32])
+                    self.assertEqual(4, SlowServerSession.num_requests)
+                    self.assertEqual({'hits': 3, 'misses': 4}, session.rpc_cache_stats)
+            finally:
+                server.close()
+                await server.wait_closed()
+        self.loop.run_until_complete(run())
+
+
+def _chunk_hex(index: int, size: int, fill: int = None) -> str:
+    fill = index % 256 if fill is None else fill
+    return bytes([fill]).hex() * 80 * size
+
+
+class StubInterface:
+
+    def __init__(self, name: str, tip: int, *, fill: int = None, fails: bool = False):
+        self.server = ServerAddr.from_str(f'{name}:50002:s')
+        self.tip = tip
+        self.fill = fill
+        self.fails = fails
+        self.requested = []
+        self.logger = get_logger(__name__)
+        self.session = mock.Mock()
+        self.session.is_closing.return_value = False
+        self.session.send_batched_request.side_effect = self.send_batched_request
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def get_chunk_hex(self, index: int, size: int) -> str:
+        self.requested.append(index)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.in_flight -= 1
+        if self.fails:
+            raise RequestTimedOut()
+        return _chunk_hex(index, size, self.fill)
+
+    async def send_batched_request(self, method, params):
+        assert method == 'blockchain.block.header'
+        height, = params
+        return _chunk_hex(height // 2016, 1)
+
+
+class TestHeaderChunkScheduler(ElectrumTestCase):
+
+    TIP = 6 * 2016 + 99
+
+    def setUp(self):
+        super().setUp()
+        self.main = StubInterface('main', self.TIP)
+        self.connected = []
+        async def connect_chunk_async(index, chunk_hex):
+            if chunk_hex != _chunk_hex(index, len(chunk_hex) // 160):
+                return False
+            self.connected.append(index)
+            return True
+        self.main.blockchain = mock.Mock()
+        self.main.blockchain.connect_chunk_async.side_effect = connect_chunk_async
+        config = SimpleConfig({'electrum_path': self.electrum_path, 'network_header_chunk_window': 4})
+        self.network = mock.Mock(config=config, interfaces_lock=threading.Lock(), interfaces={})
+
+    def _add_interfaces(self, *interfaces):
+        for iface in (self.main,) + interfaces:
+            self.network.interfaces[iface.server] = iface
+
+    def _run(self, height):
+        scheduler = HeaderChunkScheduler(self.network, self.main)
+        return asyncio.get_event_loop().run_until_complete(scheduler.run(height, self.TIP))
+
+    def test_chunks_are_spread_over_servers_and_connected_in_order(self):
+        helpers = [StubInterface(f'helper{i}', self.TIP) for i in range(3)]
+        self._add_interfaces(*helpers)
+        self.assertEqual((self.TIP + 1, True), self._run(100))
+        self.assertEqual(list(range(7)), self.connected)
+        for iface in [self.main] + helpers:
+            self.assertTrue(iface.requested)
+        self.assertLessEqual(sum(iface.max_in_flight for iface in [self.main] + helpers), 4)
+
+    def test_bad_servers_are_excluded(self):
+        conflicting = StubInterface('conflicting', self.TIP, fill=255)
+        failing = StubInterface('failing', self.TIP, fails=True)
+        lagging = StubInterface('lagging', 2016)
+        self._add_interfaces(conflicting, failing, lagging)
+        self.assertEqual((self.TIP + 1, True), self._run(0))
+        self.assertEqual(list(range(7)), self.connected)
+        # asked only while their first requests were in flight
+        self.assertLessEqual(len(conflicting.requested), 2)
+        self.assertLessEqual(len(failing.requested), 2)
+        # only has the first chunk
+        self.assertLessEqual(set(lagging.requested), {0})
+
+    def test_stops_at_chunk_that_does_not_connect(self):
+        self._add_interfaces()
+        async def connect_chunk_async(index, chunk_hex):
+            self.connected.append(index)
+            return index < 3
+        self.main.blockchain.connect_chunk_async.side_effect = connect_chunk_async
+        self.assertEqual((3 * 2016, False), self._run(2016))
+        self.assertEqual([1, 2, 3], self.connected)
+
+
+class TestAdaptiveTimeouts(ElectrumTestCase):
+
+    def test_rtt_estimator(self):
+        estimator = RttEstimator()
+        for i in range(RttEstimator.MIN_SAMPLES - 1):
+            estimator.add_sample(0.1)
+        self.assertIsNone(estimator.get_timeout())
+        estimator.add_sample(0.1)
+        # fast server: the lower bound applies
+        self.assertEqual(NetworkTimeout.Generic.MIN_ADAPTIVE, estimator.get_timeout())
+        self.assertEqual(NetworkTimeout.Urgent.MIN_ADAPTIVE, estimator.get_timeout(NetworkTimeout.Urgent))
+
+    def test_rtt_estimator_slow_and_jittery_server(self):
+        estimator = RttEstimator()
+        for rtt in [10, 30, 12, 40, 10, 35, 15]:
+            estimator.add_sample(rtt)
+        timeout = estimator.get_timeout()
+        self.assertGreater(timeout, NetworkTimeout.Generic.RELAXED)
+        self.assertLessEqual(timeout, NetworkTimeout.Generic.MOST_RELAXED)
+        # timeouts back off, until the next response
+        estimator.on_timeout()
+        self.assertEqual(min(2 * timeout, NetworkTimeout.Generic.MOST_RELAXED), estimator.get_timeout())
+        estimator.add_sample(15)
+        self.assertLess(estimator.get_timeout(), timeout)
+
+    def test_session_timeouts_adapt_per_method(self):
+        MockServerSession.txs = {('%064x' % i): ('%02x' % i) * 10 for i in range(10)}
+        config = SimpleConfig({'electrum_path': self.electrum_path})
+        interface = mock.Mock(debug=False, network=mock.Mock(debug=False, config=config),
+                              logger=get_logger(__name__))
+        async def run():
+            server = await aiorpcx.serve_rs(MockServerSession, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            session_factory = lambda *args, **kwargs: NotificationSession(*args, **kwargs, interface=interface)
+            try:
+                async with aiorpcx.connect_rs('127.0.0.1', port, session_factory=session_factory) as session:
+                    session.set_default_timeout(NetworkTimeout.Generic.RELAXED)
+                    for tx_hash in MockServerSession.txs:
+                        await session.send_request('blockchain.transaction.get', [tx_hash])
+                    self.assertEqual(NetworkTimeout.Generic.MIN_ADAPTIVE,
+                                     session.get_request_timeout('blockchain.transaction.get'))
+                    # no samples for this class yet
+                    self.assertEqual(NetworkTimeout.Generic.RELAXED,
+                                     session.get_request_timeout('blockchain.scripthash.get_history'))
+                    # the session-wide timeout must still allow for the slowest class
+                    self.assertEqual(NetworkTimeout.Generic.RELAXED, session.sent_request_timeout)
+                    self.assertEqual(10, session.get_timeout_stats()['blockchain.transaction.get']['num_samples'])
+                    # capped by the timeout of the network's policy, e.g. with a single server
+                    session.set_default_timeout(3)
+                    self.assertEqual(3, session.get_request_timeout('blockchain.transaction.get'))
+                    session.set_default_timeout(NetworkTimeout.Generic.MOST_RELAXED, adaptive=False)
+                    self.assertEqual(NetworkTimeout.Generic.MOST_RELAXED,
+                                     session.get_request_timeout('blockchain.transaction.get'))
+            finally:
+                server.close()
+                await server.wait_closed()
+        asyncio.get_event_loop().run_until_complete(run())
+
+
+class TestRpcStats(ElectrumTestCase):
+
+    def test_requests_are_measured_per_method(self):
+        SlowServerSession.txs = {('%064x' % i): ('%02x' % i) * 10 for i in range(3)}
+        config = SimpleConfig({'electrum_path': self.electrum_path})
+        interface = mock.Mock(debug=False, network=mock.Mock(debug=False, config=config),
+                              logger=get_logger(__name__))
+        async def run():
+            server = await aiorpcx.serve_rs(SlowServerSession, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            session_factory = lambda *args, **kwargs: NotificationSession(*args, **kwargs, interface=interface)
+            try:
+                async with aiorpcx.connect_rs('127.0.0.1', port, session_factory=session_factory) as session:
+                    tx_hashes = list(SlowServerSession.txs)
+                    task = asyncio.ensure_future(session.send_request('blockchain.transaction.get', [tx_hashes[0]]))
+                    await asyncio.sleep(0)
+                    self.assertEqual(1, session.rpc_stats.to_json()['blockchain.transaction.get']['in_flight'])
+                    await task
+                    await session.send_request('blockchain.transaction.get', [tx_hashes[1]])
+                    with self.assertRaises(RPCError):
+                        await session.send_request('blockchain.transaction.get', ['ff' * 32])
+                    await asyncio.gather(*[session.send_batched_request('blockchain.transaction.get', [tx_hash])
+                                           for tx_hash in tx_hashes])
+                    stats = session.rpc_stats.to_json()['blockchain.transaction.get']
+            finally:
+                server.close()
+                await server.wait_closed()
+            return stats
+        stats = asyncio.get_event_loop().run_until_complete(run())
+        self.assertEqual(6, stats['count'])
+        self.assertEqual(1, stats['errors'])
+        self.assertEqual(0, stats['in_flight'])
+        self.assertEqual(6, sum(stats['latency_buckets'].values()))
+        self.assertGreater(stats['latency_sum'], 0)
+        self.assertEqual(5 * 22, stats['bytes_in'])
+        self.assertGreater(stats['bytes_out'], 6 * 64)
+
+
+class TestServerScores(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.electrum_path, 'server_scores')
+        self.scores = ServerScores(self.path)
+        self.good = ServerAddr.from_str('good:50002:s')
+        self.slow = ServerAddr.from_str('slow:50002:s')
+        self.flaky = ServerAddr.from_str('flaky:50002:s')
+        self.unknown = ServerAddr.from_str('unknown:50002:s')
+        for i in range(20):
+            self.scores.record_request(self.good, rtt=0.05)
+            self.scores.record_request(self.slow, rtt=3)
+            self.scores.record_request(self.flaky, rtt=0.05, error=i % 2 == 0)
+        self.scores.record_throughput(self.good, 500_000, 1)
+
+    def test_scores(self):
+        score = self.scores.score
+        self.assertGreater(score(self.good), score(self.unknown))
+        self.assertGreater(score(self.unknown), score(self.slow))
+        self.assertGreater(score(self.good), score(self.flaky))
+        good_score = score(self.good)
+        self.scores.record_lag(self.good, 10)
+        self.assertLess(score(self.good), good_score)
+
+    def test_scores_are_persisted(self):
+        self.scores.save()
+        scores = ServerScores(self.path)
+        for server in (self.good, self.slow, self.flaky, self.unknown):
+            self.assertAlmostEqual(self.scores.score(server), scores.score(server))
+
+    def test_main_server_is_never_much_worse_than_the_best(self):
+        servers = [self.good, self.slow, self.flaky]
+        for i in range(50):
+            self.assertNotEqual(self.slow, self.scores.choose_main(servers))
+        self.assertTrue(self.scores.is_much_worse(self.slow, servers))
+        self.assertFalse(self.scores.is_much_worse(self.good, servers))
+        # not judged before having seen enough of it
+        self.assertFalse(self.scores.is_much_worse(self.unknown, servers))
+
+    def test_main_server_is_replaced_with_hysteresis(self):
+        mediocre = ServerAddr.from_str('mediocre:50002:s')
+        for i in range(20):
+            self.scores.record_request(mediocre, rtt=0.8)
+        servers = [self.good, mediocre]
+        # too bad to be chosen, but not bad enough to be replaced
+        self.assertTrue(self.scores.is_much_worse(mediocre, servers))
+        self.assertFalse(self.scores.is_much_worse(mediocre, servers, ratio=MAIN_SERVER_SWITCH_RATIO))
+        self.assertTrue(self.scores.is_much_worse(self.slow, servers, ratio=MAIN_SERVER_SWITCH_RATIO))
+
+    def test_exploration_still_picks_bad_servers(self):
+        hostmap = {'good': {'s': '50002'}, 'slow': {'s': '50002'}}
+        picked = [pick_random_server(hostmap, allowed_protocols={'s'}, server_scores=self.scores)
+                  for i in range(500)]
+        self.assertGreater(picked.count(self.good), picked.count(self.slow))
+        self.assertGreater(picked.count(self.slow), 0)
+        self.assertEqual({self.good, self.slow}, set(self.scores.weighted_shuffle([self.good, self.slow])))
+
 
 if __name__=="__main__":
     constants.set_regtest()
@@ -0,0 +1,123 @@
+import asyncio
+
+from aiorpcx import TaskGroup
+from aiorpcx.jsonrpc import RPCError, JSONRPC
+
+from electrum_mona.interface import ServerAddr, RequestTimedOut
+from electrum_mona.request_scheduler import RequestScheduler, JobPriority, MIN_LIMIT, INITIAL_LIMIT
+
+from . import ElectrumTestCase
+
+
+SERVER = ServerAddr.from_str('server:50002:s')
+
+
+def _timeout() -> RequestTimedOut:
+    try:
+        raise RequestTimedOut() from asyncio.TimeoutError()
+    except RequestTimedOut as e:
+        return e
+
+
+class TestRequestScheduler(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.get_event_loop()
+
+    def test_slots_are_given_by_priority(self):
+        async def run():
+            scheduler = RequestScheduler(max_limit=MIN_LIMIT)
+            held = [await scheduler.slot(SERVER, JobPriority.TX).acquire() for i in range(MIN_LIMIT)]
+            order = []
+
+            async def job(priority):
+                async with scheduler.slot(SERVER, priority):
+                    order.append(priority)
+            async with TaskGroup() as group:
+                for priority in (JobPriority.TX, JobPriority.HISTORY, JobPriority.HEADERS, JobPriority.PROOFS):
+                    await group.spawn(job(priority))
+                await asyncio.sleep(0.01)
+                self.assertEqual([], order)
+                self.assertEqual(4, scheduler.get_stats()[str(SERVER)]['waiting'])
+                for slot in held:
+                    slot.release()
+            self.assertEqual([JobPriority.HEADERS, JobPriority.PROOFS, JobPriority.HISTORY, JobPriority.TX], order)
+            self.assertEqual(0, scheduler.get_stats()[str(SERVER)]['in_flight'])
+        self.loop.run_until_complete(run())
+
+    def test_spawn_holds_back_the_producer(self):
+        async def run():
+            scheduler = RequestScheduler(max_limit=MIN_LIMIT)
+            in_flight = 0
+            max_in_flight = 0
+            num_done = 0
+
+            async def job(i, *, slot):
+                nonlocal in_flight, max_in_flight, num_done
+                async with slot:
+                    in_flight += 1
+                    max_in_flight = max(max_in_flight, in_flight)
+                    await asyncio.sleep(0.001)
+                    in_flight -= 1
+                num_done += 1
+            async with TaskGroup() as group:
+                for i in range(20):
+                    await scheduler.spawn(group, SERVER, JobPriority.TX, job, i)
+                    # never more than the limit ahead of the jobs
+                    self.assertLessEqual(i + 1 - num_done, MIN_LIMIT)
+            self.assertEqual(20, num_done)
+            self.assertEqual(MIN_LIMIT, max_in_flight)
+        self.loop.run_until_complete(run())
+
+    def test_slot_of_spawned_job_is_released_when_it_is_done(self):
+        async def run():
+            scheduler = RequestScheduler(max_limit=MIN_LIMIT)
+
+            async def job(*, slot):
+                pass  # does not use its slot
+            async with TaskGroup() as group:
+                for i in range(3 * MIN_LIMIT):
+                    await scheduler.spawn(group, SERVER, JobPriority.TX, job)
+            self.assertEqual(0, scheduler.get_stats()[str(SERVER)]['in_flight'])
+        self.loop.run_until_complete(run())
+
+    def test_cancelled_waiters_do_not_leak_slots(self):
+        async def run():
+            scheduler = RequestScheduler(max_limit=MIN_LIMIT)
+            held = [await scheduler.slot(SERVER, JobPriority.TX).acquire() for i in range(MIN_LIMIT)]
+            waiter = asyncio.ensure_future(scheduler.slot(SERVER, JobPriority.TX).acquire())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            for slot in held:
+                slot.release()
+            await asyncio.sleep(0)
+            self.assertEqual({'limit': MIN_LIMIT, 'in_flight': 0, 'waiting': 0, 'num_decreases': 0},
+                             scheduler.get_stats()[str(SERVER)])
+        self.loop.run_until_complete(run())
+
+    def test_limit_adapts_to_server(self):
+        async def run():
+            scheduler = RequestScheduler()
+            stats = lambda: scheduler.get_stats()[str(SERVER)]
+            # a whole round of requests timing out halves the limit only once
+            slots = [await scheduler.slot(SERVER, JobPriority.TX).acquire() for i in range(10)]
+            for slot in slots:
+                slot.release(error=_timeout())
+            self.assertEqual(INITIAL_LIMIT // 2, stats()['limit'])
+            self.assertEqual(1, stats()['num_decreases'])
+            # a busy server halves it again
+            async with scheduler.slot(SERVER, JobPriority.TX) as slot:
+                slot.release(error=RPCError(JSONRPC.SERVER_BUSY, 'server busy'))
+            self.assertEqual(INITIAL_LIMIT // 4, stats()['limit'])
+            # answers, including errors other than being busy, raise it by about one per round
+            for i in range(INITIAL_LIMIT // 4 + 1):
+                async with scheduler.slot(SERVER, JobPriority.TX) as slot:
+                    slot.release(error=RPCError(2, 'No such mempool or blockchain transaction') if i % 2 else None)
+            self.assertEqual(INITIAL_LIMIT // 4 + 1, stats()['limit'])
+            # but never below the minimum
+            for i in range(10):
+                async with scheduler.slot(SERVER, JobPriority.TX) as slot:
+                    slot.release(error=_timeout())
+            self.assertEqual(MIN_LIMIT, stats()['limit'])
+        self.loop.run_until_complete(run())
@@ -1,10 +1,15 @@
+import asyncio
+import os
 import unittest
 import threading
+from concurrent.futures.process import BrokenProcessPool
 
-from electrum_mona.scrypt import scrypt_1024_1_1_80 as scryptGetHash
+from electrum_mona.scrypt import scrypt_1024_1_1_80 as scryptGetHash, SCRYPT_BACKENDS
 from electrum_mona.util import bfh,bh2u
 from electrum_mona.bitcoin import rev_hex,int_to_hex
-from electrum_mona.blockchain import serialize_header
+from electrum_mona.blockchain import (serialize_header, Blockchain, PowJob, verify_pow_batch,
+                                      verify_pow_batch_in_process_pool, shutdown_pow_executor,
+                                      MIN_POW_JOBS_FOR_PROCESS_POOL, _get_pow_executor)
 
 
 class Test_scrypt(unittest.TestCase):
@@ -15,3 +20,60 @@ class Test_scrypt(unittest.TestCase):
         powhash = rev_hex(bh2u(scryptGetHash(bfh(serialize_header(header)))))
         self.assertEqual(powhash, '00000000335c88172421df73a1c1f22f4d7c23d8ef34c78d728c4eff3ba24a34')
 
+    def test_scrypt_backends_agree(self):
+        header = {'block_height': 12095, 'nonce': 1612451328, 'timestamp': 1389110198, 'version': 2, 'prev_block_hash': 'f73b996a839a34115a22dd1de33098d295cb65643646be14c26db6e021fef111', 'merkle_root': 'e2ee62e8cb194b5aebeb99e4a229e05eb632d104f2bf7997033d59e5b336dbb5', 'bits': 476866422}
+        raw_header = bfh(serialize_header(header))
+        for name, scrypt_func in SCRYPT_BACKENDS.items():
+            with self.subTest(backend=name):
+                powhash = rev_hex(bh2u(scrypt_func(raw_header)))
+                self.assertEqual(powhash, '00000000335c88172421df73a1c1f22f4d7c23d8ef34c78d728c4eff3ba24a34')
+                with self.assertRaises(ValueError):
+                    scrypt_func(raw_header[:79])
+        # the one in use is one of them
+        self.assertIn(scryptGetHash, SCRYPT_BACKENDS.values())
+
+    def test_verify_pow_batch(self):
+        header = {'block_height': 12095, 'nonce': 1612451328, 'timestamp': 1389110198, 'version': 2, 'prev_block_hash': 'f73b996a839a34115a22dd1de33098d295cb65643646be14c26db6e021fef111', 'merkle_root': 'e2ee62e8cb194b5aebeb99e4a229e05eb632d104f2bf7997033d59e5b336dbb5', 'bits': 476866422}
+        raw_header = bfh(serialize_header(header))
+        target = Blockchain.bits_to_target(header['bits'])
+        verify_pow_batch([PowJob(raw_header, 12095, target)] * 3)
+        # powhash is 0x00000000335c88...
+        with self.assertRaises(Exception):
+            verify_pow_batch([PowJob(raw_header, 12095, target), PowJob(raw_header, 12095, 0x00000000335c88 << 200)])
+
+    def test_verify_pow_batch_in_process_pool(self):
+        header = {'block_height': 12095, 'nonce': 1612451328, 'timestamp': 1389110198, 'version': 2, 'prev_block_hash': 'f73b996a839a34115a22dd1de33098d295cb65643646be14c26db6e021fef111', 'merkle_root': 'e2ee62e8cb194b5aebeb99e4a229e05eb632d104f2bf7997033d59e5b336dbb5', 'bits': 476866422}
+        raw_header = bfh(serialize_header(header))
+        target = Blockchain.bits_to_target(header['bits'])
+        jobs = [PowJob(raw_header, 12095, target)] * MIN_POW_JOBS_FOR_PROCESS_POOL
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(verify_pow_batch_in_process_pool(jobs))
+            jobs[-1] = PowJob(raw_header, 12095, 0x00000000335c88 << 200)
+            with self.assertRaises(Exception):
+                loop.run_until_complete(verify_pow_batch_in_process_pool(jobs))
+        finally:
+            loop.close()
+            shutdown_pow_executor()
+
+    def test_verify_pow_batch_survives_broken_process_pool(self):
+        header = {'block_height': 12095, 'nonce': 1612451328, 'timestamp': 1389110198, 'version': 2, 'prev_block_hash': 'f73b996a839a34115a22dd1de33098d295cb65643646be14c26db6e021fef111', 'merkle_root': 'e2ee62e8cb194b5aebeb99e4a229e05eb632d104f2bf7997033d59e5b336dbb5', 'bits': 476866422}
+        raw_header = bfh(serialize_header(header))
+        target = Blockchain.bits_to_target(header['bits'])
+        jobs = [PowJob(raw_header, 12095, target)] * MIN_POW_JOBS_FOR_PROCESS_POOL
+        loop = asyncio.new_event_loop()
+        try:
+            # a worker dies
+            executor = _get_pow_executor()
+            if executor is None:
+                self.skipTest("no process pool on this platform")
+            with self.assertRaises(BrokenProcessPool):
+                executor.submit(os._exit, 1).result()
+            loop.run_until_complete(verify_pow_batch_in_process_pool(jobs))
+            jobs[-1] = PowJob(raw_header, 12095, 0x00000000335c88 << 200)
+            with self.assertRaises(Exception):
+                loop.run_until_complete(verify_pow_batch_in_process_pool(jobs))
+            self.assertIsNot(executor, _get_pow_executor())
+        finally:
+            loop.close()
+            shutdown_pow_executor()
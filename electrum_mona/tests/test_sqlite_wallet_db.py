@@ -0,0 +1,190 @@
+import json
+import os
+
+from electrum_mona.simple_config import SimpleConfig
+from electrum_mona.sqlite_wallet_db import SqliteWalletDB, convert_to_sqlite, convert_to_json
+from electrum_mona.storage import WalletStorage
+from electrum_mona.transaction import Transaction, TxOutpoint
+from electrum_mona.util import TxMinedInfo, InvalidPassword
+from electrum_mona.wallet import restore_wallet_from_text, Wallet
+from electrum_mona.wallet_db import WalletDB, load_wallet_db
+
+from . import ElectrumTestCase
+from .test_transaction import signed_blob
+
+
+SEED = 'bitter grass shiver impose acquire brush forget axis eager alone wine silver'
+PREVOUT_HASH = 'ab' * 32
+SCRIPTHASH = 'cd' * 32
+
+
+def _add_history(db: WalletDB, addr: str) -> str:
+    tx = Transaction(signed_blob)
+    txid = tx.txid()
+    db.add_transaction(txid, tx)
+    db.add_txi_addr(txid, addr, PREVOUT_HASH + ':0', 1000)
+    db.add_txi_addr(txid, addr, PREVOUT_HASH + ':1', 2000)
+    db.add_txo_addr(txid, addr, 0, 1000000, False)
+    db.set_spent_outpoint(PREVOUT_HASH, 0, txid)
+    db.set_addr_history(addr, [(txid, 100)])
+    db.add_verified_tx(txid, TxMinedInfo(height=100, timestamp=1, txpos=0, header_hash='00' * 32))
+    db.add_tx_fee_from_server(txid, 1000)
+    db.add_num_inputs_to_tx(txid, 2)
+    db.add_prevout_by_scripthash(SCRIPTHASH, prevout=TxOutpoint.from_str(PREVOUT_HASH + ':0'), value=1000)
+    return txid
+
+
+def _get_state(db: WalletDB, txid: str, addr: str) -> dict:
+    """What the accessors return, for comparing the backends."""
+    return {
+        'txi_addresses': db.get_txi_addresses(txid),
+        'txo_addresses': db.get_txo_addresses(txid),
+        'txi_addr': sorted(db.get_txi_addr(txid, addr)),
+        'txo_addr': db.get_txo_addr(txid, addr),
+        'list_txi': sorted(db.list_txi()),  # the order of rows is not that of insertion
+        'list_txo': sorted(db.list_txo()),
+        'spent_outpoints': sorted(db.list_spent_outpoints()),
+        'spent_outpoint': db.get_spent_outpoint(PREVOUT_HASH, 0),
+        'prevouts': db.get_prevouts_by_scripthash(SCRIPTHASH),
+        'tx': str(db.get_transaction(txid)),
+        'transactions': sorted(db.list_transactions()),
+        'history': sorted(db.get_history()),
+        'in_history': db.is_addr_in_history(addr),
+        'addr_history': [tuple(x) for x in db.get_addr_history(addr)],
+        'verified_tx': db.get_verified_tx(txid),
+        'in_verified_tx': db.is_in_verified_tx(txid),
+        'fee': db.get_tx_fee(txid, trust_server=True),
+        'num_inputs': db.get_num_all_inputs_of_tx(txid),
+        'num_ismine_inputs': db.get_num_ismine_inputs_of_tx(txid),
+    }
+
+
+class TestSqliteWalletDB(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        self.wallet_path = os.path.join(self.electrum_path, 'wallet')
+
+    def _create_wallet(self, password=None):
+        wallet = restore_wallet_from_text(SEED, path=self.wallet_path, password=password,
+                                          encrypt_file=bool(password), gap_limit=2,
+                                          config=self.config)['wallet']
+        addr = wallet.get_receiving_addresses()[0]
+        txid = _add_history(wallet.db, addr)
+        wallet.save_db()
+        return wallet, txid, addr
+
+    def _load_db(self, password=None) -> WalletDB:
+        storage = WalletStorage(self.wallet_path)
+        if password:
+            storage.decrypt(password)
+        return load_wallet_db(storage, manual_upgrades=False)
+
+    def test_convert_and_load(self):
+        wallet, txid, addr = self._create_wallet()
+        backup_path = convert_to_sqlite(self.wallet_path)
+        self.assertTrue(WalletStorage(self.wallet_path).is_sqlite())
+        self.assertFalse(WalletStorage(backup_path).is_sqlite())
+        db = self._load_db()
+        self.assertIsInstance(db, SqliteWalletDB)
+        self.assertEqual(json.loads(wallet.db.dump()), json.loads(db.dump()))
+        self.assertEqual(_get_state(wallet.db, txid, addr), _get_state(db, txid, addr))
+        self.assertEqual(wallet.get_receiving_addresses(),
+                         Wallet(db, WalletStorage(self.wallet_path), config=self.config).get_receiving_addresses())
+
+    def test_same_behaviour_as_json(self):
+        wallet, txid, addr = self._create_wallet()
+        convert_to_sqlite(self.wallet_path)
+        dbs = [wallet.db, self._load_db()]
+        prevout = TxOutpoint.from_str(PREVOUT_HASH + ':0')
+        for db in dbs:
+            db.remove_prevout_by_scripthash(SCRIPTHASH, prevout=prevout, value=1)  # wrong value
+            db.add_tx_fee_we_calculated(txid, 2000)
+            db.add_tx_fee_from_server(txid, 3000)  # ignored, as we calculated it
+            db.remove_spent_outpoint(PREVOUT_HASH, 0)
+        self.assertEqual(_get_state(dbs[0], txid, addr), _get_state(dbs[1], txid, addr))
+        for db in dbs:
+            db.remove_prevout_by_scripthash(SCRIPTHASH, prevout=prevout, value=1000)
+            db.remove_txi(txid)
+            db.remove_verified_tx(txid)
+            db.remove_tx_fee(txid)
+            db.remove_addr_history(addr)
+            db.remove_transaction(txid)
+        self.assertEqual(_get_state(dbs[0], txid, addr), _get_state(dbs[1], txid, addr))
+        for db in dbs:
+            db.clear_history()
+        self.assertEqual(_get_state(dbs[0], txid, addr), _get_state(dbs[1], txid, addr))
+
+    def test_changes_are_saved_on_write(self):
+        self._create_wallet()
+        convert_to_sqlite(self.wallet_path)
+        storage = WalletStorage(self.wallet_path)
+        db = load_wallet_db(storage, manual_upgrades=False)
+        db.put('labels', {'a': 'b'})
+        db.clear_history()
+        # nothing is saved until written
+        self.assertNotEqual({'a': 'b'}, self._load_db().get('labels'))
+        self.assertNotEqual([], self._load_db().list_transactions())
+        db.write(storage)
+        self.assertEqual(json.loads(db.dump()), json.loads(self._load_db().dump()))
+        self.assertEqual({'a': 'b'}, self._load_db().get('labels'))
+
+    def test_encrypted_file(self):
+        password = 'secret'
+        wallet, txid, addr = self._create_wallet(password)
+        with self.assertRaises(InvalidPassword):
+            convert_to_sqlite(self.wallet_path)
+        convert_to_sqlite(self.wallet_path, password=password)
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(storage.is_sqlite())
+        self.assertTrue(storage.is_encrypted_with_user_pw())
+        with self.assertRaises(InvalidPassword):
+            storage.decrypt('wrong')
+        db = self._load_db(password)
+        self.assertEqual(json.loads(wallet.db.dump()), json.loads(db.dump()))
+        # keys and values are encrypted
+        with open(self.wallet_path, 'rb') as f:
+            contents = f.read()
+        for s in (txid, addr, signed_blob, PREVOUT_HASH, SEED.split()[0]):
+            self.assertNotIn(s.encode(), contents)
+
+        # changing the password rewrites the file with the new key
+        storage = WalletStorage(self.wallet_path)
+        storage.decrypt(password)
+        wallet = Wallet(load_wallet_db(storage, manual_upgrades=False), storage, config=self.config)
+        wallet.update_password(password, 'new secret')
+        wallet.save_db()
+        with self.assertRaises(InvalidPassword):
+            self._load_db(password)
+        self.assertEqual(_get_state(wallet.db, txid, addr), _get_state(self._load_db('new secret'), txid, addr))
+
+        # and removing it decrypts it
+        wallet.update_password('new secret', None, encrypt_storage=False)
+        wallet.save_db()
+        self.assertFalse(WalletStorage(self.wallet_path).is_encrypted())
+        self.assertEqual(_get_state(wallet.db, txid, addr), _get_state(self._load_db(), txid, addr))
+
+    def test_convert_back_to_json(self):
+        for password in (None, 'secret'):
+            with self.subTest(password=password):
+                for path in (self.wallet_path, self.wallet_path + '.json_backup',
+                             self.wallet_path + '.sqlite_backup'):
+                    if os.path.exists(path):
+                        os.remove(path)
+                wallet, txid, addr = self._create_wallet(password)
+                convert_to_sqlite(self.wallet_path, password=password)
+                if password:
+                    with self.assertRaises(InvalidPassword):
+                        convert_to_json(self.wallet_path)
+                with self.assertRaises(Exception):
+                    convert_to_json(self.wallet_path + '.json_backup', password=password)  # not sqlite
+                backup_path = convert_to_json(self.wallet_path, password=password)
+                self.assertTrue(WalletStorage(backup_path).is_sqlite())
+                storage = WalletStorage(self.wallet_path)
+                self.assertFalse(storage.is_sqlite())
+                self.assertEqual(bool(password), storage.is_encrypted_with_user_pw())
+                db = self._load_db(password)
+                self.assertNotIsInstance(db, SqliteWalletDB)
+                self.assertEqual(json.loads(wallet.db.dump()), json.loads(db.dump()))
+                self.assertEqual(_get_state(wallet.db, txid, addr), _get_state(db, txid, addr))
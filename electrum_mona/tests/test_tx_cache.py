@@ -0,0 +1,71 @@
+import os
+import sqlite3
+
+from electrum_mona.tx_cache import TxCache
+from electrum_mona.transaction import Transaction
+from electrum_mona.util import bfh
+
+from . import ElectrumTestCase
+from .test_transaction import signed_blob
+
+
+def _raw_tx(locktime: int) -> str:
+    return signed_blob[:-8] + locktime.to_bytes(4, 'little').hex()
+
+
+class TestTxCache(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.electrum_path, 'tx_cache')
+
+    def _create_cache(self, **kwargs) -> TxCache:
+        return TxCache(self.path, **kwargs)
+
+    def test_add_and_get(self):
+        cache = self._create_cache()
+        raw_tx = _raw_tx(1)
+        txid = Transaction(raw_tx).txid()
+        self.assertIsNone(cache.get_raw_tx(txid))
+        cache.add_raw_tx(txid, raw_tx)
+        self.assertEqual(raw_tx, cache.get_raw_tx(txid))
+        cache.add_raw_tx(txid, raw_tx)
+        self.assertEqual({'num_txs': 1, 'size': len(raw_tx) // 2, 'max_size': cache.max_size},
+                         cache.get_stats())
+
+    def test_tx_not_matching_txid_is_dropped(self):
+        cache = self._create_cache()
+        raw_tx = _raw_tx(1)
+        txid = Transaction(raw_tx).txid()
+        cache.add_raw_tx(txid, raw_tx)
+        # corrupt the stored tx behind the back of the cache
+        conn = sqlite3.connect(self.path)
+        conn.execute("UPDATE txs SET raw=? WHERE txid=?", (bfh(_raw_tx(2)), bfh(txid)))
+        conn.commit()
+        conn.close()
+        self.assertIsNone(cache.get_raw_tx(txid))
+        self.assertEqual(0, cache.get_stats()['num_txs'])
+
+    def test_least_recently_used_txs_are_evicted(self):
+        raw_txs = [_raw_tx(i) for i in range(4)]
+        txids = [Transaction(raw_tx).txid() for raw_tx in raw_txs]
+        tx_size = len(raw_txs[0]) // 2
+        cache = self._create_cache(max_size=3 * tx_size)
+        for txid, raw_tx in zip(txids[:3], raw_txs[:3]):
+            cache.add_raw_tx(txid, raw_tx)
+        # use the oldest one, so that the second one becomes the least recently used
+        self.assertEqual(raw_txs[0], cache.get_raw_tx(txids[0]))
+        cache.add_raw_tx(txids[3], raw_txs[3])
+        self.assertIsNone(cache.get_raw_tx(txids[1]))
+        for i in (0, 2, 3):
+            self.assertEqual(raw_txs[i], cache.get_raw_tx(txids[i]))
+        self.assertEqual(3 * tx_size, cache.get_stats()['size'])
+
+    def test_usable_without_event_loop(self):
+        # e.g. from the GUI before the network is started
+        cache = self._create_cache()
+        raw_tx = _raw_tx(1)
+        txid = Transaction(raw_tx).txid()
+        cache.add_raw_tx(txid, raw_tx)
+        cache.flush()
+        self.assertEqual(raw_tx, self._create_cache().get_raw_tx(txid))
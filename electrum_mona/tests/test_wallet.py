@@ -5,14 +5,15 @@ import os
 import json
 from decimal import Decimal
 import time
+import zlib
 
 from io import StringIO
-from electrum_mona.storage import WalletStorage
+from electrum_mona.storage import WalletStorage, StorageEncryptionVersion, BLOCK_SIZE
 from electrum_mona.wallet_db import FINAL_SEED_VERSION
 from electrum_mona.wallet import (Abstract_Wallet, Standard_Wallet, create_new_wallet,
                              restore_wallet_from_text, Imported_Wallet, Wallet)
 from electrum_mona.exchange_rate import ExchangeBase, FxThread
-from electrum_mona.util import TxMinedInfo, InvalidPassword
+from electrum_mona.util import TxMinedInfo, InvalidPassword, WalletFileException
 from electrum_mona.bitcoin import COIN
 from electrum_mona.wallet_db import WalletDB
 from electrum_mona.simple_config import SimpleConfig
@@ -83,6 +84,203 @@ class TestWalletStorage(WalletTestCase):
         for key, value in some_dict.items():
             self.assertEqual(d[key], value)
 
+    def _reload_db(self) -> WalletDB:
+        return WalletDB(WalletStorage(self.wallet_path).read(), manual_upgrades=True)
+
+    def test_changes_are_not_appended_by_default(self):
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB('', manual_upgrades=True)
+        db.put('a', 1)
+        db.write(storage)
+        db.put('a', 2)
+        db.write(storage)
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(2, json.loads(f.read())['a'])
+
+    def test_changes_are_appended_as_journal(self):
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB('', manual_upgrades=True)
+        db.put('use_journal', True)
+        d = db.get_dict('d')
+        d['x'] = {'y': 1}
+        d['z'] = [1, 2]
+        db.write(storage)
+        size = os.path.getsize(self.wallet_path)
+
+        d['x']['y'] = 2
+        d['x']['w'] = {'v': 3}
+        d['x']['w']['v'] = 4
+        d.pop('z')
+        d.pop('missing', None)
+        db.put('a', 'b')
+        db.write(storage)
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        self.assertGreater(len(contents), size)
+        snapshot, journal = contents[:size], contents[size:]
+        self.assertEqual({'y': 1}, json.loads(snapshot)['d']['x'])
+        self.assertEqual(1, journal.count('\n'))
+        self.assertEqual(json.loads(db.dump()), json.loads(self._reload_db().dump()))
+        # nothing changed
+        db.write(storage)
+        self.assertEqual(len(contents), os.path.getsize(self.wallet_path))
+
+        d['x'].clear()
+        db.write(storage)
+        self.assertEqual({}, self._reload_db().get('d')['x'])
+
+    def test_list_changed_in_place_and_set_again_is_journaled(self):
+        # e.g. lnhtlc.store_local_update_raw_msg
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB('', manual_upgrades=True)
+        db.put('use_journal', True)
+        log = db.get_dict('log')
+        db.write(storage)
+        for msg in ('aa', 'bb'):
+            l = log.get(5, [])
+            l.append(msg)
+            log[5] = l
+            db.write(storage)
+        db.put('y', 1)
+        db.write(storage)
+        self.assertEqual({'5': ['aa', 'bb']}, self._reload_db().get('log'))
+
+    def test_incomplete_journal_write_is_ignored(self):
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB('', manual_upgrades=True)
+        db.put('use_journal', True)
+        db.put('a', 1)
+        db.write(storage)
+        db.put('a', 2)
+        db.write(storage)
+        with open(self.wallet_path, "a") as f:
+            f.write('\n[[["a"],3')
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB(storage.read(), manual_upgrades=True)
+        self.assertEqual(2, db.get('a'))
+        # the incomplete write is removed before anything is appended
+        db.put('a', 4)
+        db.write(storage)
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(4, json.loads(f.read())['a'])
+
+    def test_journal_is_compacted(self):
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB('', manual_upgrades=True)
+        db.put('use_journal', True)
+        db.write(storage)
+        d = db.get_dict('d')
+        for i in range(100):
+            d[i] = 'x' * 10
+            db.write(storage)
+        # rewritten when the journal got larger than the rest of the file
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        self.assertLess(contents.count('\n['), 50)
+        self.assertEqual(json.loads(db.dump()), json.loads(self._reload_db().dump()))
+
+    def _reload_encrypted_db(self, password) -> WalletDB:
+        storage = WalletStorage(self.wallet_path)
+        storage.decrypt(password)
+        return WalletDB(storage.read(), manual_upgrades=True)
+
+    def test_encrypted_changes_are_appended_as_journal(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_password('secret', StorageEncryptionVersion.USER_PASSWORD)
+        self.assertEqual(StorageEncryptionVersion.USER_PASSWORD, storage.get_encryption_version())
+        storage.set_password('secret', StorageEncryptionVersion.USER_PASSWORD, use_blocks=True)
+        self.assertEqual(StorageEncryptionVersion.USER_PASSWORD_BLOCKS, storage.get_encryption_version())
+        db = WalletDB('', manual_upgrades=True)
+        db.put('use_journal', True)
+        d = db.get_dict('d')
+        d['x'] = 'first value'
+        db.write(storage)
+        size = os.path.getsize(self.wallet_path)
+
+        d['x'] = 'second value'
+        db.put('a', 'b')
+        db.write(storage)
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        # index, one block, and one journal record
+        self.assertEqual(1, contents[:size].count('\n'))
+        self.assertEqual(1, contents[size:].count('\n'))
+        self.assertNotIn('value', contents)
+        self.assertTrue(WalletStorage(self.wallet_path).is_encrypted_with_user_pw())
+        with self.assertRaises(InvalidPassword):
+            self._reload_encrypted_db('wrong')
+        self.assertEqual(json.loads(db.dump()), json.loads(self._reload_encrypted_db('secret').dump()))
+
+        # changing the password rewrites the file, which stays in blocks
+        storage.set_password('new secret', StorageEncryptionVersion.USER_PASSWORD)
+        self.assertEqual(StorageEncryptionVersion.USER_PASSWORD_BLOCKS, storage.get_encryption_version())
+        d['x'] = 'third value'
+        db.write(storage)
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(1, f.read().count('\n'))
+        self.assertEqual(json.loads(db.dump()), json.loads(self._reload_encrypted_db('new secret').dump()))
+
+    def test_encrypted_incomplete_journal_write_is_ignored(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_password('secret', StorageEncryptionVersion.XPUB_PASSWORD_BLOCKS)
+        db = WalletDB('', manual_upgrades=True)
+        db.put('use_journal', True)
+        db.put('a', 1)
+        db.write(storage)
+        db.put('a', 2)
+        db.write(storage)
+        with open(self.wallet_path, "a") as f:
+            f.write('\nAAAA')
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(storage.is_encrypted_with_hw_device())
+        storage.decrypt('secret')
+        db = WalletDB(storage.read(), manual_upgrades=True)
+        self.assertEqual(2, db.get('a'))
+        # the incomplete write is removed before anything is appended
+        db.put('a', 4)
+        db.write(storage)
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(1, f.read().count('\n'))
+        self.assertEqual(4, self._reload_encrypted_db('secret').get('a'))
+
+    def test_encrypted_blocks_are_authenticated(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_password('secret', StorageEncryptionVersion.USER_PASSWORD_BLOCKS)
+        db = WalletDB('', manual_upgrades=True)
+        db.put('a', os.urandom(BLOCK_SIZE // 2).hex())
+        db.write(storage)
+        with open(self.wallet_path, "r") as f:
+            lines = f.read().split('\n')
+        self.assertEqual(1 + 2, len(lines))
+        self.assertEqual(json.loads(db.dump()), json.loads(self._reload_encrypted_db('secret').dump()))
+        # blocks cannot be swapped
+        with open(self.wallet_path, "w") as f:
+            f.write('\n'.join([lines[0], lines[2], lines[1]]))
+        with self.assertRaises(WalletFileException):
+            self._reload_encrypted_db('secret')
+
+    def test_legacy_encrypted_file_is_not_converted_when_written(self):
+        ec_key = WalletStorage.get_eckey_from_password('secret')
+        data = zlib.compress(json.dumps({'a': 1}).encode('utf8'))
+        with open(self.wallet_path, "w") as f:
+            f.write(ec_key.encrypt_message(data, b'BIE1').decode('utf8'))
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual(StorageEncryptionVersion.USER_PASSWORD, storage.get_encryption_version())
+        with self.assertRaises(InvalidPassword):
+            storage.decrypt('wrong')
+        storage.decrypt('secret')
+        db = WalletDB(storage.read(), manual_upgrades=True)
+        self.assertEqual(1, db.get('a'))
+        self.assertFalse(storage.can_append())
+        db.put('use_journal', True)
+        db.put('a', 2)
+        db.write(storage)
+        # only converted when the password is set with use_blocks
+        self.assertEqual(StorageEncryptionVersion.USER_PASSWORD,
+                         WalletStorage(self.wallet_path).get_encryption_version())
+        self.assertFalse(storage.can_append())
+        self.assertEqual(2, self._reload_encrypted_db('secret').get('a'))
+
 class FakeExchange(ExchangeBase):
     def __init__(self, rate):
         super().__init__(lambda self: None, lambda self: None)
@@ -186,6 +384,45 @@ class TestCreateRestoreWallet(WalletTestCase):
         self.assertEqual(encrypt_file, wallet.storage.is_encrypted())
         self.assertEqual('mona1q2ccr34wzep58d4239tl3x3734ttle92arr4e30', wallet.get_receiving_addresses()[0])
 
+    def test_wallet_changes_are_journaled(self):
+        text = 'bitter grass shiver impose acquire brush forget axis eager alone wine silver'
+        d = restore_wallet_from_text(text, path=self.wallet_path, gap_limit=2, config=self.config)
+        wallet = d['wallet']  # type: Standard_Wallet
+        wallet.create_new_address(False)
+        wallet.save_db()
+        with open(self.wallet_path, "r") as f:
+            self.assertNotIn('\n[', f.read())
+        wallet.enable_file_journal(None)
+        size = os.path.getsize(self.wallet_path)
+        wallet.create_new_address(False)
+        wallet.create_new_address(True)
+        wallet.set_label(wallet.get_receiving_addresses()[0], 'label')
+        wallet.save_db()
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(size, f.read().find('\n['))
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB(storage.read(), manual_upgrades=False)
+        self.assertEqual(json.loads(wallet.db.dump()), json.loads(db.dump()))
+
+    def test_enabling_journal_converts_encrypted_file_to_blocks(self):
+        text = 'bitter grass shiver impose acquire brush forget axis eager alone wine silver'
+        d = restore_wallet_from_text(text, path=self.wallet_path, gap_limit=2, config=self.config,
+                                     password='secret', encrypt_file=True)
+        wallet = d['wallet']  # type: Standard_Wallet
+        self.assertEqual(StorageEncryptionVersion.USER_PASSWORD, WalletStorage(self.wallet_path).get_encryption_version())
+        with self.assertRaises(InvalidPassword):
+            wallet.enable_file_journal('wrong')
+        wallet.enable_file_journal('secret')
+        self.assertEqual(StorageEncryptionVersion.USER_PASSWORD_BLOCKS, WalletStorage(self.wallet_path).get_encryption_version())
+        # and it stays so when the password is changed
+        wallet.update_password('secret', 'new secret')
+        wallet.save_db()
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual(StorageEncryptionVersion.USER_PASSWORD_BLOCKS, storage.get_encryption_version())
+        storage.decrypt('new secret')
+        db = WalletDB(storage.read(), manual_upgrades=False)
+        self.assertEqual(json.loads(wallet.db.dump()), json.loads(db.dump()))
+
     def test_restore_wallet_from_text_xpub(self):
         text = 'zpub6nsHdRuY92FsMKdbn9BfjBCG6X8pyhCibNP6uDvpnw2cyrVhecvHRMa3Ne8kdJZxjxgwnpbHLkcR4bfnhHy6auHPJyDTQ3kianeuVLdkCYQ'
         d = restore_wallet_from_text(text, path=self.wallet_path, gap_limit=1, config=self.config)
@@ -0,0 +1,146 @@
+"""Datadir-level store of raw transactions, shared by all wallets.
+
+Transactions are content-addressed by txid, and the txid is checked again
+when reading them back, so a corrupted entry is dropped instead of served.
+The total size of the stored transactions is capped; when the cap is
+exceeded the least recently used transactions are evicted.
+
+The methods are blocking, and safe to call from any thread. They do not
+depend on the event loop, so that a lookup can never hang; the network
+runs them in an executor.
+"""
+
+import sqlite3
+import threading
+from typing import Optional
+
+from .logging import Logger
+from .transaction import Transaction
+from .util import bh2u, bfh, test_read_write_permissions
+
+
+DEFAULT_TX_CACHE_MAX_SIZE = 32 * 1024 * 1024  # bytes
+COMMIT_INTERVAL = 100
+
+create_txs = """
+CREATE TABLE IF NOT EXISTS txs (
+txid BLOB(32) PRIMARY KEY,
+raw BLOB,
+last_used INTEGER NOT NULL
+)"""
+
+create_last_used_index = """
+CREATE INDEX IF NOT EXISTS txs_last_used ON txs (last_used)"""
+
+
+class TxCache(Logger):
+
+    def __init__(self, path, *, max_size: int = DEFAULT_TX_CACHE_MAX_SIZE):
+        Logger.__init__(self)
+        self.path = path
+        self.max_size = max_size
+        test_read_write_permissions(path)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._num_uncommitted = 0
+        self.create_database()
+
+    def create_database(self):
+        c = self.conn.cursor()
+        c.execute(create_txs)
+        c.execute(create_last_used_index)
+        self.conn.commit()
+        c.execute("SELECT COALESCE(SUM(LENGTH(raw)), 0), COALESCE(MAX(last_used), 0) FROM txs")
+        self._total_size, self._clock = c.fetchone()
+
+    def flush(self) -> None:
+        """Writes out the pending updates of last_used."""
+        with self.lock:
+            self._commit()
+
+    def _touch(self, txid: bytes) -> None:
+        self._clock += 1
+        c = self.conn.cursor()
+        c.execute("UPDATE txs SET last_used=? WHERE txid=?", (self._clock, txid))
+        # accesses only update last_used; they get written out with the next add,
+        # or every COMMIT_INTERVAL accesses
+        self._num_uncommitted += 1
+        if self._num_uncommitted >= COMMIT_INTERVAL:
+            self._commit()
+
+    def _commit(self) -> None:
+        self.conn.commit()
+        self._num_uncommitted = 0
+
+    def _delete(self, txid: bytes, size: int) -> None:
+        c = self.conn.cursor()
+        c.execute("DELETE FROM txs WHERE txid=?", (txid,))
+        self._total_size -= size
+
+    def _evict(self) -> None:
+        c = self.conn.cursor()
+        while self._total_size > self.max_size:
+            c.execute("SELECT txid, LENGTH(raw) FROM txs ORDER BY last_used ASC LIMIT 100")
+            rows = c.fetchall()
+            if not rows:
+                break
+            for txid, size in rows:
+                if self._total_size <= self.max_size:
+                    break
+                self._delete(txid, size)
+
+    def get_raw_tx(self, txid: str) -> Optional[str]:
+        with self.lock:
+            return self._get_raw_tx(txid)
+
+    def _get_raw_tx(self, txid: str) -> Optional[str]:
+        key = bfh(txid)
+        c = self.conn.cursor()
+        c.execute("SELECT raw FROM txs WHERE txid=?", (key,))
+        row = c.fetchone()
+        if row is None:
+            return None
+        raw = row[0]
+        raw_tx = bh2u(raw)
+        try:
+            ok = Transaction(raw_tx).txid() == txid
+        except Exception:
+            ok = False
+        if not ok:
+            self.logger.warning(f"dropping cached tx that does not match its txid {txid}")
+            self._delete(key, len(raw))
+            self._commit()
+            return None
+        self._touch(key)
+        return raw_tx
+
+    def add_raw_tx(self, txid: str, raw_tx: str) -> None:
+        with self.lock:
+            self._add_raw_tx(txid, raw_tx)
+
+    def _add_raw_tx(self, txid: str, raw_tx: str) -> None:
+        key = bfh(txid)
+        raw = bfh(raw_tx)
+        if len(raw) > self.max_size:
+            return
+        c = self.conn.cursor()
+        c.execute("SELECT LENGTH(raw) FROM txs WHERE txid=?", (key,))
+        row = c.fetchone()
+        if row is not None:
+            self._touch(key)
+        else:
+            self._clock += 1
+            c.execute("INSERT INTO txs (txid, raw, last_used) VALUES (?,?,?)", (key, raw, self._clock))
+            self._total_size += len(raw)
+            self._evict()
+        self._commit()
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT COUNT(*) FROM txs")
+            return {
+                'num_txs': c.fetchone()[0],
+                'size': self._total_size,
+                'max_size': self.max_size,
+            }
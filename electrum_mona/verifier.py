@@ -32,6 +32,7 @@ from .bitcoin import hash_decode, hash_encode
 from .transaction import Transaction
 from .blockchain import hash_header
 from .interface import GracefulDisconnect
+from .request_scheduler import JobPriority, RequestSlot
 from .network import UntrustedServerReturnedError
 from . import constants
 
@@ -89,14 +90,17 @@ class SPV(NetworkJobOnDefaultServer):
                 if tx_height < constants.net.max_checkpoint():
                     await self.taskgroup.spawn(self.network.request_chunk(tx_height, None, can_return_early=True))
                 continue
-            # request now
+            # request now, as soon as the scheduler lets us.
+            # the proofs requested at once go out as JSON-RPC batches
             self.logger.info(f'requested merkle {tx_hash}')
             self.requested_merkle.add(tx_hash)
-            await self.taskgroup.spawn(self._request_and_verify_single_proof, tx_hash, tx_height)
+            await self.network.request_scheduler.spawn(self.taskgroup, self.interface.server, JobPriority.PROOFS,
+                                                       self._request_and_verify_single_proof, tx_hash, tx_height)
 
-    async def _request_and_verify_single_proof(self, tx_hash, tx_height):
+    async def _request_and_verify_single_proof(self, tx_hash, tx_height, *, slot: RequestSlot):
         try:
-            merkle = await self.network.get_merkle_for_transaction(tx_hash, tx_height)
+            async with slot:
+                merkle = await self.network.get_merkle_for_transaction(tx_hash, tx_height, batched=True)
         except UntrustedServerReturnedError as e:
             if not isinstance(e.original_exception, aiorpcx.jsonrpc.RPCError):
                 raise
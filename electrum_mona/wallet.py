@@ -66,7 +66,7 @@ from .keystore import (load_keystore, Hardware_KeyStore, KeyStore, KeyStoreWithM
                        AddressIndexGeneric, CannotDerivePubkey)
 from .util import multisig_type
 from .storage import StorageEncryptionVersion, WalletStorage
-from .wallet_db import WalletDB
+from .wallet_db import WalletDB, load_wallet_db
 from . import transaction, bitcoin, coinchooser, paymentrequest, ecc, bip32
 from .transaction import (Transaction, TxInput, UnknownTxinType, TxOutput,
                           PartialTransaction, PartialTxInput, PartialTxOutput, TxOutpoint)
@@ -2164,6 +2164,22 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         if self.has_storage_encryption():
             self.storage.check_password(password)
 
+    def enable_file_journal(self, password) -> None:
+        """Save changes by appending them to the wallet file, instead of
+        rewriting it. Encrypted files are rewritten as encrypted blocks for
+        that. Older versions of Electrum cannot open the file afterwards.
+        """
+        if not self.storage:
+            raise Exception("This wallet has no file.")
+        if self.storage.is_sqlite():
+            raise Exception("SQLite wallet files do not need a journal.")
+        self.check_password(password)
+        if self.has_storage_encryption():
+            self.storage.set_password(password, use_blocks=True)
+        self.db.put('use_journal', True)
+        self.db.set_modified(True)
+        self.save_db()
+
     def update_password(self, old_pw, new_pw, *, encrypt_storage: bool = True):
         if old_pw is None and self.has_password():
             raise InvalidPassword()
@@ -2173,7 +2189,7 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
                 enc_version = self.get_available_storage_encryption_version()
             else:
                 enc_version = StorageEncryptionVersion.PLAINTEXT
-            self.storage.set_password(new_pw, enc_version)
+            self.storage.set_password(new_pw, enc_version, use_blocks=self.db.get('use_journal', False))
         # make sure next storage.write() saves changes
         self.db.set_modified(True)
 
@@ -3038,7 +3054,7 @@ def check_password_for_directory(config, old_password, new_password=None):
             if not storage.is_encrypted():
                 # it is a bit wasteful load the wallet here, but that is fine
                 # because we are progressively enforcing storage encryption.
-                db = WalletDB(storage.read(), manual_upgrades=False)
+                db = load_wallet_db(storage, manual_upgrades=False)
                 wallet = Wallet(db, storage, config=config)
                 if wallet.has_keystore_encryption():
                     try:
@@ -3060,7 +3076,7 @@ def check_password_for_directory(config, old_password, new_password=None):
             except:
                 failed.append(basename)
                 continue
-            db = WalletDB(storage.read(), manual_upgrades=False)
+            db = load_wallet_db(storage, manual_upgrades=False)
             wallet = Wallet(db, storage, config=config)
             try:
                 wallet.check_password(old_password)
@@ -39,7 +39,7 @@ from .transaction import Transaction, TxOutpoint, tx_from_any, PartialTransactio
 from .logging import Logger
 from .lnutil import LOCAL, REMOTE, FeeUpdate, UpdateAddHtlc, LocalConfig, RemoteConfig, Keypair, OnlyPubkeyKeypair, RevocationStore, ChannelBackupStorage
 from .lnutil import ChannelConstraints, Outpoint, ShachainElement
-from .json_db import StoredDict, JsonDB, locked, modifier
+from .json_db import StoredDict, JsonDB, locked, modifier, load_json_with_journal
 from .plugin import run_hook, plugin_loaders
 from .paymentrequest import PaymentRequest
 from .submarine_swaps import SwapData
@@ -62,6 +62,14 @@ class TxFeesValue(NamedTuple):
     num_inputs: Optional[int] = None
 
 
+def load_wallet_db(storage: 'WalletStorage', *, manual_upgrades: bool) -> 'WalletDB':
+    """Returns the db of storage, which must be decrypted, whatever the format of the file."""
+    if storage.is_sqlite():
+        from .sqlite_wallet_db import SqliteWalletDB
+        return SqliteWalletDB(storage, manual_upgrades=manual_upgrades)
+    return WalletDB(storage.read(), manual_upgrades=manual_upgrades)
+
+
 class WalletDB(JsonDB):
 
     def __init__(self, raw, *, manual_upgrades: bool):
@@ -76,8 +84,11 @@ class WalletDB(JsonDB):
             self._after_upgrade_tasks()
 
     def load_data(self, s):
+        is_journal_complete = True
         try:
-            self.data = json.loads(s)
+            self.data, is_journal_complete = load_json_with_journal(s)
+        except WalletFileException:
+            raise
         except:
             try:
                 d = ast.literal_eval(s)
@@ -103,6 +114,10 @@ class WalletDB(JsonDB):
             self._after_upgrade_tasks()
         elif not self._manual_upgrades:
             self.upgrade()
+        if not is_journal_complete:
+            self.logger.warning('the last write to the wallet file was incomplete, and is ignored')
+            # rewrite the file, without the incomplete write
+            self.set_modified(True)
 
     def requires_split(self):
         d = self.get('accounts', {})
@@ -185,6 +200,8 @@ class WalletDB(JsonDB):
         self._convert_version_35()
         self._convert_version_36()
         self.put('seed_version', FINAL_SEED_VERSION)  # just to be sure
+        # the conversions above are not journaled
+        self.set_modified(True)
 
         self._after_upgrade_tasks()
 
@@ -935,6 +952,7 @@ class WalletDB(JsonDB):
         if scripthash not in self._prevouts_by_scripthash:
             self._prevouts_by_scripthash[scripthash] = set()
         self._prevouts_by_scripthash[scripthash].add((prevout.to_str(), value))
+        self._journal_set(self._prevouts_by_scripthash.path + [scripthash], self._prevouts_by_scripthash[scripthash])
 
     @modifier
     def remove_prevout_by_scripthash(self, scripthash: str, *, prevout: TxOutpoint, value: int) -> None:
@@ -944,6 +962,8 @@ class WalletDB(JsonDB):
         self._prevouts_by_scripthash[scripthash].discard((prevout.to_str(), value))
         if not self._prevouts_by_scripthash[scripthash]:
             self._prevouts_by_scripthash.pop(scripthash)
+        else:
+            self._journal_set(self._prevouts_by_scripthash.path + [scripthash], self._prevouts_by_scripthash[scripthash])
 
     @locked
     def get_prevouts_by_scripthash(self, scripthash: str) -> Set[Tuple[TxOutpoint, int]]:
@@ -1124,14 +1144,18 @@ class WalletDB(JsonDB):
     @modifier
     def add_change_address(self, addr: str) -> None:
         assert isinstance(addr, str)
-        self._addr_to_addr_index[addr] = (1, len(self.change_addresses))
+        index = len(self.change_addresses)
+        self._addr_to_addr_index[addr] = (1, index)
         self.change_addresses.append(addr)
+        self._journal_set(['addresses', 'change', index], addr)
 
     @modifier
     def add_receiving_address(self, addr: str) -> None:
         assert isinstance(addr, str)
-        self._addr_to_addr_index[addr] = (0, len(self.receiving_addresses))
+        index = len(self.receiving_addresses)
+        self._addr_to_addr_index[addr] = (0, index)
         self.receiving_addresses.append(addr)
+        self._journal_set(['addresses', 'receiving', index], addr)
 
     @locked
     def get_address_index(self, address: str) -> Optional[Sequence[int]]:
@@ -1275,8 +1299,14 @@ class WalletDB(JsonDB):
             return
         if not self.modified():
             return
-        json_str = self.dump(human_readable=not storage.is_encrypted())
-        storage.write(json_str)
+        if (self._full_write_needed or not self.get('use_journal', False)
+                or not storage.can_append() or storage.needs_compaction()):
+            json_str = self.dump(human_readable=not storage.is_encrypted())
+            storage.write(json_str)
+        else:
+            record = self.dump_journal_record()
+            if record:
+                storage.append(record)
         self.set_modified(False)
 
     def is_ready_to_be_used_by_wallet(self):